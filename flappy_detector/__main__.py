@@ -0,0 +1,82 @@
+"""
+Offline detection over exported EC2 records, finding when each group would have been flapping.
+
+Usage: python -m flappy_detector [options] EXPORT_FILE [EXPORT_FILE ...]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from typing import List, Optional
+
+from flappy_detector.utils.replay import EXPORT_FORMATS, ReplayConfig, get_chunks, replay
+from flappy_detector.utils.time_bucket import ROLLUP_BUCKET_SIZE_IN_SECS
+
+logger = logging.getLogger(__name__)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Build the command line parser, with the detector's thresholds as flags.
+    :return: The parser.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m flappy_detector",
+        description=(
+            "Replay exported EC2 records, as JSON lines or CSV, through the detector and print each period a "
+            "group was flapping for as a JSON line."
+        ),
+    )
+    parser.add_argument("paths", nargs="+", metavar="EXPORT_FILE", help="Export files, optionally gzipped")
+    parser.add_argument(
+        "--format",
+        choices=EXPORT_FORMATS,
+        help="Format of the export files, guessed from their names by default",
+    )
+    parser.add_argument("--max-event-age-mins", type=int, default=120, help="How far back each run looks")
+    parser.add_argument("--min-num-events", type=int, default=5, help="Fewest events to be flapping")
+    parser.add_argument("--min-spread", type=int, default=1, help="Most change in host count to be flapping")
+    parser.add_argument("--step-mins", type=int, default=30, help="How often the detector runs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--chunk-size-mb", type=int, default=64, help="Size of the chunks files are split in")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    """
+    Run the offline detection.
+    :param argv: Command line arguments, sys.argv by default.
+    """
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.step_mins <= 0 or args.step_mins * 60 % ROLLUP_BUCKET_SIZE_IN_SECS:
+        parser.error(f"--step-mins must be a positive multiple of {ROLLUP_BUCKET_SIZE_IN_SECS // 60}")
+    if args.workers <= 0 or args.chunk_size_mb <= 0:
+        parser.error("--workers and --chunk-size-mb must be positive")
+
+    config = ReplayConfig(
+        max_event_age_in_secs=args.max_event_age_mins * 60,
+        min_number_of_events=args.min_num_events,
+        min_spread=args.min_spread,
+        step_in_secs=args.step_mins * 60,
+    )
+    chunks = get_chunks(
+        paths=args.paths,
+        chunk_size=args.chunk_size_mb * 1024 * 1024,
+        export_format=args.format,
+    )
+    periods = replay(chunks=chunks, config=config, workers=args.workers)
+
+    for period in periods:
+        sys.stdout.write(json.dumps(period) + "\n")
+
+    logger.info(
+        "Found %s flapping periods in %s groups",
+        len(periods),
+        len({period["key"] for period in periods}),
+    )
+
+
+if __name__ == "__main__":
+    main()
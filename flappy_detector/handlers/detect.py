@@ -1,22 +1,55 @@
 """Lambda for detecting whether or not resources are flapping"""
+from __future__ import annotations
+
 import json
 import logging
 import os
+from dataclasses import asdict
 from datetime import timedelta, datetime
 from decimal import Decimal
-from typing import Dict, Any, List
+from itertools import chain
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple, TYPE_CHECKING
 
 import boto3
-import botostubs
-from amplify_aws_utils.resource_helper import get_boto3_paged_results
-from boto3.dynamodb.conditions import Attr
-from datadog import initialize, api
+from boto3.dynamodb.conditions import Attr, Key
+from datadog import api
 
 from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.alert_state import AlertStateStore
+from flappy_detector.utils.alerting import AlertSender, AlertSendResult, initialize_datadog
+from flappy_detector.utils.dynamodb import build_projection, drop_redelivered, iterate_pages, parallel_scan
 from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.env import strtobool
+from flappy_detector.utils.metrics import MetricSender
+from flappy_detector.utils.rules import Rule, RuleIndex
+from flappy_detector.utils.snapshot import DetectionSnapshot, SnapshotStore, get_rollup_known
+from flappy_detector.utils.time_bucket import (
+    ROLLUP_BUCKET_SIZE_IN_SECS,
+    TIME_BUCKET_ATTRIBUTE,
+    get_time_bucket,
+    get_time_buckets,
+)
+from flappy_detector.utils.tracing import patch_libraries
+from flappy_detector.utils.transitions import GroupTransitions, group_transitions
+
+if TYPE_CHECKING:
+    import botostubs
 
 logger = logging.getLogger(__name__)
 
+patch_libraries(("botocore", "requests"))
+
+# Attributes of a rollup read by the detector, leaving out the ids of the events counted
+ROLLUP_ATTRIBUTES = FlappyEvent.KEY_ATTRIBUTES + (
+    "key", "team", "count", "spread", "known", TIME_BUCKET_ATTRIBUTE,
+)
+
+# Ways of summing the records by group, numpy needs NumPy installed
+ENGINES = ("python", "numpy")
+# Ways of telling a group is flapping, transitions needs the individual records so can't use rollups or
+# snapshots
+DETECTIONS = ("spread", "transitions")
+
 
 def handler(event, _):
     """
@@ -24,38 +57,118 @@ def handler(event, _):
     """
     logger.info("Event: %s", json.dumps(event))
 
-    ssm_client: botostubs.SSM = boto3.client("ssm")
-    initialize(
-        api_key=ssm_client.get_parameter(
-            Name="/account/app_auth/datadog/api_key",
-            WithDecryption=True,
-        )["Parameter"]["Value"],
-        app_key=ssm_client.get_parameter(
-            Name="/account/app_auth/datadog/flappy_detector_app_key",
-            WithDecryption=True,
-        )["Parameter"]["Value"],
-    )
+    initialize_datadog()
+    rollup_table_name = os.environ.get("FLAPPY_DETECTOR_ROLLUP_TABLE")
+    snapshot_table_name = os.environ.get("FLAPPY_DETECTOR_SNAPSHOT_TABLE")
     flappy_detector = FlappyDetector(
         datadog_client=api,
+        alert_sender=_get_alert_sender(),
+        metric_sender=_get_metric_sender(),
+        rule_index=_get_rule_index(),
         dynamodb_table=boto3.resource('dynamodb').Table(os.environ["FLAPPY_DETECTOR_EC2_TABLE"]),
         max_event_age=timedelta(minutes=int(os.environ["FLAPPY_DETECTOR_MAX_EVENT_AGE_IN_MINS"])),
         min_number_of_events=int(os.environ["FLAPPY_DETECTOR_MIN_NUM_EVENTS"]),
         min_spread=int(os.environ["FLAPPY_DETECTOR_MIN_SPREAD"]),
+        time_index_name=os.environ.get("FLAPPY_DETECTOR_EC2_TABLE_TIME_INDEX") or None,
+        include_legacy_events=strtobool(
+            os.environ.get("FLAPPY_DETECTOR_INCLUDE_LEGACY_EVENTS", "False")
+        ),
+        scan_segments=int(os.environ.get("FLAPPY_DETECTOR_SCAN_SEGMENTS", 1)),
+        engine=os.environ.get("FLAPPY_DETECTOR_ENGINE", "python"),
+        detection=os.environ.get("FLAPPY_DETECTOR_DETECTION", "spread"),
+        min_reversals=int(os.environ.get("FLAPPY_DETECTOR_MIN_REVERSALS", 4)),
+        max_transitions_per_group=int(os.environ.get("FLAPPY_DETECTOR_MAX_TRANSITIONS_PER_GROUP", 1000)),
+        rollup_table=boto3.resource('dynamodb').Table(rollup_table_name) if rollup_table_name else None,
+        snapshot_store=(
+            SnapshotStore(dynamodb_table=boto3.resource('dynamodb').Table(snapshot_table_name))
+            if snapshot_table_name else None
+        ),
+        late_record_window=timedelta(
+            minutes=int(os.environ.get("FLAPPY_DETECTOR_LATE_RECORD_WINDOW_IN_MINS", 30)),
+        ),
+    )
+
+    flappy_detector.detect_flaps(
+        # Set on a manual invocation to rebuild the snapshot from the whole window
+        force_full_recompute=bool(event.get("force_full_recompute")) or strtobool(
+            os.environ.get("FLAPPY_DETECTOR_FORCE_FULL_RECOMPUTE", "False")
+        ),
+    )
+
+
+def _get_alert_sender() -> AlertSender:
+    """Sender of the Datadog events, suppressing repeat alerts when an alert state table is configured"""
+    alert_state_table_name = os.environ.get("FLAPPY_DETECTOR_ALERT_STATE_TABLE")
+    alert_state_store = None
+    if alert_state_table_name:
+        alert_state_store = AlertStateStore(
+            dynamodb_table=boto3.resource('dynamodb').Table(alert_state_table_name),
+            cooldown=timedelta(minutes=int(os.environ.get("FLAPPY_DETECTOR_ALERT_COOLDOWN_IN_MINS", 120))),
+            escalation_factor=float(os.environ.get("FLAPPY_DETECTOR_ALERT_ESCALATION_FACTOR", 2)),
+        )
+
+    return AlertSender(
+        datadog_client=api,
+        max_workers=int(os.environ.get("FLAPPY_DETECTOR_ALERT_WORKERS", 8)),
+        rate_per_sec=float(os.environ.get("FLAPPY_DETECTOR_ALERT_RATE_PER_SEC", 10)),
+        alert_state_store=alert_state_store,
     )
 
-    flappy_detector.detect_flaps()
 
+def _get_metric_sender() -> Optional[MetricSender]:
+    """Sender of the per group Datadog metrics, None when they are turned off"""
+    max_groups = int(os.environ.get("FLAPPY_DETECTOR_METRICS_MAX_GROUPS", 1000))
+    if not max_groups:
+        return None
+
+    return MetricSender(
+        datadog_client=api,
+        batch_size=int(os.environ.get("FLAPPY_DETECTOR_METRICS_BATCH_SIZE", 500)),
+        max_groups=max_groups,
+    )
 
-class FlappyDetector:
+
+def _get_rule_index() -> Optional[RuleIndex]:
+    """Rules of every group when rule sets are configured, with the global thresholds as their defaults"""
+    rules = os.environ.get("FLAPPY_DETECTOR_RULES")
+    if not rules:
+        return None
+
+    return RuleIndex.loads(
+        rules,
+        default=[
+            Rule(
+                window=timedelta(minutes=int(os.environ["FLAPPY_DETECTOR_MAX_EVENT_AGE_IN_MINS"])),
+                min_number_of_events=int(os.environ["FLAPPY_DETECTOR_MIN_NUM_EVENTS"]),
+                min_spread=int(os.environ["FLAPPY_DETECTOR_MIN_SPREAD"]),
+            ),
+        ],
+    )
+
+
+class FlappyDetector:  # pylint: disable=too-many-instance-attributes
     """Class for detecting flappy resources"""
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
             self,
             datadog_client,
             dynamodb_table: botostubs.DynamoDB.DynamodbResource.Table,
             max_event_age: timedelta,
             min_number_of_events: int,
             min_spread: int,
+            time_index_name: Optional[str] = None,
+            include_legacy_events: bool = False,
+            scan_segments: int = 1,
+            rollup_table: Optional[botostubs.DynamoDB.DynamodbResource.Table] = None,
+            snapshot_store: Optional[SnapshotStore] = None,
+            late_record_window: timedelta = timedelta(minutes=30),
+            alert_sender: Optional[AlertSender] = None,
+            metric_sender: Optional[MetricSender] = None,
+            engine: str = "python",
+            detection: str = "spread",
+            min_reversals: int = 4,
+            max_transitions_per_group: int = 1000,
+            rule_index: Optional[RuleIndex] = None,
     ):
         """
         :param datadog_client: Datadog API Client.
@@ -63,54 +176,376 @@ class FlappyDetector:
         :param max_event_age: Timedelta representing how old an event can be to be evaluated.
         :param min_number_of_events: The minimum number of events to consider for flapping.
         :param min_spread: The amount of deviation in the host count below which we consider flapping.
+        :param time_index_name: Name of the index keyed by time_bucket and timestamp, or None to scan.
+        :param include_legacy_events: Whether to also scan for records written before the time index existed.
+            Only needed for the first max_event_age after ingest starts writing time_bucket, as older records
+            have aged out of every window.
+        :param scan_segments: Number of segments to scan the table in parallel with, 1 scans serially.
+        :param rollup_table: Table resource for the per group counters written by ingest. When given, only
+            the counters are read, never the individual records.
+        :param snapshot_store: Store of the per group state left by the previous run. When given, only
+            records newer than the state's watermark are read.
+        :param late_record_window: How long after their event time records may still be ingested, e.g. after
+            SQS retries. The snapshot only stores records older than this, newer ones are read on every run.
+        :param alert_sender: Sender of the Datadog events, defaults to one using datadog_client.
+        :param metric_sender: Sender of every group's Datadog metrics, None to only send events.
+        :param engine: How the records read are summed by group, one of ENGINES. numpy sums them with
+            vectorized group-bys, which is faster on large windows.
+        :param detection: How flapping groups are told apart, one of DETECTIONS. spread flags groups whose
+            host count changed often but ended near where it started. transitions orders each group's
+            changes by timestamp and flags those whose host count changed direction often, so a scale up
+            followed by a scale down isn't mistaken for cycling.
+        :param min_reversals: The minimum number of changes in direction to consider for flapping, with the
+            transitions detection.
+        :param max_transitions_per_group: The most recent changes of each group held for the transitions
+            detection, bounding its memory.
+        :param rule_index: Rules of every group, evaluated over each of their windows instead of the global
+            thresholds. Records are read over the longest window once, into per group time buckets.
         """
         self.datadog_client = datadog_client
         self.dynamodb_table = dynamodb_table
         self.max_event_age = max_event_age
         self.min_number_of_events = min_number_of_events
         self.min_spread = min_spread
+        self.time_index_name = time_index_name
+        self.include_legacy_events = include_legacy_events
+        self.scan_segments = scan_segments
+        self.rollup_table = rollup_table
+        self.snapshot_store = snapshot_store
+        self.late_record_window = late_record_window
+        self.alert_sender = alert_sender or AlertSender(datadog_client=datadog_client)
+        self.metric_sender = metric_sender
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine={engine}, expected one of {ENGINES}")
+        self.engine = engine
+        if detection not in DETECTIONS:
+            raise ValueError(f"Unknown detection={detection}, expected one of {DETECTIONS}")
+        if detection == "transitions" and (rollup_table or snapshot_store):
+            raise ValueError("Detection=transitions reads the individual records, not rollups or a snapshot")
+        self.detection = detection
+        self.min_reversals = min_reversals
+        self.max_transitions_per_group = max_transitions_per_group
+        if rule_index and detection == "transitions":
+            raise ValueError("Detection=transitions can't be evaluated against rules")
+        self.rule_index = rule_index
+        if rule_index:
+            self.max_event_age = max(max_event_age, rule_index.max_window)
 
-    def detect_flaps(self):
+    def detect_flaps(self, force_full_recompute: bool = False):
         """
         Manages looking for flapping events.
+        :param force_full_recompute: Whether to ignore the stored snapshot and read the whole window.
         """
-        events = self._get_events()
-        flapping_events = self._find_flapping_events(events=events)
+        if self.detection == "transitions":
+            groups = group_transitions(events=self._get_events(), max_events=self.max_transitions_per_group)
+            flappy_events = [group.flappy_event for group in groups]
+            flapping_events = self._find_cycling(groups=groups)
+        elif self.rule_index:
+            snapshot = self._get_snapshot(force_full_recompute=force_full_recompute)
+            flappy_events = snapshot.get_flappy_events()
+            flapping_events = self.rule_index.find_flapping(
+                groups=snapshot.groups.values(),
+                now=datetime.now(),
+            )
+        else:
+            flappy_events = self._get_flappy_events(force_full_recompute=force_full_recompute)
+            flapping_events = self._find_flapping(flappy_events=flappy_events)
+
         self._send_alerts(flapping_events=flapping_events)
+        if self.metric_sender:
+            self.metric_sender.send(flappy_events=flappy_events)
+
+    def _get_flappy_events(self, force_full_recompute: bool = False) -> List[FlappyEvent]:
+        """
+        Sum the records of the window by group, from the snapshot, the rollups or the records themselves.
+        :param force_full_recompute: Whether to ignore the stored snapshot and read the whole window.
+        :return: List of FlappyEvents, one per group.
+        """
+        if self.snapshot_store:
+            flappy_events = self._update_snapshot(
+                snapshot_store=self.snapshot_store,
+                force_full_recompute=force_full_recompute,
+            ).get_flappy_events()
+        elif self.rollup_table:
+            flappy_events = self._group_rollups(
+                rollups=self._get_rollups(rollup_table=self.rollup_table),
+            )
+        else:
+            events = self._get_events()
+            flappy_events = self._group_events(events=events)
 
-    def _get_events(self) -> List[Dict[str, Any]]:
+        return flappy_events
+
+    def _get_snapshot(self, force_full_recompute: bool = False) -> DetectionSnapshot:
         """
-        Get all relevant DynamoDB records.
-        :return: List of all DynamoDB records, no older than the max_event_age.
+        Bucket the records of the window by group, from the snapshot, the rollups or the records themselves.
+        :param force_full_recompute: Whether to ignore the stored snapshot and read the whole window.
+        :return: The DetectionSnapshot of the window.
         """
-        cut_off = Decimal((datetime.now() - self.max_event_age).timestamp())
-        return get_boto3_paged_results(
-            self.dynamodb_table.scan,
-            results_key="Items",
-            next_token_key="LastEvaluatedKey",
-            next_request_token_key="ExclusiveStartKey",
-            FilterExpression=(Attr("timestamp").gte(cut_off)),
-            ConsistentRead=True,
+        if self.snapshot_store:
+            return self._update_snapshot(
+                snapshot_store=self.snapshot_store,
+                force_full_recompute=force_full_recompute,
+            )
+
+        snapshot = DetectionSnapshot(watermark=0)
+        if self.rollup_table:
+            for rollup in self._get_rollups(rollup_table=self.rollup_table):
+                snapshot.add_rollup(rollup)
+        else:
+            for event in self._get_events():
+                snapshot.add_event(event)
+
+        return snapshot
+
+    def _update_snapshot(
+            self,
+            snapshot_store: SnapshotStore,
+            force_full_recompute: bool = False,
+    ) -> DetectionSnapshot:
+        """
+        Fold the records since the stored snapshot's watermark into it, expiring buckets outside the window.
+        The whole window is read instead when there is no usable snapshot.
+
+        Only records older than late_record_window are stored, as records newer than that may still be
+        joined by ones ingested late. Those are read on every run and folded in after the snapshot is stored,
+        so none is counted twice or missed.
+        :param snapshot_store: Store of the per group state left by the previous run.
+        :param force_full_recompute: Whether to ignore the stored snapshot.
+        :return: The DetectionSnapshot of the whole window, up to now.
+        """
+        now = datetime.now()
+        cut_off_bucket = get_time_bucket(
+            (now - self.max_event_age).timestamp(),
+            bucket_size=ROLLUP_BUCKET_SIZE_IN_SECS,
         )
+        watermark = max(int((now - self.late_record_window).timestamp()), cut_off_bucket)
+
+        snapshot = None if force_full_recompute else snapshot_store.load()
+        if snapshot is None or snapshot.watermark < cut_off_bucket:
+            logger.info("Recomputing snapshot from the whole window")
+            snapshot = DetectionSnapshot(watermark=cut_off_bucket)
+
+        snapshot.expire(cut_off_bucket=cut_off_bucket)
+        if snapshot.watermark < watermark:
+            for event in self._get_events(after=Decimal(snapshot.watermark), until=Decimal(watermark)):
+                snapshot.add_event(event)
+            snapshot.watermark = watermark
+            snapshot_store.save(snapshot=snapshot)
 
-    def _find_flapping_events(self, events: List[Dict[str, Any]]) -> List[FlappyEvent]:
+        for event in self._get_events(after=Decimal(snapshot.watermark)):
+            snapshot.add_event(event)
+
+        return snapshot
+
+    def _find_flapping(self, flappy_events: Iterable[FlappyEvent]) -> List[FlappyEvent]:
         """
-        Iterate through the given events and calculate which ones are flapping.
-        :param events: List of DynamoDB records.
+        Calculate which groups are flapping.
+        :param flappy_events: The FlappyEvents of every group.
         :return: List of FlappyEvents
         """
+        return [
+            flappy_event
+            for flappy_event in flappy_events
+            if flappy_event.is_flapping(
+                min_number_of_events=self.min_number_of_events,
+                min_spread=self.min_spread,
+            )
+        ]
+
+    def _find_cycling(self, groups: Iterable[GroupTransitions]) -> List[FlappyEvent]:
+        """
+        Calculate which groups are flapping from the order of their changes.
+        Only groups with enough events have their changes sorted.
+        :param groups: The GroupTransitions of every group.
+        :return: List of FlappyEvents
+        """
+        flapping_events = []
+        for group in groups:
+            if group.flappy_event.count < self.min_number_of_events:
+                continue
+
+            stats = group.get_stats()
+            if stats.reversals >= self.min_reversals:
+                logger.info(
+                    "Group key=%s reversed %s times",
+                    group.flappy_event.key,
+                    stats.reversals,
+                    extra={"transitions": asdict(stats)},
+                )
+                flapping_events.append(group.flappy_event)
+
+        return flapping_events
+
+    def _get_events(
+            self,
+            after: Optional[Decimal] = None,
+            until: Optional[Decimal] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Get all relevant DynamoDB records, page by page as they are read.
+        With the time index, records of redelivered events are only returned once, so every fold counts each
+        event once. A redelivery shares its event's timestamp, so it is read in the same range as the original
+        and right next to it. A scan reads records in no particular order, so they are returned as they are.
+        :param after: Epoch timestamp of the oldest record to return, defaults to max_event_age ago.
+        :param until: Epoch timestamp before which to return records, None for no bound.
+        :return: Iterator of all DynamoDB records in the range.
+        """
+        now = datetime.now()
+        cut_off = after if after is not None else Decimal((now - self.max_event_age).timestamp())
+        time_filter = Attr("timestamp").gte(cut_off)
+        if until is not None:
+            time_filter = time_filter & Attr("timestamp").lt(until)
+
+        if not self.time_index_name:
+            return self._scan_events(filter_expression=time_filter)
+
+        events = self._query_events(
+            cut_off=cut_off,
+            until=until if until is not None else Decimal(now.timestamp()),
+            filter_expression=Attr("timestamp").lt(until) if until is not None else None,
+        )
+        events = drop_redelivered(events)
+        if self.include_legacy_events:
+            legacy_filter = time_filter & Attr(TIME_BUCKET_ATTRIBUTE).not_exists()
+            events = chain(events, self._scan_events(filter_expression=legacy_filter))
+
+        return events
+
+    def _scan_events(self, filter_expression) -> Iterator[Dict[str, Any]]:
+        """
+        Scan the whole table for records.
+        :param filter_expression: Condition applied to each record after it is read.
+        :return: Iterator of matching DynamoDB records.
+        """
+        if self.scan_segments > 1:
+            return parallel_scan(
+                self._get_segment_scan,
+                total_segments=self.scan_segments,
+                FilterExpression=filter_expression,
+                ConsistentRead=True,
+                **build_projection(FlappyEvent.RECORD_ATTRIBUTES),
+            )
+
+        return chain.from_iterable(
+            iterate_pages(
+                self.dynamodb_table.scan,
+                FilterExpression=filter_expression,
+                ConsistentRead=True,
+                **build_projection(FlappyEvent.RECORD_ATTRIBUTES),
+            )
+        )
+
+    def _get_segment_scan(self) -> Callable[..., Dict[str, Any]]:
+        """
+        Get a scan of the EC2 table for one segment of a parallel scan, from a session of its own.
+        :return: The scan function.
+        """
+        # botostubs' Table doesn't describe the resource's name
+        table_name: str = self.dynamodb_table.name  # type: ignore
+        return boto3.session.Session().resource("dynamodb").Table(table_name).scan
+
+    def _query_events(
+            self,
+            cut_off: Decimal,
+            until: Decimal,
+            filter_expression=None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Query the time index for records, reading only the buckets overlapping the evaluated window.
+        :param cut_off: Epoch timestamp of the oldest record to return.
+        :param until: Epoch timestamp of the end of the evaluated window.
+        :param filter_expression: Optional condition applied to each record after it is read.
+        :return: Iterator of DynamoDB records no older than the cut off.
+        """
+        kwargs = {"FilterExpression": filter_expression} if filter_expression is not None else {}
+        for time_bucket in get_time_buckets(start=cut_off, end=until):
+            for page in iterate_pages(
+                    self.dynamodb_table.query,
+                    IndexName=self.time_index_name,
+                    KeyConditionExpression=(
+                        Key(TIME_BUCKET_ATTRIBUTE).eq(time_bucket) & Key("timestamp").gte(cut_off)
+                    ),
+                    **kwargs,
+                    **build_projection(FlappyEvent.RECORD_ATTRIBUTES),
+            ):
+                yield from page
+
+    def _get_rollups(
+            self,
+            rollup_table: botostubs.DynamoDB.DynamodbResource.Table,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Get the per group counters of every time bucket overlapping the evaluated window.
+        The window is widened to the start of the bucket the cut off falls in.
+        :param rollup_table: Table resource for the per group counters written by ingest.
+        :return: Iterator of counters, one per group and time bucket.
+        """
+        now = datetime.now()
+        for time_bucket in get_time_buckets(
+                start=(now - self.max_event_age).timestamp(),
+                end=now.timestamp(),
+                bucket_size=ROLLUP_BUCKET_SIZE_IN_SECS,
+        ):
+            for page in iterate_pages(
+                    rollup_table.query,
+                    KeyConditionExpression=Key(TIME_BUCKET_ATTRIBUTE).eq(time_bucket),
+                    **build_projection(ROLLUP_ATTRIBUTES),
+            ):
+                yield from page
+
+    def _group_rollups(self, rollups: Iterable[Dict[str, Any]]) -> List[FlappyEvent]:
+        """
+        Sum the given per group counters.
+        As in the loop, groups without any record with a known state are left out.
+        :param rollups: Iterable of counters, one per group and time bucket.
+        :return: List of FlappyEvents, one per group.
+        """
         flappy_events: Dict[str, FlappyEvent] = {}
+        known: Dict[str, int] = {}
 
-        for event in events:
-            try:
+        for rollup in rollups:
+            flappy_event = flappy_events.get(rollup["key"])
+            if not flappy_event:
                 flappy_event = FlappyEvent(
-                    account=event["account"],
-                    region=event["region"],
-                    environment=event["environment"],
-                    application=event["application"],
-                    group_name=event["group_name"],
+                    **{attribute: rollup[attribute] for attribute in FlappyEvent.KEY_ATTRIBUTES}
                 )
-                flappy_event = flappy_events.get(flappy_event.key, flappy_event)
+                flappy_events[flappy_event.key] = flappy_event
+
+            if not flappy_event.team:
+                flappy_event.team = rollup.get("team")
+
+            flappy_event.count += int(rollup["count"])
+            flappy_event.spread += int(rollup["spread"])
+            known[flappy_event.key] = known.get(flappy_event.key, 0) + get_rollup_known(rollup)
+
+        return [flappy_event for key, flappy_event in flappy_events.items() if known[key]]
+
+    def _group_events(self, events: Iterable[Dict[str, Any]]) -> List[FlappyEvent]:
+        """
+        Iterate through the given events and sum them by group.
+        Events are folded into their group one at a time, so only one FlappyEvent per group is held in memory.
+        Groups are looked up by their key attributes, so only a group's first record builds a FlappyEvent.
+        :param events: Iterable of DynamoDB records.
+        :return: List of FlappyEvents, one per group.
+        """
+        if self.engine == "numpy":
+            # Imported here so NumPy is only needed when its engine is chosen
+            from flappy_detector.utils import columnar  # pylint: disable=import-outside-toplevel
+            return columnar.group_events(events=events)
+
+        flappy_events: Dict[Tuple[str, ...], FlappyEvent] = {}
+
+        for event in events:
+            key_attributes = (
+                event["account"],
+                event["region"],
+                event["environment"],
+                event["application"],
+                event["group_name"],
+            )
+            try:
+                flappy_event = flappy_events.get(key_attributes) or FlappyEvent(*key_attributes)
             except TypeError:
                 logger.error(
                     "Could not handle event",
@@ -137,38 +572,30 @@ class FlappyDetector:
                 )
                 continue
 
-            flappy_events[flappy_event.key] = flappy_event
+            flappy_events[key_attributes] = flappy_event
 
-        return [
-            flappy_event
-            for flappy_event in flappy_events.values()
-            if flappy_event.count >= self.min_number_of_events and
-            abs(flappy_event.spread) <= self.min_spread
-        ]
+        return list(flappy_events.values())
 
-    def _send_alerts(self, flapping_events: List[FlappyEvent]):
+    def _send_alerts(self, flapping_events: List[FlappyEvent]) -> AlertSendResult:
         """
         Send Datadog Events
         :param flapping_events: List of the FlappyEvents to turn into Datadog events.
+        :return: How many events were sent and retried, and the events that could not be sent.
         """
         logger.info(
             "Sending flappy events",
             extra={"flapping_apps": flapping_events},
         )
 
-        for event in flapping_events:
-            self.datadog_client.Event.create(
-                title=f"Flappy Detector: {event.application} might be flapping in {event.environment}",
-                text="%%% \nThis application might be flapping.\n"
-                     f"There have been {event.count} starts/stops, "
-                     f"but the total number of instances has only changed by {event.spread}.\n"
-                     "Please investigate:\n"
-                     "  * Scaling might be configured too aggressively\n"
-                     "  * New instances are failing to start\n"
-                     "  * Spotinst might be shifting instances between on-demand and spot\n"
-                     "  * Host is undersized and failing under load\n %%%",
-                alert_type="warning",
-                aggregation_key=event.key,
-                tags=event.tags,
-                attach_host_name=False,
-            )
+        result = self.alert_sender.send(flappy_events=flapping_events)
+        logger.info(
+            "Sent %s flappy events and %s recoveries, suppressed %s, %s failed after %s retries",
+            result.sent,
+            result.recovered,
+            result.suppressed,
+            len(result.failed),
+            result.retried,
+            extra={"failed_apps": result.failed},
+        )
+
+        return result
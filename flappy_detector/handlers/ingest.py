@@ -1,38 +1,237 @@
 """Lambda for ingesting EC2 State Change CloudWatch Events"""
+from __future__ import annotations
+
 import json
 import logging
 import os
+import random
+import time
 from collections import defaultdict
-from decimal import Decimal
-from typing import Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from typing import Dict, Any, List, NamedTuple, Optional, Set, Tuple, TYPE_CHECKING
 
 import boto3
-import botostubs
-from amplify_aws_utils.resource_helper import boto3_tags_to_dict, throttled_call
-from amplify_aws_utils.clients.sts import STS
-from dateutil.parser import parse
+from amplify_aws_utils.resource_helper import boto3_tags_to_dict, get_boto3_paged_results, throttled_call
+from botocore.exceptions import ClientError
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.client_cache import AssumedRoleClientCache
+from flappy_detector.utils.dynamodb import BatchWriteResult, UnprocessedItemsError, batch_write
+from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.event_time import parse_event_time
+from flappy_detector.utils.metadata_cache import InstanceMetadataCache
+from flappy_detector.utils.time_bucket import (
+    ROLLUP_BUCKET_SIZE_IN_SECS,
+    TIME_BUCKET_ATTRIBUTE,
+    get_time_bucket,
+)
+from flappy_detector.utils.tracing import patch_libraries
+
+if TYPE_CHECKING:
+    import botostubs
 
 logger = logging.getLogger(__name__)
 
+patch_libraries(("botocore",))
+
+# The most instance ids to describe in a single request
+DESCRIBE_INSTANCES_CHUNK_SIZE = 100
+# Errors EC2 returns for the whole request when any one of the instance ids is bad
+INVALID_INSTANCE_ID_ERROR_CODES = {"InvalidInstanceID.NotFound", "InvalidInstanceID.Malformed"}
+# The most event ids claimed along with a single rollup update, well within the 100 items of a transaction
+ROLLUP_EVENT_IDS_PER_UPDATE = 50
+# How many times to try a rollup update that conflicts with another transaction on the same counters
+ROLLUP_MAX_ATTEMPTS = 5
+# Seconds to wait before retrying a conflicting rollup update, doubled on each further retry up to the max
+ROLLUP_RETRY_BASE_DELAY_IN_SECS = 0.05
+ROLLUP_RETRY_MAX_DELAY_IN_SECS = 2.0
+# The event id of a record, None if it has none, and its change in host count, None if its state isn't known
+RollupChange = Tuple[Optional[str], Optional[int]]
+
+
+class MetadataLookupFailure(NamedTuple):
+    """The events of an account and region whose metadata could not be looked up"""
+
+    account: str
+    region: str
+    events: List[Dict[str, Any]]
+    error: Exception
+
+
+class MetadataLookupError(Exception):
+    """Raised when the metadata for some events could not be looked up"""
+
+    def __init__(self, failures: List[MetadataLookupFailure]):
+        super().__init__(
+            "Could not look up metadata for " +
+            ", ".join(f"account:{failure.account} region:{failure.region}" for failure in failures)
+        )
+        self.failures = failures
+
+
+@lru_cache(maxsize=None)
+def _get_client_cache() -> AssumedRoleClientCache:
+    """Clients for other accounts, kept for the life of the Lambda container"""
+    return AssumedRoleClientCache(sts_client=boto3.client("sts"))
+
+
+@lru_cache(maxsize=None)
+def _get_metadata_cache() -> InstanceMetadataCache:
+    """Instance tags, kept for the life of the Lambda container and optionally shared through DynamoDB"""
+    table_name = os.environ.get("FLAPPY_DETECTOR_METADATA_CACHE_TABLE")
+    return InstanceMetadataCache(
+        ttl=timedelta(minutes=int(os.environ.get("FLAPPY_DETECTOR_METADATA_CACHE_TTL_IN_MINS", 360))),
+        dynamodb_table=_get_dynamodb_table(table_name) if table_name else None,
+    )
+
+
+@lru_cache(maxsize=None)
+def _get_dynamodb_table(table_name: str) -> botostubs.DynamoDB.DynamodbResource.Table:
+    """Table resource, kept for the life of the Lambda container"""
+    return boto3.resource('dynamodb').Table(table_name)
+
 
 def handler(event, _):
     """
     Lambda Handler
-    :param event: CloudWatch Event for EC2 State Change
+    :param event: SNS notifications, or a batch of SQS messages, of CloudWatch Events for EC2 State Change
+    :return: For SQS batches, the messages that failed so only they are retried.
     """
     logger.info("Event: %s", json.dumps(event))
 
+    client_cache = _get_client_cache()
+    client_cache.reset_stats()
+    rollup_table_name = os.environ.get("FLAPPY_DETECTOR_ROLLUP_TABLE")
     ingestor = Ingestor(
-        sts_client=STS(sts_client=boto3.client("sts")),
-        dynamodb_table=boto3.resource('dynamodb').Table(os.environ["FLAPPY_DETECTOR_EC2_TABLE"]),
+        sts_client=client_cache,
+        dynamodb_table=_get_dynamodb_table(os.environ["FLAPPY_DETECTOR_EC2_TABLE"]),
+        max_workers=int(os.environ.get("FLAPPY_DETECTOR_METADATA_WORKERS", 8)),
+        metadata_cache=_get_metadata_cache(),
+        rollup_table=_get_dynamodb_table(rollup_table_name) if rollup_table_name else None,
     )
 
-    ingestor.ingest_events(
-        events=[
-            json.loads(record["Sns"]["Message"])
-            for record in event["Records"]
-        ]
-    )
+    try:
+        if event["Records"] and event["Records"][0].get("eventSource") == "aws:sqs":
+            return _ingest_messages(ingestor=ingestor, records=event["Records"])
+
+        ingestor.ingest_events(
+            events=[
+                json.loads(record["Sns"]["Message"])
+                for record in event["Records"]
+            ]
+        )
+        return None
+    finally:
+        logger.info(
+            "Client cache hits:%s misses:%s",
+            client_cache.hits,
+            client_cache.misses,
+            extra={
+                "client_cache_hits": client_cache.hits,
+                "client_cache_misses": client_cache.misses,
+            },
+        )
+
+
+def _ingest_messages(ingestor: "Ingestor", records: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Ingest a batch of SQS messages, each holding a CloudWatch Event either raw or in an SNS notification.
+    Records are traced back to their message through their event_id, so only the messages whose events
+    failed to be stored are reported.
+    :param ingestor: The Ingestor to ingest the events with.
+    :param records: SQS messages.
+    :return: The batchItemFailures response, listing the messages to retry.
+    """
+    failed_message_ids = []
+    message_ids: Dict[str, str] = {}
+    events = []
+    for record in records:
+        try:
+            event = _parse_message(record)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            logger.exception(
+                "Could not parse message_id:%s",
+                record["messageId"],
+                extra={"record": record},
+            )
+            failed_message_ids.append(record["messageId"])
+            continue
+
+        message_ids[event["id"]] = record["messageId"]
+        events.append(event)
+
+    failed_events: List[Dict[str, Any]] = []
+    try:
+        ingestor.ingest_events(events=events)
+    except UnprocessedItemsError as exc:
+        failed_events += exc.result.unprocessed
+    except MetadataLookupError:
+        pass
+    failed_events += [event for failure in ingestor.metadata_failures for event in failure.events]
+
+    if ingestor.rollup_error:
+        # Every message is retried, so the rollups of the records that were written aren't missed
+        failed_message_ids += list(dict.fromkeys(message_ids.values()))
+    else:
+        failed_message_ids += list({message_ids[event["event_id"]]: None for event in failed_events})
+    if failed_message_ids:
+        logger.warning(
+            "Failed %s of %s messages",
+            len(failed_message_ids),
+            len(records),
+            extra={"failed_message_ids": failed_message_ids},
+        )
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id}
+            for message_id in failed_message_ids
+        ],
+    }
+
+
+def _parse_message(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Parse the CloudWatch Event in an SQS message, checking it holds every field ingesting it reads.
+    Bad messages are caught here, rather than failing the whole batch once it is being ingested.
+    :param record: SQS message.
+    :return: The CloudWatch Event.
+    :raises KeyError: If the event is missing a field.
+    :raises TypeError: If a field is not a string.
+    :raises ValueError: If the message is not JSON, or the event's time can't be parsed.
+    """
+    message = json.loads(record["body"])
+    event = json.loads(message["Message"]) if message.get("Type") == "Notification" else message
+    fields = {
+        "id": event["id"],
+        "account": event["account"],
+        "region": event["region"],
+        "time": event["time"],
+        "detail.instance-id": event["detail"]["instance-id"],
+        "detail.state": event["detail"]["state"],
+    }
+    for name, value in fields.items():
+        if not isinstance(value, str):
+            raise TypeError(f"{name} is not a string")
+
+    parse_event_time(event["time"])
+    return event
+
+
+def _get_marker_key(rollup_key: Dict[str, Any], event_id: str) -> Dict[str, Any]:
+    """
+    Get the key of the marker claiming an event id for a group's counters in a time bucket.
+    Markers are kept under the negated time bucket, a partition the detector never queries.
+    :param rollup_key: Key of the group's counters in the time bucket.
+    :param event_id: The event's id.
+    :return: The marker's key.
+    """
+    return {
+        TIME_BUCKET_ATTRIBUTE: -rollup_key[TIME_BUCKET_ATTRIBUTE],
+        "key": f"{rollup_key['key']}#{event_id}",
+    }
 
 
 class Ingestor:
@@ -40,15 +239,30 @@ class Ingestor:
 
     def __init__(
             self,
-            sts_client: STS,
+            sts_client: AssumedRoleClientCache,
             dynamodb_table: botostubs.DynamoDB.DynamodbResource.Table,
+            max_workers: int = 8,
+            metadata_cache: Optional[InstanceMetadataCache] = None,
+            rollup_table: Optional[botostubs.DynamoDB.DynamodbResource.Table] = None,
+            rollup_ttl: timedelta = timedelta(days=1),
     ):
         """
-        :param sts_client: STS Client for assuming roles.
+        :param sts_client: Builds clients for other accounts by assuming roles.
         :param dynamodb_table: Table resource for our data store.
+        :param max_workers: The most account and region metadata lookups to run at once.
+        :param metadata_cache: Cache of instance tags. Defaults to an in-process cache for this Ingestor.
+        :param rollup_table: Table resource for per group counters keyed by time_bucket and key, None to skip.
+        :param rollup_ttl: How long to keep each group's counters for.
         """
         self.sts_client = sts_client
         self.dynamodb_table = dynamodb_table
+        self.max_workers = max_workers
+        self.metadata_cache = metadata_cache or InstanceMetadataCache()
+        self.rollup_table = rollup_table
+        self.rollup_ttl = rollup_ttl
+        self.metadata_failures: List[MetadataLookupFailure] = []
+        # Set when the rollups couldn't be updated after some records couldn't be written either
+        self.rollup_error: Optional[Exception] = None
 
     def ingest_events(
             self,
@@ -58,10 +272,29 @@ class Ingestor:
         Ingests CloudWatch Events for EC2 state changes
         :param events: List of CloudWatch events.
         """
+        self.rollup_error = None
         grouped_events = self._group_events(events=events)
         events_with_metadata = self._find_metadata(grouped_events=grouped_events)
 
-        self._write_to_dynamodb(events=events_with_metadata)
+        try:
+            self._write_to_dynamodb(events=events_with_metadata)
+        except Exception:
+            # Rolled up even when some records couldn't be written, retried events are only counted once. A
+            # rollup error is kept in rollup_error rather than raised, so it doesn't replace the write's error
+            if self.rollup_table:
+                try:
+                    self._update_rollups(rollup_table=self.rollup_table, events=events_with_metadata)
+                except Exception as exc:
+                    logger.exception("Could not update rollups")
+                    self.rollup_error = exc
+            raise
+
+        if self.rollup_table:
+            self._update_rollups(rollup_table=self.rollup_table, events=events_with_metadata)
+
+        if self.metadata_failures:
+            # Fail the invocation so the events whose metadata couldn't be found are retried
+            raise MetadataLookupError(failures=self.metadata_failures)
 
     def _group_events(
             self,
@@ -69,17 +302,35 @@ class Ingestor:
     ) -> Dict[str, Dict[str, List[Dict[str, Any]]]]:
         """
         Groups the incoming CloudWatch events by account and region.
+        SNS delivers at least once, so events with the id of one already in the batch are dropped before any
+        metadata is looked up. Each record keeps its event's id as event_id.
         :param events: The CloudWatch events in a flat list.
         :return: The CloudWatch events grouped first by account, then by region.
         """
         grouped_events: Dict[str, Dict[str, List[Dict[str, Any]]]] = defaultdict(lambda: defaultdict(list))
+        event_ids: Set[str] = set()
+        duplicates = 0
         for event in events:
-            grouped_events[event["account"]][event["region"]].append(
-                {
-                    "instance_id": event["detail"]["instance-id"],
-                    "state": event["detail"]["state"],
-                    "timestamp": Decimal(parse(event["time"]).timestamp()),
-                }
+            record = {
+                "instance_id": event["detail"]["instance-id"],
+                "state": event["detail"]["state"],
+                "timestamp": parse_event_time(event["time"]),
+            }
+            event_id = event.get("id")
+            if event_id:
+                if event_id in event_ids:
+                    duplicates += 1
+                    continue
+                event_ids.add(event_id)
+                record["event_id"] = event_id
+
+            grouped_events[event["account"]][event["region"]].append(record)
+
+        if duplicates:
+            logger.info(
+                "Dropped %s duplicate events",
+                duplicates,
+                extra={"duplicates": duplicates},
             )
 
         return grouped_events
@@ -89,80 +340,483 @@ class Ingestor:
             grouped_events: Dict[str, Dict[str, List[Dict[str, str]]]],
     ) -> List[Dict[str, str]]:
         """
-        Look up metadata on each event.
+        Look up metadata on each event, looking up each account and region concurrently.
+        Lookups that fail are logged and recorded in metadata_failures without affecting the others.
         :param grouped_events: List of CloudWatch events grouped by account and region.
         :return: A list of records with metadata formatted for upload to DynamoDB.
         """
+        self.metadata_failures = []
+        events_with_metadata: List[Dict[str, str]] = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                (
+                    account,
+                    region,
+                    events,
+                    executor.submit(
+                        self._find_region_metadata,
+                        account=account,
+                        region=region,
+                        events=events,
+                    ),
+                )
+                for account, events_by_region in grouped_events.items()
+                for region, events in events_by_region.items()
+            ]
+
+            for account, region, events, future in futures:
+                try:
+                    events_with_metadata += future.result()
+                except Exception as exc:
+                    logger.exception(
+                        "Could not look up metadata for account:%s region:%s",
+                        account,
+                        region,
+                        extra={
+                            "account": account,
+                            "region": region,
+                            "events": events,
+                        },
+                    )
+                    self.metadata_failures.append(
+                        MetadataLookupFailure(account=account, region=region, events=events, error=exc)
+                    )
+
+        return events_with_metadata
+
+    def _find_region_metadata(
+            self,
+            account: str,
+            region: str,
+            events: List[Dict[str, str]],
+    ) -> List[Dict[str, str]]:
+        """
+        Look up metadata on each event in a single account and region.
+        :param account: The account the events happened in.
+        :param region: The region the events happened in.
+        :param events: The CloudWatch events for the account and region.
+        :return: A list of records with metadata formatted for upload to DynamoDB.
+        """
+        start = time.perf_counter()
+        instance_ids = list({event["instance_id"]: None for event in events})
+        instance_metadata = self.metadata_cache.get_many(
+            account=account,
+            region=region,
+            instance_ids=instance_ids,
+        )
+        cache_hits = len(instance_metadata)
+
+        missing_instance_ids = [
+            instance_id
+            for instance_id in instance_ids
+            if instance_id not in instance_metadata
+        ]
+        if missing_instance_ids:
+            described_metadata = self._describe_instances(
+                account=account,
+                region=region,
+                instance_ids=missing_instance_ids,
+            )
+            self.metadata_cache.put_many(account=account, region=region, metadata=described_metadata)
+            instance_metadata.update(described_metadata)
+
+        logger.info(
+            "Looked up metadata for account:%s region:%s",
+            account,
+            region,
+            extra={
+                "account": account,
+                "region": region,
+                "instances": len(instance_ids),
+                "cache_hits": cache_hits,
+                "duration": time.perf_counter() - start,
+            },
+        )
+
         events_with_metadata = []
-        for account, events_by_region in grouped_events.items():
-            for region, events in events_by_region.items():
-                ec2_client: botostubs.EC2 = self.sts_client.get_boto3_client_for_account(
-                    account_id=account,
-                    role_name=os.environ["FLAPPY_DETECTOR_ROLE"],
-                    client_name="ec2",
-                    region_name=region,
+        for event in events:
+            cur_metadata = instance_metadata.get(event["instance_id"])
+
+            if cur_metadata is None:
+                logger.warning(
+                    "Event for instance_id:%s has no metadata, ignoring",
+                    event["instance_id"],
+                    extra={
+                        "instance_id": event["instance_id"],
+                        "event": event,
+                    },
                 )
+                continue
 
-                response = throttled_call(
-                    ec2_client.describe_instances,
-                    InstanceIds=[event["instance_id"] for event in events],
+            if not cur_metadata["group_name"]:
+                logger.warning(
+                    "Event for instance_id:%s has no associated group, ignoring",
+                    event["instance_id"],
+                    extra={
+                        "instance_id": event["instance_id"],
+                        "event": event,
+                        "metadata": cur_metadata,
+                    },
                 )
+                continue
 
-                instance_metadata = {
-                    instance["InstanceId"]: boto3_tags_to_dict(instance.get("Tags", {}))
-                    for reservation in response["Reservations"]
-                    for instance in reservation["Instances"]
-                }
+            events_with_metadata.append(
+                dict(
+                    **cur_metadata,
+                    region=region,
+                    account=account,
+                    **event,
+                )
+            )
 
-                for event in events:
-                    cur_metadata = instance_metadata[event["instance_id"]]
+        return events_with_metadata
 
-                    group_name = cur_metadata.get(
-                        "spotinst:aws:ec2:group:id",
-                        cur_metadata.get("aws:autoscaling:groupName"),
-                    )
+    def _describe_instances(
+            self,
+            account: str,
+            region: str,
+            instance_ids: List[str],
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Look up the tags of instances in EC2, describing bounded chunks of instances concurrently.
+        :param account: The account the instances are in.
+        :param region: The region the instances are in.
+        :param instance_ids: The instances to look up.
+        :return: The standardized tags of each instance EC2 describes, by instance id.
+        """
+        ec2_client: botostubs.EC2 = self.sts_client.get_boto3_client_for_account(
+            account_id=account,
+            role_name=os.environ["FLAPPY_DETECTOR_ROLE"],
+            client_name="ec2",
+            region_name=region,
+        )
 
-                    if not group_name:
-                        logger.warning(
-                            "Event for instance_id:%s has no associated group, ignoring",
-                            event["instance_id"],
-                            extra={
-                                "instance_id": event["instance_id"],
-                                "event": event,
-                                "metadata": cur_metadata,
-                            },
-                        )
-                        continue
-
-                    standardized_tags = {
-                        "application": cur_metadata.get("application"),
-                        "environment":
-                            cur_metadata.get("environment") or
-                            cur_metadata.get("env"),
-                        "team": cur_metadata.get("team"),
-                        "group_name": group_name,
-                        "region": region,
-                        "account": account,
-                    }
-                    events_with_metadata.append(
-                        dict(
-                            **standardized_tags,
-                            **event,
-                        )
-                    )
+        chunks = [
+            instance_ids[start:start + DESCRIBE_INSTANCES_CHUNK_SIZE]
+            for start in range(0, len(instance_ids), DESCRIBE_INSTANCES_CHUNK_SIZE)
+        ]
+        if len(chunks) == 1:
+            return self._describe_instance_chunk(ec2_client=ec2_client, instance_ids=chunks[0])
 
-        return events_with_metadata
+        instance_metadata: Dict[str, Dict[str, Any]] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chunk_metadata in executor.map(
+                    lambda chunk: self._describe_instance_chunk(ec2_client=ec2_client, instance_ids=chunk),
+                    chunks,
+            ):
+                instance_metadata.update(chunk_metadata)
+
+        return instance_metadata
+
+    def _describe_instance_chunk(
+            self,
+            ec2_client: botostubs.EC2,
+            instance_ids: List[str],
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Look up the tags of a chunk of instances, following every page of results.
+        EC2 fails the whole request if any instance id is unknown or malformed, so the chunk is split in half
+        until the bad instance ids are isolated and skipped.
+        :param ec2_client: EC2 client for the account and region of the instances.
+        :param instance_ids: The instances to look up.
+        :return: The standardized tags of each instance EC2 describes, by instance id.
+        """
+        try:
+            reservations = get_boto3_paged_results(
+                ec2_client.describe_instances,
+                results_key="Reservations",
+                next_token_key="NextToken",
+                InstanceIds=instance_ids,
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] not in INVALID_INSTANCE_ID_ERROR_CODES:
+                raise
+
+            if len(instance_ids) == 1:
+                logger.warning(
+                    "Could not describe instance_id:%s, ignoring",
+                    instance_ids[0],
+                    extra={
+                        "instance_id": instance_ids[0],
+                        "error": exc.response["Error"],
+                    },
+                )
+                return {}
+
+            half = len(instance_ids) // 2
+            return {
+                **self._describe_instance_chunk(ec2_client=ec2_client, instance_ids=instance_ids[:half]),
+                **self._describe_instance_chunk(ec2_client=ec2_client, instance_ids=instance_ids[half:]),
+            }
+
+        return {
+            instance["InstanceId"]: self._standardize_tags(boto3_tags_to_dict(instance.get("Tags", {})))
+            for reservation in reservations
+            for instance in reservation["Instances"]
+        }
+
+    @staticmethod
+    def _standardize_tags(tags: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Pick the tags we record from an instance's tags.
+        :param tags: All of the instance's tags.
+        :return: The instance's application, environment, team and group name.
+        """
+        return {
+            "application": tags.get("application"),
+            "environment":
+                tags.get("environment") or
+                tags.get("env"),
+            "team": tags.get("team"),
+            "group_name": tags.get(
+                "spotinst:aws:ec2:group:id",
+                tags.get("aws:autoscaling:groupName"),
+            ),
+        }
 
     def _write_to_dynamodb(
             self,
-            events: List[Dict[str, str]],
+            events: List[Dict[str, Any]],
+    ) -> BatchWriteResult:
+        """
+        Writes the list of records to DynamoDB in batches of up to 25 records.
+        Each record is keyed by time bucket so the detector can query by time.
+        :param events: List of records.
+        :return: Summary of the records written and retried.
+        :raises UnprocessedItemsError: If some records could not be written, so the invocation is retried.
+        """
+        result = batch_write(
+            dynamodb_table=self.dynamodb_table,
+            items=[
+                {
+                    **event,
+                    TIME_BUCKET_ATTRIBUTE: get_time_bucket(event["timestamp"]),
+                }
+                for event in events
+            ],
+        )
+
+        logger.info(
+            "Wrote %s records, retried %s, failed %s",
+            result.written,
+            result.retried,
+            len(result.unprocessed),
+            extra={
+                "written": result.written,
+                "retried": result.retried,
+                "failed": len(result.unprocessed),
+            },
+        )
+        if result.unprocessed:
+            raise UnprocessedItemsError(result=result)
+
+        return result
+
+    def _update_rollups(
+            self,
+            rollup_table: botostubs.DynamoDB.DynamodbResource.Table,
+            events: List[Dict[str, Any]],
     ):
         """
-        Writes the list of records to DynamoDB.
+        Adds the records to the count and spread of their group in the time bucket they fall in.
+        Records are combined before writing, so each group and bucket takes one atomic update.
+        As in the detector's loop, records with an unknown state are counted without changing the spread.
+        The records with a known state are counted too, so groups without any can be left out.
+        :param rollup_table: Table resource for per group counters keyed by time_bucket and key.
         :param events: List of records.
         """
+        rollups: Dict[Tuple[int, str], Dict[str, Any]] = {}
         for event in events:
-            throttled_call(
-                self.dynamodb_table.put_item,
-                Item=event,
+            group = {attribute: event[attribute] for attribute in FlappyEvent.KEY_ATTRIBUTES}
+            try:
+                key = FlappyEvent(**group).key
+            except TypeError:
+                logger.debug(
+                    "Not rolling up event",
+                    extra={"event": event},
+                )
+                continue
+
+            change: Optional[int]
+            try:
+                change = Ec2State(event["state"]).change
+            except ValueError:
+                change = None
+
+            time_bucket = get_time_bucket(event["timestamp"], bucket_size=ROLLUP_BUCKET_SIZE_IN_SECS)
+            rollup = rollups.setdefault(
+                (time_bucket, key),
+                {
+                    "group": group,
+                    "team": None,
+                    "changes": [],
+                },
             )
+            rollup["team"] = rollup["team"] or event.get("team")
+            rollup["changes"].append((event.get("event_id"), change))
+
+        expires_at = int(time.time() + self.rollup_ttl.total_seconds())
+        for (time_bucket, key), rollup in rollups.items():
+            changes = rollup["changes"]
+            for start in range(0, len(changes), ROLLUP_EVENT_IDS_PER_UPDATE):
+                self._update_rollup(
+                    rollup_table=rollup_table,
+                    rollup_key={TIME_BUCKET_ATTRIBUTE: time_bucket, "key": key},
+                    group={**rollup["group"], "expires_at": expires_at},
+                    team=rollup["team"],
+                    changes=changes[start:start + ROLLUP_EVENT_IDS_PER_UPDATE],
+                )
+
+    def _update_rollup(
+            self,
+            rollup_table: botostubs.DynamoDB.DynamodbResource.Table,
+            rollup_key: Dict[str, Any],
+            group: Dict[str, Any],
+            team: Optional[str],
+            changes: List[RollupChange],
+    ):
+        """
+        Adds changes to a group's counters in a time bucket, once per event id.
+        Each event id is claimed by a marker item written in the same transaction as the update, conditional
+        on the marker not existing yet. When some do, the changes are applied one at a time so only the
+        redelivered ones are skipped. Markers expire along with the counters, so the counters stay the same
+        size however busy the group is.
+        :param rollup_table: Table resource for per group counters keyed by time_bucket and key.
+        :param rollup_key: Key of the group's counters in the time bucket.
+        :param group: Attributes set on the counters.
+        :param team: The team owning the group, set unless the counters already have one.
+        :param changes: The event id and change in host count of each record.
+        """
+        update = self._build_rollup_update(group=group, team=team, changes=changes)
+        event_ids = [event_id for event_id, _ in changes if event_id]
+        try:
+            self._write_rollup(
+                rollup_table=rollup_table,
+                rollup_key=rollup_key,
+                update=update,
+                event_ids=event_ids,
+                expires_at=group["expires_at"],
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "TransactionCanceledException" or not any(
+                    reason.get("Code") == "ConditionalCheckFailed"
+                    for reason in exc.response.get("CancellationReasons", [])
+            ):
+                raise
+
+            if len(changes) == 1:
+                logger.info(
+                    "Skipping event_id:%s already rolled up",
+                    changes[0][0],
+                    extra={"event_id": changes[0][0], "rollup_key": rollup_key},
+                )
+                return
+
+            for change in changes:
+                self._update_rollup(
+                    rollup_table=rollup_table,
+                    rollup_key=rollup_key,
+                    group=group,
+                    team=team,
+                    changes=[change],
+                )
+
+    @staticmethod
+    def _write_rollup(
+            rollup_table: botostubs.DynamoDB.DynamodbResource.Table,
+            rollup_key: Dict[str, Any],
+            update: Dict[str, Any],
+            event_ids: List[str],
+            expires_at: int,
+    ):
+        """
+        Apply an update to a group's counters, in one transaction with a marker for each event id if any.
+        Counters of busy groups are updated by several invocations at once, so an update conflicting with
+        another transaction is retried with exponential backoff and jitter.
+        :param rollup_table: Table resource for per group counters keyed by time_bucket and key.
+        :param rollup_key: Key of the group's counters in the time bucket.
+        :param update: The arguments for UpdateItem, other than the Key.
+        :param event_ids: The event ids to claim with markers.
+        :param expires_at: When the markers expire.
+        :raises ClientError: If the update failed for any other reason, or kept conflicting.
+        """
+        # botostubs' Table doesn't describe the resource's name or client
+        table_name: str = rollup_table.name  # type: ignore
+        client = rollup_table.meta.client  # type: ignore
+        for attempt in range(1, ROLLUP_MAX_ATTEMPTS + 1):
+            try:
+                if not event_ids:
+                    throttled_call(rollup_table.update_item, Key=rollup_key, **update)
+                    return
+
+                throttled_call(
+                    client.transact_write_items,
+                    TransactItems=[
+                        *[
+                            {
+                                "Put": {
+                                    "TableName": table_name,
+                                    "Item": {
+                                        **_get_marker_key(rollup_key=rollup_key, event_id=event_id),
+                                        "expires_at": expires_at,
+                                    },
+                                    "ConditionExpression": "attribute_not_exists(#key)",
+                                    "ExpressionAttributeNames": {"#key": "key"},
+                                },
+                            }
+                            for event_id in event_ids
+                        ],
+                        {"Update": {"TableName": table_name, "Key": rollup_key, **update}},
+                    ],
+                )
+                return
+            except ClientError as exc:
+                reasons = [reason.get("Code") for reason in exc.response.get("CancellationReasons", [])]
+                conflicted = exc.response["Error"]["Code"] == "TransactionConflictException" or (
+                    "TransactionConflict" in reasons and "ConditionalCheckFailed" not in reasons
+                )
+                if not conflicted or attempt == ROLLUP_MAX_ATTEMPTS:
+                    raise
+
+                logger.info(
+                    "Retrying rollup update conflicting with another transaction",
+                    extra={"rollup_key": rollup_key, "attempt": attempt},
+                )
+                time.sleep(
+                    random.uniform(
+                        0,
+                        min(ROLLUP_RETRY_MAX_DELAY_IN_SECS, ROLLUP_RETRY_BASE_DELAY_IN_SECS * 2 ** attempt),
+                    )
+                )
+
+    @staticmethod
+    def _build_rollup_update(
+            group: Dict[str, Any],
+            team: Optional[str],
+            changes: List[RollupChange],
+    ) -> Dict[str, Any]:
+        """
+        Build the update adding changes to a group's counters.
+        :param group: Attributes set on the counters.
+        :param team: The team owning the group, set unless the counters already have one.
+        :param changes: The event id and change in host count of each record.
+        :return: The arguments for UpdateItem, other than the Key.
+        """
+        values = {
+            "count": len(changes),
+            "spread": sum(change for _, change in changes if change is not None),
+            "known": sum(change is not None for _, change in changes),
+            **group,
+        }
+        set_expression = " SET " + ", ".join(
+            f"#{name} = :{name}" for name in values if name not in ("count", "spread", "known")
+        )
+        if team:
+            values["team"] = team
+            set_expression += ", #team = if_not_exists(#team, :team)"
+
+        return {
+            "UpdateExpression": "ADD #count :count, #spread :spread, #known :known" + set_expression,
+            "ExpressionAttributeNames": {f"#{name}": name for name in values},
+            "ExpressionAttributeValues": {f":{name}": value for name, value in values.items()},
+        }
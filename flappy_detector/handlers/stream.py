@@ -0,0 +1,492 @@
+"""Lambda for detecting flapping resources as they are ingested, from the EC2 table's DynamoDB Stream"""
+from __future__ import annotations
+
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple, TYPE_CHECKING
+
+import boto3
+from amplify_aws_utils.resource_helper import throttled_call
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+from datadog import api
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.alert_state import AlertStateStore
+from flappy_detector.utils.alerting import initialize_datadog, send_flappy_event
+from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.time_bucket import get_time_bucket
+from flappy_detector.utils.tracing import patch_libraries
+
+if TYPE_CHECKING:
+    import botostubs
+
+logger = logging.getLogger(__name__)
+
+patch_libraries(("botocore", "requests"))
+
+# The most records claimed with each write of a group's state, as a transaction holds at most 100 items
+RECORD_IDS_PER_UPDATE = 50
+# Seconds to wait before retrying a raced update, doubled on each further retry up to the max
+RETRY_BASE_DELAY_IN_SECS = 0.05
+RETRY_MAX_DELAY_IN_SECS = 2.0
+
+# The start of the time bucket each record falls in and the change it made to its group, by record id.
+# The change is None when the record's state isn't known
+Changes = Dict[str, Tuple[int, Optional[int]]]
+# Counts, spreads and counts of records with a known state of a group, by the start of their time bucket
+Buckets = Dict[int, Dict[str, int]]
+
+
+class GroupRecords(NamedTuple):
+    """The new records of a group"""
+
+    flappy_event: FlappyEvent
+    changes: Changes
+    # Stream sequence numbers of the records, reported back to the stream when the group can't be updated
+    sequence_numbers: List[str]
+
+
+def handler(event, _):
+    """
+    Stream handler.
+    :param event: DynamoDB Stream event for the EC2 table
+    :return: The sequence numbers of the records to retry, as batchItemFailures
+    """
+    logger.info("Received %s stream records", len(event["Records"]))
+
+    deserializer = TypeDeserializer()
+    records = [
+        {
+            **{
+                name: deserializer.deserialize(value)
+                for name, value in record["dynamodb"]["NewImage"].items()
+            },
+            "sequence_number": record["dynamodb"]["SequenceNumber"],
+        }
+        for record in event["Records"]
+        # Rewrites of an existing record don't add an event
+        if record["eventName"] == "INSERT"
+    ]
+
+    initialize_datadog()
+    stream_detector = StreamDetector(
+        datadog_client=api,
+        state_table=boto3.resource('dynamodb').Table(os.environ["FLAPPY_DETECTOR_STATE_TABLE"]),
+        max_event_age=timedelta(minutes=int(os.environ["FLAPPY_DETECTOR_MAX_EVENT_AGE_IN_MINS"])),
+        min_number_of_events=int(os.environ["FLAPPY_DETECTOR_MIN_NUM_EVENTS"]),
+        min_spread=int(os.environ["FLAPPY_DETECTOR_MIN_SPREAD"]),
+        alert_state_store=_get_alert_state_store(),
+    )
+
+    failed_sequence_numbers = stream_detector.process_records(records=records)
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": sequence_number}
+            for sequence_number in failed_sequence_numbers
+        ],
+    }
+
+
+def _get_alert_state_store() -> Optional[AlertStateStore]:
+    """Store of the alerts sent for each group, shared with the scheduled detector, None when unset"""
+    alert_state_table_name = os.environ.get("FLAPPY_DETECTOR_ALERT_STATE_TABLE")
+    if not alert_state_table_name:
+        return None
+
+    return AlertStateStore(
+        dynamodb_table=boto3.resource('dynamodb').Table(alert_state_table_name),
+        cooldown=timedelta(minutes=int(os.environ.get("FLAPPY_DETECTOR_ALERT_COOLDOWN_IN_MINS", 120))),
+        escalation_factor=float(os.environ.get("FLAPPY_DETECTOR_ALERT_ESCALATION_FACTOR", 2)),
+    )
+
+
+class StreamDetector:
+    """
+    Class for detecting flappy resources incrementally.
+
+    Each group's state holds its count and spread per time bucket over the last max_event_age, so new records
+    are folded in without reading any other records. The window starts at the start of the bucket the cut off
+    falls in, and the flap condition is the same one the scheduled detector uses.
+
+    Each record counted is claimed by a marker item in the state table, keyed by the group's key and the
+    record's event_id or else its stream sequence number, written in the same transaction as the state and
+    expiring along with it. Records the stream delivers again, as it does when retrying a batch, are skipped
+    rather than counted twice, and the group's state stays the same size however busy the group is.
+    """
+
+    def __init__(
+            self,
+            datadog_client,
+            state_table: botostubs.DynamoDB.DynamodbResource.Table,
+            max_event_age: timedelta,
+            min_number_of_events: int,
+            min_spread: int,
+            bucket_size: int = 60,
+            max_attempts: int = 5,
+            alert_state_store: Optional[AlertStateStore] = None,
+    ):
+        """
+        :param datadog_client: Datadog API Client.
+        :param state_table: Table resource for the state of each group, keyed by key.
+        :param max_event_age: Timedelta representing how old an event can be to be evaluated.
+        :param min_number_of_events: The minimum number of events to consider for flapping.
+        :param min_spread: The amount of deviation in the host count below which we consider flapping.
+        :param bucket_size: Size of each time bucket in seconds.
+        :param max_attempts: How many times to try updating a group's state when other updates race it.
+        :param alert_state_store: Store of the alerts sent for each group, shared with the scheduled detector
+            so a flap is only alerted on once. None to alert on groups as they start flapping.
+        """
+        self.datadog_client = datadog_client
+        self.state_table = state_table
+        self.max_event_age = max_event_age
+        self.min_number_of_events = min_number_of_events
+        self.min_spread = min_spread
+        self.bucket_size = bucket_size
+        self.max_attempts = max_attempts
+        self.alert_state_store = alert_state_store
+
+    def process_records(self, records: List[Dict[str, Any]]) -> List[str]:
+        """
+        Fold new records into the state of their groups, alerting on groups that start flapping.
+        A group that can't be updated is logged without affecting the others.
+        :param records: Newly ingested DynamoDB records, along with their stream sequence_number.
+        :return: The sequence numbers of the records of the groups that couldn't be updated.
+        """
+        cut_off_bucket = get_time_bucket(
+            (datetime.now() - self.max_event_age).timestamp(),
+            bucket_size=self.bucket_size,
+        )
+
+        failed_sequence_numbers: List[str] = []
+        for group in self._group_records(records=records, cut_off_bucket=cut_off_bucket):
+            try:
+                self._update_group(group=group, cut_off_bucket=cut_off_bucket)
+            except Exception:
+                logger.exception(
+                    "Could not update group",
+                    extra={"flapping_app": group.flappy_event},
+                )
+                failed_sequence_numbers += group.sequence_numbers
+
+        return failed_sequence_numbers
+
+    def _group_records(
+            self,
+            records: List[Dict[str, Any]],
+            cut_off_bucket: int,
+    ) -> List[GroupRecords]:
+        """
+        Collect the records by group and time bucket.
+        As in the detector's loop, records with an unknown state are counted without changing the spread.
+        :param records: Newly ingested DynamoDB records.
+        :param cut_off_bucket: The oldest bucket still in the window, older records are ignored.
+        :return: The FlappyEvent of each group along with the change of each of its new records.
+        """
+        groups: Dict[Tuple[str, ...], GroupRecords] = {}
+        for record in records:
+            try:
+                time_bucket = get_time_bucket(record["timestamp"], bucket_size=self.bucket_size)
+                key_attributes = tuple(record[attribute] for attribute in FlappyEvent.KEY_ATTRIBUTES)
+                record_id = str(record.get("event_id") or record["sequence_number"])
+                group = groups.get(key_attributes) or GroupRecords(
+                    flappy_event=FlappyEvent(*key_attributes),
+                    changes={},
+                    sequence_numbers=[],
+                )
+            except (KeyError, ValueError, TypeError):
+                logger.debug(
+                    "Not evaluating record",
+                    extra={"record": record},
+                )
+                continue
+
+            if time_bucket < cut_off_bucket:
+                continue
+
+            change: Optional[int]
+            try:
+                change = Ec2State(record["state"]).change
+            except (KeyError, ValueError, TypeError):
+                change = None
+
+            groups[key_attributes] = group
+            if not group.flappy_event.team:
+                group.flappy_event.team = record.get("team")
+
+            group.changes[record_id] = (time_bucket, change)
+            if record.get("sequence_number"):
+                group.sequence_numbers.append(record["sequence_number"])
+
+        return list(groups.values())
+
+    def _update_group(self, group: GroupRecords, cut_off_bucket: int):
+        """
+        Add new records to a group's state, a chunk of records at a time so each fits in one transaction.
+        :param group: The group's new records.
+        :param cut_off_bucket: The oldest bucket still in the window.
+        """
+        record_ids = list(group.changes)
+        for start in range(0, len(record_ids), RECORD_IDS_PER_UPDATE):
+            self._update_state(
+                flappy_event=group.flappy_event,
+                changes={
+                    record_id: group.changes[record_id]
+                    for record_id in record_ids[start:start + RECORD_IDS_PER_UPDATE]
+                },
+                cut_off_bucket=cut_off_bucket,
+            )
+
+    def _update_state(self, flappy_event: FlappyEvent, changes: Changes, cut_off_bucket: int):
+        """
+        Add new records to a group's state, expiring buckets outside the window and skipping records already
+        counted. Alerts if the group is flapping.
+        The state is written conditionally on its version, and each record's marker on it not existing yet, so
+        concurrent updates retry rather than overwrite or count a record twice.
+        :param flappy_event: The FlappyEvent of the group.
+        :param changes: The change of each of the group's new records.
+        :param cut_off_bucket: The oldest bucket still in the window.
+        """
+        alerted = False
+        for attempt in range(1, self.max_attempts + 1):
+            state = throttled_call(
+                self.state_table.get_item,
+                Key={"key": flappy_event.key},
+                ConsistentRead=True,
+            ).get("Item", {})
+
+            counted = self._get_counted(flappy_event=flappy_event, record_ids=list(changes))
+            if counted:
+                logger.info(
+                    "Skipping %s records already counted",
+                    len(counted),
+                    extra={"flapping_app": flappy_event},
+                )
+                changes = {
+                    record_id: change for record_id, change in changes.items() if record_id not in counted
+                }
+            if not changes:
+                return
+
+            merged_buckets = _merge_buckets(
+                buckets=state.get("buckets", {}),
+                changes=changes,
+                cut_off_bucket=cut_off_bucket,
+            )
+            evaluated_event = FlappyEvent(
+                **{attribute: getattr(flappy_event, attribute) for attribute in FlappyEvent.KEY_ATTRIBUTES},
+                team=state.get("team") or flappy_event.team,
+                count=sum(counts["count"] for counts in merged_buckets.values()),
+                spread=sum(counts["spread"] for counts in merged_buckets.values()),
+            )
+            # As in the loop, a group is only evaluated once it has a record with a known state
+            known = sum(counts["known"] for counts in merged_buckets.values())
+            flapping = bool(known) and evaluated_event.is_flapping(
+                min_number_of_events=self.min_number_of_events,
+                min_spread=self.min_spread,
+            )
+            if flapping and not alerted:
+                # Sent before the state is written, so an alert that fails is sent again with the records
+                alerted = self._alert(flappy_event=evaluated_event, was_flapping=bool(state.get("flapping")))
+
+            try:
+                self._write_state(
+                    flappy_event=evaluated_event,
+                    buckets=merged_buckets,
+                    flapping=flapping,
+                    version=int(state.get("version", 0)),
+                    record_ids=list(changes),
+                )
+            except ClientError as exc:
+                raced = exc.response["Error"]["Code"] == "TransactionCanceledException" and all(
+                    reason.get("Code") in ("None", "ConditionalCheckFailed", "TransactionConflict")
+                    for reason in exc.response.get("CancellationReasons", [])
+                )
+                if not raced or attempt == self.max_attempts:
+                    raise
+                _backoff(attempt=attempt)
+                continue
+
+            return
+
+    def _get_counted(self, flappy_event: FlappyEvent, record_ids: List[str]) -> Set[str]:
+        """
+        Find the records already counted in a group's state, from their markers.
+        :param flappy_event: The FlappyEvent of the group.
+        :param record_ids: The ids of the group's new records, at most 100.
+        :return: The ids of the records with a marker.
+        """
+        # botostubs' Table doesn't describe the resource's name or client
+        table_name: str = self.state_table.name  # type: ignore
+        client = self.state_table.meta.client  # type: ignore
+
+        record_ids_by_key = {
+            _get_marker_key(key=flappy_event.key, record_id=record_id): record_id
+            for record_id in record_ids
+        }
+        keys = [{"key": marker_key} for marker_key in record_ids_by_key]
+        counted: Set[str] = set()
+        for attempt in range(1, self.max_attempts + 1):
+            response = throttled_call(
+                client.batch_get_item,
+                RequestItems={
+                    table_name: {
+                        "Keys": keys,
+                        "ConsistentRead": True,
+                        "ProjectionExpression": "#key",
+                        "ExpressionAttributeNames": {"#key": "key"},
+                    },
+                },
+            )
+            counted.update(
+                record_ids_by_key[item["key"]] for item in response["Responses"].get(table_name, [])
+            )
+            keys = response.get("UnprocessedKeys", {}).get(table_name, {}).get("Keys", [])
+            if not keys:
+                return counted
+
+            _backoff(attempt=attempt)
+
+        raise RuntimeError(f"Could not read {len(keys)} markers after {self.max_attempts} attempts")
+
+    def _write_state(
+            self,
+            flappy_event: FlappyEvent,
+            buckets: Buckets,
+            flapping: bool,
+            version: int,
+            record_ids: List[str],
+    ):
+        """
+        Write a group's state along with a marker for each record it counts, in one transaction.
+        :param flappy_event: The evaluated FlappyEvent of the group.
+        :param buckets: The group's merged buckets.
+        :param flapping: Whether the group is flapping.
+        :param version: The version of the state the buckets were merged into, 0 when there was none.
+        :param record_ids: The ids of the records counted.
+        """
+        # botostubs' Table doesn't describe the resource's name or client
+        table_name: str = self.state_table.name  # type: ignore
+        client = self.state_table.meta.client  # type: ignore
+        expires_at = int((datetime.now() + self.max_event_age).timestamp())
+
+        throttled_call(
+            client.transact_write_items,
+            TransactItems=[
+                *[
+                    {
+                        "Put": {
+                            "TableName": table_name,
+                            "Item": {
+                                "key": _get_marker_key(key=flappy_event.key, record_id=record_id),
+                                "expires_at": expires_at,
+                            },
+                            "ConditionExpression": "attribute_not_exists(#key)",
+                            "ExpressionAttributeNames": {"#key": "key"},
+                        },
+                    }
+                    for record_id in record_ids
+                ],
+                {
+                    "Put": {
+                        "TableName": table_name,
+                        "Item": {
+                            "key": flappy_event.key,
+                            **{
+                                attribute: getattr(flappy_event, attribute)
+                                for attribute in FlappyEvent.KEY_ATTRIBUTES
+                            },
+                            "team": flappy_event.team,
+                            "buckets": {
+                                str(time_bucket): counts
+                                for time_bucket, counts in buckets.items()
+                            },
+                            "flapping": flapping,
+                            "version": version + 1,
+                            "expires_at": expires_at,
+                        },
+                        "ConditionExpression": "attribute_not_exists(#version) OR #version = :version",
+                        "ExpressionAttributeNames": {"#version": "version"},
+                        "ExpressionAttributeValues": {":version": version},
+                    },
+                },
+            ],
+        )
+
+    def _alert(self, flappy_event: FlappyEvent, was_flapping: bool) -> bool:
+        """
+        Alert on a flapping group, unless it was already alerted on.
+        With an AlertStateStore the alert is claimed from it, otherwise a group is alerted on as it starts
+        flapping. Errors sending the alert are raised, with the claim released.
+        :param flappy_event: The FlappyEvent of the flapping group.
+        :param was_flapping: Whether the group's stored state was flapping.
+        :return: True if the alert was sent.
+        """
+        if self.alert_state_store:
+            if not self.alert_state_store.claim_alert(flappy_event=flappy_event):
+                return False
+        elif was_flapping:
+            return False
+
+        logger.info(
+            "Alerting on flapping group",
+            extra={"flapping_app": flappy_event},
+        )
+        try:
+            send_flappy_event(datadog_client=self.datadog_client, flappy_event=flappy_event)
+        except Exception:
+            if self.alert_state_store:
+                self.alert_state_store.release(flappy_events=[flappy_event])
+            raise
+
+        return True
+
+
+def _backoff(attempt: int):
+    """
+    Wait before retrying, with exponential backoff and jitter.
+    :param attempt: The number of attempts made so far.
+    """
+    time.sleep(random.uniform(0, min(RETRY_MAX_DELAY_IN_SECS, RETRY_BASE_DELAY_IN_SECS * 2 ** attempt)))
+
+
+def _get_marker_key(key: str, record_id: str) -> str:
+    """
+    Key of the marker claiming a record for a group's state.
+    :param key: The group's key.
+    :param record_id: The record's event_id or else its stream sequence number.
+    :return: The marker's key.
+    """
+    return f"{key}#{record_id}"
+
+
+def _merge_buckets(buckets: Dict[str, Any], changes: Changes, cut_off_bucket: int) -> Buckets:
+    """
+    Add new records to a group's stored buckets, dropping buckets outside the window.
+    :param buckets: The group's stored buckets, by the start of their time bucket as a string.
+    :param changes: The change of each of the group's new records.
+    :param cut_off_bucket: The oldest bucket still in the window.
+    :return: The merged buckets.
+    """
+    merged_buckets: Buckets = {
+        int(time_bucket): {
+            "count": int(counts["count"]),
+            "spread": int(counts["spread"]),
+            # Buckets stored before unknown states were counted only hold records with a known state
+            "known": int(counts.get("known", counts["count"])),
+        }
+        for time_bucket, counts in buckets.items()
+        if int(time_bucket) >= cut_off_bucket
+    }
+    for time_bucket, change in changes.values():
+        merged = merged_buckets.setdefault(time_bucket, {"count": 0, "spread": 0, "known": 0})
+        merged["count"] += 1
+        if change is not None:
+            merged["spread"] += change
+            merged["known"] += 1
+
+    return merged_buckets
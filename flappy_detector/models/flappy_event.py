@@ -1,48 +1,136 @@
 """Model representing a Flappy Event"""
-from dataclasses import dataclass, field
-from typing import Optional
+from typing import ClassVar, Iterable, Optional, Tuple
 
 
-@dataclass
 class FlappyEvent:
-    """Represents a flappy event"""
-
-    account: str
-    region: str
-    environment: str
-    application: str
-    group_name: str
-    team: Optional[str] = None
-    key: str = field(init=False)
-    count: int = 0
-    spread: int = 0
-
-    def __post_init__(self):
-        self.key = "_".join(
-            [
-                self.account,
-                self.region,
-                self.environment,
-                self.application,
-                self.group_name,
-            ]
+    """
+    Represents a flappy event.
+
+    Slotted since the detector holds one per group and folds every scanned record into them. The key is
+    built once from the key attributes, and the tags once per team.
+    """
+
+    # Attributes of an ingested record identifying the group it belongs to
+    KEY_ATTRIBUTES: ClassVar[Tuple[str, ...]] = (
+        "account",
+        "region",
+        "environment",
+        "application",
+        "group_name",
+    )
+    # Attributes of an ingested record that are folded into a flappy event, and the id it is deduplicated by
+    RECORD_ATTRIBUTES: ClassVar[Tuple[str, ...]] = KEY_ATTRIBUTES + ("team", "state", "timestamp", "event_id")
+
+    __slots__ = (
+        "account",
+        "region",
+        "environment",
+        "application",
+        "group_name",
+        "key",
+        "count",
+        "spread",
+        "_team",
+        "_tags",
+    )
+
+    def __init__(
+            self,
+            account: str,
+            region: str,
+            environment: str,
+            application: str,
+            group_name: str,
+            team: Optional[str] = None,
+            count: int = 0,
+            spread: int = 0,
+    ):
+        self.account = account
+        self.region = region
+        self.environment = environment
+        self.application = application
+        self.group_name = group_name
+        self.key = self.get_key((account, region, environment, application, group_name))
+        self.count = count
+        self.spread = spread
+        self._team = team
+        self._tags: Optional[Tuple[str, ...]] = None
+
+    @staticmethod
+    def get_key(key_attributes: Iterable[str]) -> str:
+        """
+        Build the key of a group.
+        :param key_attributes: The group's values of KEY_ATTRIBUTES, in order.
+        :return: The key shared by every FlappyEvent of the group.
+        """
+        return "_".join(key_attributes)
+
+    @property
+    def team(self) -> Optional[str]:
+        """The team owning the group"""
+        return self._team
+
+    @team.setter
+    def team(self, team: Optional[str]):
+        self._team = team
+        self._tags = None
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    # Mutable, so unhashable like the dataclass it replaced
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(account={self.account!r}, region={self.region!r}, "
+            f"environment={self.environment!r}, application={self.application!r}, "
+            f"group_name={self.group_name!r}, team={self.team!r}, key={self.key!r}, "
+            f"count={self.count!r}, spread={self.spread!r})"
+        )
+
+    def _astuple(self):
+        return (
+            self.account,
+            self.region,
+            self.environment,
+            self.application,
+            self.group_name,
+            self._team,
+            self.key,
+            self.count,
+            self.spread,
         )
 
+    def is_flapping(self, min_number_of_events: int, min_spread: int) -> bool:
+        """
+        Whether the group changed often enough, with little enough change in its host count, to be flapping.
+        :param min_number_of_events: The minimum number of events to consider for flapping.
+        :param min_spread: The amount of deviation in the host count below which we consider flapping.
+        :return: True if the group is flapping.
+        """
+        return self.count >= min_number_of_events and abs(self.spread) <= min_spread
+
     @property
-    def tags(self):
+    def tags(self) -> Tuple[str, ...]:
         """Returns the DD tags for the flappy event"""
-        tags = [
-            f"account:{self.account}",
-            f"region:{self.region}",
-            f"environment:{self.environment}",
-            f"application:{self.application}",
-            f"env:{self.environment}",
-            f"service:{self.application}",
-            f"group_name:{self.group_name}",
-            "source:flappy_detector",
-        ]
-
-        if self.team:
-            tags.append(f"team:{self.team}")
-
-        return tags
+        if self._tags is None:
+            tags: Tuple[str, ...] = (
+                f"account:{self.account}",
+                f"region:{self.region}",
+                f"environment:{self.environment}",
+                f"application:{self.application}",
+                f"env:{self.environment}",
+                f"service:{self.application}",
+                f"group_name:{self.group_name}",
+                "source:flappy_detector",
+            )
+
+            if self._team:
+                tags += (f"team:{self._team}",)
+
+            self._tags = tags
+
+        return self._tags
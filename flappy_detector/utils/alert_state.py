@@ -0,0 +1,222 @@
+"""State of the alerts sent for each group, used to suppress repeat alerts"""
+from __future__ import annotations
+
+import logging
+import time
+from datetime import timedelta
+from itertools import chain
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+from amplify_aws_utils.resource_helper import throttled_call
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.dynamodb import iterate_pages
+
+if TYPE_CHECKING:
+    import botostubs
+
+logger = logging.getLogger(__name__)
+
+
+class AlertStateStore:
+    """
+    Records when each group was last alerted on and how badly it was flapping then, keyed by FlappyEvent.key.
+
+    A group still flapping is only alerted on again once the cooldown passes or its count escalates.
+    Groups that stop flapping get a single recovery alert. Every change of state is a write conditional
+    on the version read, so when detect runs overlap only one of them claims each alert.
+    """
+
+    def __init__(
+            self,
+            dynamodb_table: botostubs.DynamoDB.DynamodbResource.Table,
+            cooldown: timedelta = timedelta(hours=2),
+            escalation_factor: float = 2.0,
+            ttl: timedelta = timedelta(days=1),
+    ):
+        """
+        :param dynamodb_table: Table resource for the alert state, keyed by key.
+        :param cooldown: How long after alerting on a group to suppress alerts for it.
+        :param escalation_factor: How many times the last alerted count a group must reach to be alerted on
+            during the cooldown.
+        :param ttl: How long the state of a group is kept after it last changed.
+        """
+        self.dynamodb_table = dynamodb_table
+        self.cooldown = cooldown
+        self.escalation_factor = escalation_factor
+        self.ttl = ttl
+        # The state each claim replaced along with the version it wrote, so failed alerts can be released
+        self._claims: Dict[str, Tuple[Optional[Dict[str, Any]], int]] = {}
+        self._lock = Lock()
+
+    def claim(self, flapping_events: List[FlappyEvent]) -> Tuple[List[FlappyEvent], List[FlappyEvent]]:
+        """
+        Decide which groups to alert on, recording the alerts as sent.
+        :param flapping_events: The FlappyEvents of every group flapping now.
+        :return: The flapping groups to alert on, and the groups that stopped flapping.
+        """
+        now = time.time()
+        states = self._get_states()
+
+        alerts = []
+        for flappy_event in flapping_events:
+            state = states.pop(flappy_event.key, None)
+            if self._should_alert(flappy_event=flappy_event, state=state, now=now) and self._put_state(
+                    flappy_event=flappy_event,
+                    state=state,
+                    flapping=True,
+                    now=now,
+            ):
+                alerts.append(flappy_event)
+
+        recoveries = []
+        for state in states.values():
+            if not state.get("flapping"):
+                continue
+
+            flappy_event = FlappyEvent(
+                **{attribute: state[attribute] for attribute in FlappyEvent.KEY_ATTRIBUTES},
+                team=state.get("team"),
+                count=int(state["last_count"]),
+                spread=int(state["last_spread"]),
+            )
+            if self._put_state(flappy_event=flappy_event, state=state, flapping=False, now=now):
+                recoveries.append(flappy_event)
+
+        logger.info(
+            "Claimed %s alerts and %s recoveries, suppressed %s alerts",
+            len(alerts),
+            len(recoveries),
+            len(flapping_events) - len(alerts),
+        )
+
+        return alerts, recoveries
+
+    def claim_alert(self, flappy_event: FlappyEvent) -> bool:
+        """
+        Decide whether to alert on a single flapping group, recording the alert as sent.
+        Unlike claim, no other group is recovered, for detectors that only see the groups they update.
+        :param flappy_event: The FlappyEvent of the flapping group.
+        :return: True if this run claimed the alert.
+        """
+        now = time.time()
+        state = throttled_call(
+            self.dynamodb_table.get_item,
+            Key={"key": flappy_event.key},
+            ConsistentRead=True,
+        ).get("Item")
+
+        return self._should_alert(flappy_event=flappy_event, state=state, now=now) and self._put_state(
+            flappy_event=flappy_event,
+            state=state,
+            flapping=True,
+            now=now,
+        )
+
+    def release(self, flappy_events: Iterable[FlappyEvent]):
+        """
+        Restore the state replaced by claims whose alert could not be sent, so the next run tries again.
+        States changed since the claim are left alone.
+        :param flappy_events: The FlappyEvents whose alert could not be sent.
+        """
+        for flappy_event in flappy_events:
+            with self._lock:
+                previous_state, version = self._claims.pop(flappy_event.key)
+
+            try:
+                if previous_state:
+                    throttled_call(
+                        self.dynamodb_table.put_item,
+                        Item=previous_state,
+                        ConditionExpression=Attr("version").eq(version),
+                    )
+                else:
+                    throttled_call(
+                        self.dynamodb_table.delete_item,
+                        Key={"key": flappy_event.key},
+                        ConditionExpression=Attr("version").eq(version),
+                    )
+            except ClientError as exc:
+                if exc.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+
+    def _get_states(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Read the state of every group alerted on within the TTL.
+        :return: The state of each group, by key.
+        """
+        return {
+            state["key"]: state
+            for state in chain.from_iterable(
+                iterate_pages(self.dynamodb_table.scan, ConsistentRead=True)
+            )
+        }
+
+    def _should_alert(self, flappy_event: FlappyEvent, state: Optional[Dict[str, Any]], now: float) -> bool:
+        """
+        Whether a flapping group is newly flapping, out of its cooldown, or flapping materially worse.
+        :param flappy_event: The FlappyEvent of the flapping group.
+        :param state: The group's stored state, None if it has none.
+        :param now: Epoch timestamp of the current run.
+        :return: True if the group should be alerted on.
+        """
+        if not state or not state.get("flapping"):
+            return True
+
+        if now - float(state["last_alerted_at"]) >= self.cooldown.total_seconds():
+            return True
+
+        return flappy_event.count >= int(state["last_count"]) * self.escalation_factor
+
+    def _put_state(
+            self,
+            flappy_event: FlappyEvent,
+            state: Optional[Dict[str, Any]],
+            flapping: bool,
+            now: float,
+    ) -> bool:
+        """
+        Record an alert for the group, unless another run changed its state since it was read.
+        :param flappy_event: The FlappyEvent alerted on.
+        :param state: The group's stored state, None if it has none.
+        :param flapping: Whether the alert is for the group flapping, rather than recovering.
+        :param now: Epoch timestamp of the current run.
+        :return: True if this run claimed the alert.
+        """
+        version = int(state["version"]) if state else 0
+        try:
+            throttled_call(
+                self.dynamodb_table.put_item,
+                Item={
+                    "key": flappy_event.key,
+                    **{
+                        attribute: getattr(flappy_event, attribute)
+                        for attribute in FlappyEvent.KEY_ATTRIBUTES
+                    },
+                    "team": flappy_event.team,
+                    "flapping": flapping,
+                    "last_alerted_at": int(now),
+                    "last_count": flappy_event.count,
+                    "last_spread": flappy_event.spread,
+                    "version": version + 1,
+                    "expires_at": int(now + self.ttl.total_seconds()),
+                },
+                ConditionExpression=Attr("version").not_exists() | Attr("version").eq(version),
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+            logger.info(
+                "Alert already claimed by another run",
+                extra={"flapping_app": flappy_event},
+            )
+            return False
+
+        with self._lock:
+            self._claims[flappy_event.key] = (state, version + 1)
+
+        return True
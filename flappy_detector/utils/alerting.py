@@ -0,0 +1,305 @@
+"""Helpers for alerting on flappy events through Datadog"""
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import timedelta
+from functools import lru_cache
+from threading import Lock
+from typing import Any, Iterable, List, Optional
+
+import boto3
+from datadog import initialize
+from datadog.api.exceptions import ClientError, HTTPError, HttpBackoff, HttpTimeout
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.alert_state import AlertStateStore
+
+logger = logging.getLogger(__name__)
+
+API_KEY_PARAMETER = "/account/app_auth/datadog/api_key"
+APP_KEY_PARAMETER = "/account/app_auth/datadog/flappy_detector_app_key"
+# Errors Datadog responds with when the keys are wrong, e.g. after they were rotated
+AUTH_ERRORS = ("forbidden", "unauthorized", "api key")
+# Errors worth sending the event again for, as returned by the client for 429s and network failures
+RETRYABLE_ERRORS = ("rate limit", "too many requests", "try again later")
+# Raised by the client for 5xx responses and timeouts whether or not it is muted
+RETRYABLE_EXCEPTIONS = (ClientError, HTTPError, HttpBackoff, HttpTimeout)
+
+
+class DatadogKeys:
+    """
+    The Datadog keys stored in SSM, along with when they were last initialized.
+
+    Kept at module level in a Lambda, warm invocations skip both reading SSM and initializing Datadog.
+    """
+
+    def __init__(self, ttl: timedelta):
+        """
+        :param ttl: How long the keys are used before reading them from SSM again.
+        """
+        self.ttl = ttl
+        self.expires_at = 0.0
+
+    def initialize(self, force_refresh: bool = False):
+        """
+        Initialize the Datadog API client, unless it was initialized with keys that are still fresh.
+        :param force_refresh: Whether to read the keys from SSM even if they are still fresh.
+        """
+        if not force_refresh and self.expires_at > time.time():
+            return
+
+        ssm_client = boto3.client("ssm")
+        parameters = {
+            parameter["Name"]: parameter["Value"]
+            for parameter in ssm_client.get_parameters(
+                Names=[API_KEY_PARAMETER, APP_KEY_PARAMETER],
+                WithDecryption=True,
+            )["Parameters"]
+        }
+        initialize(
+            api_key=parameters[API_KEY_PARAMETER],
+            app_key=parameters[APP_KEY_PARAMETER],
+        )
+        self.expires_at = time.time() + self.ttl.total_seconds()
+
+
+@lru_cache(maxsize=None)
+def _get_datadog_keys() -> DatadogKeys:
+    """Datadog keys, kept for the life of the Lambda container"""
+    return DatadogKeys(
+        ttl=timedelta(minutes=int(os.environ.get("FLAPPY_DETECTOR_SECRETS_TTL_IN_MINS", 60))),
+    )
+
+
+def initialize_datadog(force_refresh: bool = False):
+    """
+    Initialize the Datadog API client with the keys stored in SSM.
+    :param force_refresh: Whether to read the keys from SSM even if they are still fresh.
+    """
+    _get_datadog_keys().initialize(force_refresh=force_refresh)
+
+
+def send_flappy_event(datadog_client, flappy_event: FlappyEvent, recovered: bool = False) -> Any:
+    """
+    Send a Datadog event for a flapping group.
+    The keys are read from SSM again and the event resent once if Datadog rejects them.
+    :param datadog_client: Datadog API Client.
+    :param flappy_event: The FlappyEvent of the flapping group.
+    :param recovered: Whether the group has stopped flapping.
+    :return: The response of the Datadog API.
+    """
+    create_event = _create_recovery_event if recovered else _create_event
+    response = create_event(datadog_client=datadog_client, flappy_event=flappy_event)
+    if _has_error(response, AUTH_ERRORS):
+        logger.warning(
+            "Datadog rejected its keys, refreshing them",
+            extra={"errors": response["errors"]},
+        )
+        initialize_datadog(force_refresh=True)
+        response = create_event(datadog_client=datadog_client, flappy_event=flappy_event)
+
+    return response
+
+
+class TokenBucket:
+    """
+    Rate limiter shared between threads, allowing bursts up to its capacity.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        :param rate: Tokens added per second.
+        :param capacity: The most tokens held at once, defaults to one second's worth.
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for one to be added if there are none.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+@dataclass
+class AlertSendResult:
+    """Summary of sending a batch of flappy events"""
+
+    sent: int = 0
+    retried: int = 0
+    failed: List[FlappyEvent] = field(default_factory=list)
+    suppressed: int = 0
+    recovered: int = 0
+
+
+class AlertSender:
+    """
+    Sends flappy events to Datadog concurrently, within a rate limit.
+
+    Events rejected with a 429 or 5xx, or lost to the network, are sent again with backoff and jitter.
+    Given an AlertStateStore, repeat alerts for groups still flapping are suppressed and recoveries sent.
+    """
+
+    def __init__(
+            self,
+            datadog_client,
+            max_workers: int = 8,
+            rate_per_sec: float = 10.0,
+            max_attempts: int = 4,
+            base_delay: float = 0.5,
+            max_delay: float = 8.0,
+            alert_state_store: Optional[AlertStateStore] = None,
+    ):
+        """
+        :param datadog_client: Datadog API Client.
+        :param max_workers: The most events sent at once.
+        :param rate_per_sec: The most requests made per second, retries included.
+        :param max_attempts: The number of times to send each event before giving up on it.
+        :param base_delay: Seconds to wait before the first retry, doubled on each further retry.
+        :param max_delay: The most seconds to wait between retries.
+        :param alert_state_store: Store of the alerts sent for each group, None to alert on every flapping
+            group.
+        """
+        self.datadog_client = datadog_client
+        self.max_workers = max_workers
+        self.rate_limiter = TokenBucket(rate=rate_per_sec)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.alert_state_store = alert_state_store
+
+    def send(self, flappy_events: List[FlappyEvent]) -> AlertSendResult:
+        """
+        Send a Datadog event for each of the given flappy events.
+        :param flappy_events: The FlappyEvents of the flapping groups.
+        :return: How many events were sent, retried and suppressed, and the events that could not be sent.
+        """
+        result = AlertSendResult()
+        lock = Lock()
+
+        alerts: List[FlappyEvent] = flappy_events
+        recoveries: List[FlappyEvent] = []
+        if self.alert_state_store:
+            alerts, recoveries = self.alert_state_store.claim(flapping_events=flappy_events)
+            result.suppressed = len(flappy_events) - len(alerts)
+
+        def send_one(flappy_event: FlappyEvent, recovered: bool):
+            sent, retries = self._send_with_retries(flappy_event=flappy_event, recovered=recovered)
+            with lock:
+                result.retried += retries
+                if not sent:
+                    result.failed.append(flappy_event)
+                elif recovered:
+                    result.recovered += 1
+                else:
+                    result.sent += 1
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Consumed so any unexpected error is raised here
+            list(
+                executor.map(
+                    send_one,
+                    alerts + recoveries,
+                    [False] * len(alerts) + [True] * len(recoveries),
+                )
+            )
+
+        if self.alert_state_store and result.failed:
+            self.alert_state_store.release(flappy_events=result.failed)
+
+        return result
+
+    def _send_with_retries(self, flappy_event: FlappyEvent, recovered: bool = False):
+        """
+        Send a single event, retrying failures that may succeed later.
+        :param flappy_event: The FlappyEvent to send.
+        :param recovered: Whether the group has stopped flapping.
+        :return: Whether the event was sent, and how many times it was retried.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = send_flappy_event(
+                    datadog_client=self.datadog_client,
+                    flappy_event=flappy_event,
+                    recovered=recovered,
+                )
+            except RETRYABLE_EXCEPTIONS as exc:
+                error: Any = str(exc)
+            else:
+                if not _has_error(response, ()):
+                    return True, attempt - 1
+                error = response["errors"]
+                if not _has_error(response, RETRYABLE_ERRORS):
+                    break
+
+            if attempt < self.max_attempts:
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+        logger.error(
+            "Could not send flappy event",
+            extra={"flapping_app": flappy_event, "errors": error},
+        )
+        return False, attempt - 1
+
+
+def _create_event(datadog_client, flappy_event: FlappyEvent) -> Any:
+    return datadog_client.Event.create(
+        title=f"Flappy Detector: {flappy_event.application} might be flapping in {flappy_event.environment}",
+        text="%%% \nThis application might be flapping.\n"
+             f"There have been {flappy_event.count} starts/stops, "
+             f"but the total number of instances has only changed by {flappy_event.spread}.\n"
+             "Please investigate:\n"
+             "  * Scaling might be configured too aggressively\n"
+             "  * New instances are failing to start\n"
+             "  * Spotinst might be shifting instances between on-demand and spot\n"
+             "  * Host is undersized and failing under load\n %%%",
+        alert_type="warning",
+        aggregation_key=flappy_event.key,
+        tags=flappy_event.tags,
+        attach_host_name=False,
+    )
+
+
+def _create_recovery_event(datadog_client, flappy_event: FlappyEvent) -> Any:
+    return datadog_client.Event.create(
+        title=f"Flappy Detector: {flappy_event.application} stopped flapping in {flappy_event.environment}",
+        text="%%% \nThis application is no longer flapping.\n"
+             f"When last alerted on there had been {flappy_event.count} starts/stops, "
+             f"with the total number of instances changing by {flappy_event.spread}.\n %%%",
+        alert_type="success",
+        aggregation_key=flappy_event.key,
+        tags=flappy_event.tags,
+        attach_host_name=False,
+    )
+
+
+def _has_error(response: Any, matching: Iterable[str]) -> bool:
+    """
+    Whether a Datadog response holds errors.
+    The client returns errors in the response rather than raising them, unless mute is turned off.
+    :param response: The response of a Datadog API call.
+    :param matching: Lowercase fragments of the errors to look for, empty to match any error.
+    :return: True if the response holds a matching error.
+    """
+    if not isinstance(response, dict) or not response.get("errors"):
+        return False
+
+    errors = str(response["errors"]).lower()
+    return not matching or any(fragment in errors for fragment in matching)
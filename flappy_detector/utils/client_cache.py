@@ -0,0 +1,127 @@
+"""Cache of boto3 clients for assumed roles"""
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from typing import Any, Dict, NamedTuple, Tuple, TYPE_CHECKING
+
+import boto3
+from amplify_aws_utils.resource_helper import throttled_call
+
+if TYPE_CHECKING:
+    import botostubs
+
+logger = logging.getLogger(__name__)
+
+
+class _CacheEntry(NamedTuple):
+    value: Any
+    expires_at: datetime
+
+
+class AssumedRoleClientCache:
+    """
+    Builds boto3 clients from assumed-role credentials, reusing them until just before the credentials expire.
+
+    Kept at module level in a Lambda, the cache lives as long as the warm container, so repeat invocations
+    skip both the AssumeRole call and building the client.
+    """
+
+    def __init__(
+            self,
+            sts_client: botostubs.STS,
+            role_session_name: str = "flappy_detector",
+            expiry_margin: timedelta = timedelta(minutes=5),
+    ):
+        """
+        :param sts_client: Boto3 STS client used to assume roles.
+        :param role_session_name: Session name used when assuming roles.
+        :param expiry_margin: How long before the credentials expire to stop using them.
+        """
+        self.sts_client = sts_client
+        self.role_session_name = role_session_name
+        self.expiry_margin = expiry_margin
+        self.hits = 0
+        self.misses = 0
+        self._credentials: Dict[Tuple[str, str], _CacheEntry] = {}
+        self._clients: Dict[Tuple[str, str, str, str], _CacheEntry] = {}
+        self._lock = Lock()
+
+    def get_boto3_client_for_account(
+            self,
+            account_id: str,
+            role_name: str,
+            client_name: str,
+            region_name: str,
+    ):
+        """
+        Get a boto3 client for the given account, assuming the role only if no cached client is still valid.
+        :param account_id: The account to build the client for.
+        :param role_name: The name of the role to assume in the account.
+        :param client_name: The name of the boto3 client, such as ec2.
+        :param region_name: The region to build the client for.
+        :return: The boto3 client.
+        """
+        key = (account_id, role_name, region_name, client_name)
+        with self._lock:
+            entry = self._get_valid(self._clients, key)
+            if entry:
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+
+        credentials = self._get_credentials(account_id=account_id, role_name=role_name)
+        # A session per client since building clients from the shared default session isn't thread safe
+        client = boto3.session.Session(
+            aws_access_key_id=credentials.value["AccessKeyId"],
+            aws_secret_access_key=credentials.value["SecretAccessKey"],
+            aws_session_token=credentials.value["SessionToken"],
+        ).client(client_name, region_name=region_name)
+
+        with self._lock:
+            self._clients[key] = _CacheEntry(value=client, expires_at=credentials.expires_at)
+
+        return client
+
+    def reset_stats(self):
+        """Reset the hit and miss counters"""
+        self.hits = 0
+        self.misses = 0
+
+    def _get_credentials(self, account_id: str, role_name: str) -> _CacheEntry:
+        """
+        Get credentials for the role, shared by the clients of every region.
+        :param account_id: The account the role is in.
+        :param role_name: The name of the role to assume.
+        :return: Cache entry of the credentials, expiring when the credentials do less the expiry margin.
+        """
+        key = (account_id, role_name)
+        with self._lock:
+            entry = self._get_valid(self._credentials, key)
+            if entry:
+                return entry
+
+        credentials = throttled_call(
+            self.sts_client.assume_role,
+            RoleArn=f"arn:aws:iam::{account_id}:role/{role_name}",
+            RoleSessionName=self.role_session_name,
+        )["Credentials"]
+        entry = _CacheEntry(
+            value=credentials,
+            expires_at=credentials["Expiration"] - self.expiry_margin,
+        )
+
+        with self._lock:
+            self._credentials[key] = entry
+
+        return entry
+
+    @staticmethod
+    def _get_valid(cache: Dict, key: Tuple) -> Any:
+        entry = cache.get(key)
+        if entry and entry.expires_at > datetime.now(timezone.utc):
+            return entry
+
+        cache.pop(key, None)
+        return None
@@ -0,0 +1,318 @@
+"""
+Columnar group-by of ingested records, summing each group's count and spread with NumPy.
+
+NumPy is optional, this module is only imported when the detector's numpy engine is chosen.
+"""
+import logging
+from itertools import islice, repeat
+from operator import itemgetter, methodcaller
+from typing import Any, Dict, Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.enum import Ec2State
+
+logger = logging.getLogger(__name__)
+
+# Number of records dictionary-encoded and summed at a time
+CHUNK_SIZE = 10000
+# Change in host count of each known state, by value and by member as Ec2State accepts either.
+# Unknown states are encoded as 0
+STATE_CHANGES = {
+    **{state.value: state.change for state in Ec2State},
+    **{state: state.change for state in Ec2State},
+}
+
+# Group code of records that can't be grouped
+UNGROUPED = -1
+
+_get_key_attributes = itemgetter(*FlappyEvent.KEY_ATTRIBUTES)
+_get_state = methodcaller("get", "state")
+_get_team = methodcaller("get", "team")
+
+
+class _Chunk(NamedTuple):
+    """A chunk of records dictionary-encoded into integer columns"""
+    groups: List[int]
+    changes: List[int]
+    teams: List[int]
+    # The states that aren't known, and the records that can't be grouped, by position in the chunk
+    unknown_states: Dict[int, Any]
+    malformed_events: Dict[int, Dict[str, Any]]
+
+
+class _Groups:
+    """Running count, spread and team of each group, summed a chunk of records at a time"""
+
+    def __init__(self):
+        self.group_codes: Dict[Any, int] = {}
+        self.team_codes: Dict[Any, int] = {None: 0}
+        self.truthy_teams: List[bool] = [False]
+        self.number_of_events = 0
+        # Position of each group's first record with a known state, -1 until it has one
+        self.first = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.spreads = np.zeros(0, dtype=np.int64)
+        self.teams = np.zeros(0, dtype=np.int64)
+        # Whether each group's team is the first set on its records, rather than its last record's so far
+        self.team_set = np.zeros(0, dtype=bool)
+        self.malformed = np.zeros(0, dtype=bool)
+
+    def add_events(self, events: Iterable[Dict[str, Any]]):
+        """
+        Sum records a chunk at a time.
+        :param events: Iterable of DynamoDB records.
+        """
+        events = iter(events)
+        while True:
+            chunk = list(islice(events, CHUNK_SIZE))
+            if not chunk:
+                return
+            self.add_chunk(chunk)
+
+    def add_chunk(self, chunk: List[Dict[str, Any]]):
+        """
+        Encode a chunk of records and add them to their groups.
+        :param chunk: DynamoDB records.
+        """
+        columns = self._encode_chunk(chunk)
+        self._grow()
+
+        groups = np.array(columns.groups, dtype=np.int64)
+        changes = np.array(columns.changes, dtype=np.int64)
+        teams = np.array(columns.teams, dtype=np.int64)
+        positions = np.arange(self.number_of_events, self.number_of_events + len(groups))
+        self.number_of_events += len(groups)
+
+        skipped = groups == UNGROUPED
+        skipped[~skipped] = self.malformed[groups[~skipped]]
+        self._log_skipped(columns=columns, skipped=skipped, changes=changes)
+
+        known = ~skipped & (changes != 0)
+        first = _first_per_group(groups[known], positions[known], len(self.first))
+        starting = self.first < 0
+        self.first[starting] = first[starting]
+
+        # Each group's records from its first with a known state onwards
+        counted = np.flatnonzero(~skipped)
+        starts = self.first[groups[counted]]
+        counted = counted[(starts >= 0) & (positions[counted] >= starts)]
+        counted_groups = groups[counted]
+        self.counts += np.bincount(counted_groups, minlength=len(self.counts))
+        self.spreads += np.bincount(
+            counted_groups,
+            weights=changes[counted],
+            minlength=len(self.spreads),
+        ).astype(np.int64)
+        self._add_teams(groups=counted_groups, teams=teams[counted])
+
+    def _encode_chunk(self, chunk: List[Dict[str, Any]]) -> _Chunk:
+        """
+        Dictionary-encode a chunk of records.
+        :param chunk: DynamoDB records.
+        :return: The encoded chunk.
+        """
+        try:
+            # Looked up with map so the per record work stays in C, only new values are encoded in Python
+            groups = self._encode(self.group_codes, list(map(_get_key_attributes, chunk)))
+            states = list(map(_get_state, chunk))
+            changes = list(map(STATE_CHANGES.get, states, repeat(0)))
+            teams = self._encode(self.team_codes, list(map(_get_team, chunk)))
+        except TypeError:
+            # Encoded one at a time so only the records with unhashable attributes are singled out
+            columns = _Chunk(groups=[], changes=[], teams=[], unknown_states={}, malformed_events={})
+            for event in chunk:
+                self._encode_event(columns, event)
+            return columns
+
+        unknown_states = {
+            position: state
+            for position, (state, change) in enumerate(zip(states, changes))
+            if not change
+        } if 0 in changes else {}
+
+        return _Chunk(
+            groups=groups,
+            changes=changes,
+            teams=teams,
+            unknown_states=unknown_states,
+            malformed_events={},
+        )
+
+    @staticmethod
+    def _encode(codes: Dict[Any, int], values: List[Any]) -> List[int]:
+        """
+        Dictionary-encode values, adding a code for each value not seen before.
+        :param codes: Code of each value seen so far.
+        :param values: The values to encode.
+        :return: The code of each value.
+        """
+        encoded: List[Any] = list(map(codes.get, values))
+        if None in encoded:
+            for position, code in enumerate(encoded):
+                if code is None:
+                    encoded[position] = codes.setdefault(values[position], len(codes))
+
+        return encoded
+
+    def _encode_event(self, columns: _Chunk, event: Dict[str, Any]):
+        """
+        Encode a single record onto the end of a chunk.
+        Records with unhashable key attributes can't be grouped, unhashable states are unknown and unhashable
+        teams are ignored.
+        :param columns: The chunk encoded so far.
+        :param event: DynamoDB record.
+        """
+        position = len(columns.groups)
+        key = _get_key_attributes(event)
+        state = _get_state(event)
+        try:
+            group = self.group_codes.setdefault(key, len(self.group_codes))
+        except TypeError:
+            group = UNGROUPED
+            columns.malformed_events[position] = event
+
+        try:
+            change = STATE_CHANGES.get(state, 0)
+        except TypeError:
+            change = 0
+        if not change:
+            columns.unknown_states[position] = state
+
+        try:
+            team = self.team_codes.setdefault(_get_team(event), len(self.team_codes))
+        except TypeError:
+            team = 0
+
+        columns.groups.append(group)
+        columns.changes.append(change)
+        columns.teams.append(team)
+
+    def _grow(self):
+        """Make room for the groups and teams first seen in the last chunk"""
+        self.truthy_teams.extend(bool(team) for team in islice(self.team_codes, len(self.truthy_teams), None))
+
+        new_key_attributes = list(islice(self.group_codes, len(self.first), None))
+        if not new_key_attributes:
+            return
+
+        padding = np.zeros(len(new_key_attributes), dtype=np.int64)
+        self.first = np.concatenate([self.first, padding - 1])
+        self.counts = np.concatenate([self.counts, padding])
+        self.spreads = np.concatenate([self.spreads, padding])
+        self.teams = np.concatenate([self.teams, padding])
+        self.team_set = np.concatenate([self.team_set, padding.astype(bool)])
+        self.malformed = np.concatenate([self.malformed, _find_malformed(new_key_attributes)])
+
+    def _log_skipped(self, columns: _Chunk, skipped: np.ndarray, changes: np.ndarray):
+        """
+        Log the records that can't be grouped, and those with an unknown state, as the detector's loop does.
+        :param columns: The encoded chunk.
+        :param skipped: Whether each record of the chunk can't be grouped.
+        :param changes: Change in host count of each record of the chunk.
+        """
+        positions = np.flatnonzero(skipped).tolist()
+        key_attributes = list(self.group_codes) if positions else []
+        for position in positions:
+            logger.error(
+                "Could not handle event",
+                extra={
+                    "event": columns.malformed_events.get(position) or dict(
+                        zip(FlappyEvent.KEY_ATTRIBUTES, key_attributes[columns.groups[position]])
+                    ),
+                }
+            )
+
+        for position in np.flatnonzero(~skipped & (changes == 0)).tolist():
+            logger.error(
+                "Could not handle unknown state=%s",
+                columns.unknown_states[position],
+                extra={
+                    "state": columns.unknown_states[position],
+                }
+            )
+
+    def _add_teams(self, groups: np.ndarray, teams: np.ndarray):
+        """
+        Update the team of each group from its counted records in a chunk.
+        Groups take the first team set on their records, or else whatever their last record held.
+        :param groups: Group code of each counted record.
+        :param teams: Team code of each counted record, in the order of the records.
+        """
+        indices = np.arange(len(groups))
+        with_team = np.array(self.truthy_teams, dtype=bool)[teams]
+        team_indices = _first_per_group(groups[with_team], indices[with_team], len(self.teams))
+        last_indices = _first_per_group(groups[::-1], indices[::-1], len(self.teams))
+
+        # Without any team set, the loop leaves the group with whatever its last record held
+        unset = ~self.team_set & (last_indices >= 0)
+        self.teams[unset] = teams[last_indices[unset]]
+        found = ~self.team_set & (team_indices >= 0)
+        self.teams[found] = teams[team_indices[found]]
+        self.team_set |= found
+
+    def get_flappy_events(self) -> List[FlappyEvent]:
+        """
+        Build the FlappyEvent of each group with a counted record, in the order the groups started.
+        :return: List of FlappyEvents, one per group.
+        """
+        key_attributes: List[Tuple[Any, ...]] = list(self.group_codes)
+        team_values = list(self.team_codes)
+        started = np.flatnonzero(self.first >= 0)
+        return [
+            FlappyEvent(
+                **dict(zip(FlappyEvent.KEY_ATTRIBUTES, key_attributes[code])),
+                team=team_values[self.teams[code]],
+                count=int(self.counts[code]),
+                spread=int(self.spreads[code]),
+            )
+            for code in started[np.argsort(self.first[started], kind="stable")].tolist()
+        ]
+
+
+def _first_per_group(groups: np.ndarray, positions: np.ndarray, number_of_groups: int) -> np.ndarray:
+    """
+    Find the first of the given positions in each group.
+    :param groups: Group code of each position.
+    :param positions: The positions, the first of each group is the earliest in this order.
+    :param number_of_groups: Number of group codes.
+    :return: The first position of each group, -1 for groups without any.
+    """
+    first = np.full(number_of_groups, -1, dtype=np.int64)
+    # Assigning to a repeated index leaves the last value assigned, so assign in reverse
+    first[groups[::-1]] = positions[::-1]
+    return first
+
+
+def _find_malformed(key_attributes: List[Tuple[Any, ...]]) -> np.ndarray:
+    """
+    Find the groups whose key attributes can't be joined into a key, all their records are skipped.
+    :param key_attributes: The key attributes of each group.
+    :return: Whether each group is malformed.
+    """
+    malformed = np.zeros(len(key_attributes), dtype=bool)
+    for code, attributes in enumerate(key_attributes):
+        try:
+            FlappyEvent.get_key(attributes)
+        except TypeError:
+            malformed[code] = True
+
+    return malformed
+
+
+def group_events(events: Iterable[Dict[str, Any]]) -> List[FlappyEvent]:
+    """
+    Sum the given events by group, giving the same FlappyEvents in the same order as the detector's loop.
+
+    Group keys and teams are dictionary-encoded and states mapped to their change a chunk at a time, then
+    each chunk's counts and spreads are added to running per group totals with vectorized group-bys, so
+    memory grows with the number of groups rather than records. As in the loop, a group starts at its first
+    record with a known state, and takes the first team set on its records from then on. Unlike the loop,
+    records without a state are counted as having an unknown one rather than failing the run.
+    :param events: Iterable of DynamoDB records.
+    :return: List of FlappyEvents, one per group.
+    """
+    groups = _Groups()
+    groups.add_events(events)
+    return groups.get_flappy_events()
@@ -0,0 +1,232 @@
+"""Helpers for reading from and writing to DynamoDB"""
+from __future__ import annotations
+
+import copy
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from queue import Full, Queue
+from threading import Event
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, TYPE_CHECKING
+
+from amplify_aws_utils.resource_helper import throttled_call
+
+if TYPE_CHECKING:
+    import botostubs
+
+logger = logging.getLogger(__name__)
+
+# The most items DynamoDB accepts in a single BatchWriteItem request
+BATCH_WRITE_SIZE = 25
+# How long a blocked thread waits before checking whether it should give up
+_POLL_INTERVAL_IN_SECS = 0.1
+_SEGMENT_DONE = object()
+
+
+def build_projection(attributes: Iterable[str]) -> Dict[str, Any]:
+    """
+    Build the arguments for a Scan or Query that only returns the given attributes.
+    Every attribute is aliased, since names like timestamp are reserved words.
+    :param attributes: Names of the attributes to return.
+    :return: The ProjectionExpression and ExpressionAttributeNames arguments.
+    """
+    names = {f"#{attribute}": attribute for attribute in attributes}
+    return {
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+    }
+
+
+def iterate_pages(
+        func: Callable[..., Dict[str, Any]],
+        **kwargs,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Iterate over the pages of a DynamoDB Scan or Query.
+    :param func: The paginated function, such as Table.scan.
+    :param kwargs: Arguments passed through to every call.
+    :return: Iterator of the items of each page.
+    """
+    while True:
+        response = throttled_call(func, **kwargs)
+        yield response["Items"]
+
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if not last_evaluated_key:
+            return
+
+        kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+
+def drop_redelivered(records: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Drop the records of events already read, since ingest writes an event again each time it is redelivered.
+    A redelivered event keeps its event's time, so only the ids of the records sharing the latest timestamp
+    are held. The records must be in timestamp order, as a query of the time index returns them, and records
+    without an event_id are all kept.
+    :param records: Iterable of DynamoDB records, by increasing timestamp.
+    :return: Iterator of the records, once per event.
+    """
+    event_ids: Set[str] = set()
+    timestamp = None
+    duplicates = 0
+    for record in records:
+        if record.get("timestamp") != timestamp:
+            timestamp = record.get("timestamp")
+            event_ids.clear()
+
+        event_id = record.get("event_id")
+        if event_id:
+            if event_id in event_ids:
+                duplicates += 1
+                continue
+            event_ids.add(event_id)
+
+        yield record
+
+    if duplicates:
+        logger.info(
+            "Dropped %s redelivered records",
+            duplicates,
+            extra={"duplicates": duplicates},
+        )
+
+
+def parallel_scan(
+        get_scan: Callable[[], Callable[..., Dict[str, Any]]],
+        total_segments: int,
+        max_workers: Optional[int] = None,
+        **kwargs,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Scan a table using DynamoDB's parallel scan, yielding items from each segment as their pages arrive.
+
+    boto3's resources aren't thread safe. Their condition expression builder is shared between calls, and
+    ExpressionAttributeNames is updated in place, so concurrent scans through one Table can send clashing
+    placeholders. Each segment gets its own scan function, from its own thread, and its own copy of kwargs.
+    :param get_scan: Called once by each segment's thread for the scan function it uses, such as the scan of
+        a Table from a session of its own.
+    :param total_segments: The number of segments to split the table into.
+    :param max_workers: The number of threads scanning segments. Defaults to one thread per segment.
+    :param kwargs: Arguments passed through to every scan call.
+    :return: Iterator of the scanned items, in no particular order.
+    """
+    # Bounded so segments can't read far ahead of the consumer
+    pages: Queue = Queue(maxsize=total_segments * 2)
+    stopped = Event()
+
+    def put(page):
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=_POLL_INTERVAL_IN_SECS)
+                return
+            except Full:
+                continue
+
+    def scan_segment(segment: int):
+        try:
+            pages_of_segment = iterate_pages(
+                get_scan(),
+                Segment=segment,
+                TotalSegments=total_segments,
+                **copy.deepcopy(kwargs),
+            )
+            for page in pages_of_segment:
+                if stopped.is_set():
+                    return
+                put(page)
+        except Exception as exc:
+            put(exc)
+        else:
+            put(_SEGMENT_DONE)
+
+    with ThreadPoolExecutor(max_workers=max_workers or total_segments) as executor:
+        for segment in range(total_segments):
+            executor.submit(scan_segment, segment)
+
+        try:
+            remaining_segments = total_segments
+            while remaining_segments:
+                page = pages.get()
+                if page is _SEGMENT_DONE:
+                    remaining_segments -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            # Release any segments still scanning, e.g. after an error or if the caller stops early
+            stopped.set()
+
+
+@dataclass
+class BatchWriteResult:
+    """Summary of a batched write"""
+
+    written: int = 0
+    retried: int = 0
+    unprocessed: List[Dict[str, Any]] = field(default_factory=list)
+
+
+class UnprocessedItemsError(Exception):
+    """Raised when some items of a batched write could not be written"""
+
+    def __init__(self, result: BatchWriteResult):
+        super().__init__(f"{len(result.unprocessed)} items could not be written")
+        self.result = result
+
+
+def batch_write(
+        dynamodb_table: botostubs.DynamoDB.DynamodbResource.Table,
+        items: List[Dict[str, Any]],
+        max_attempts: int = 5,
+        base_delay: float = 0.05,
+        max_delay: float = 2.0,
+) -> BatchWriteResult:
+    """
+    Write items using BatchWriteItem, retrying any UnprocessedItems with exponential backoff and jitter.
+    :param dynamodb_table: Table resource to write to.
+    :param items: The items to write.
+    :param max_attempts: The number of times to send each batch before giving up on its unprocessed items.
+    :param base_delay: Seconds to wait before the first retry, doubled on each further retry.
+    :param max_delay: The most seconds to wait between retries.
+    :return: How many items were written and retried, and any items that could not be written.
+    """
+    # botostubs' Table doesn't describe the resource's name and meta
+    table_name: str = dynamodb_table.name  # type: ignore
+    client = dynamodb_table.meta.client  # type: ignore
+
+    result = BatchWriteResult()
+    for start in range(0, len(items), BATCH_WRITE_SIZE):
+        requests = [
+            {"PutRequest": {"Item": item}}
+            for item in items[start:start + BATCH_WRITE_SIZE]
+        ]
+
+        for attempt in range(1, max_attempts + 1):
+            response = throttled_call(
+                client.batch_write_item,
+                RequestItems={table_name: requests},
+            )
+            unprocessed = response.get("UnprocessedItems", {}).get(table_name, [])
+            result.written += len(requests) - len(unprocessed)
+            if not unprocessed:
+                break
+
+            if attempt == max_attempts:
+                result.unprocessed += [request["PutRequest"]["Item"] for request in unprocessed]
+                logger.warning(
+                    "Gave up writing %s items after %s attempts",
+                    len(unprocessed),
+                    attempt,
+                    extra={"table": table_name},
+                )
+                break
+
+            result.retried += len(unprocessed)
+            requests = unprocessed
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+    return result
@@ -0,0 +1,20 @@
+"""Helpers for reading the Lambdas' configuration from the environment"""
+
+# The values distutils' strtobool accepts, without importing distutils and with it setuptools at cold start
+TRUE_VALUES = frozenset({"y", "yes", "t", "true", "on", "1"})
+FALSE_VALUES = frozenset({"n", "no", "f", "false", "off", "0"})
+
+
+def strtobool(value: str) -> bool:
+    """
+    Convert a string representation of truth to a bool.
+    :param value: The string, case insensitive.
+    :return: True for y, yes, t, true, on and 1, False for n, no, f, false, off and 0.
+    """
+    normalized = value.lower()
+    if normalized in TRUE_VALUES:
+        return True
+    if normalized in FALSE_VALUES:
+        return False
+
+    raise ValueError(f"Invalid truth value {value!r}")
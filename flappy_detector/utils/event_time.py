@@ -0,0 +1,27 @@
+"""Helpers for parsing the time of CloudWatch events"""
+import re
+from datetime import datetime, timezone
+
+# The format CloudWatch sends event times in, e.g. 2021-01-30T03:37:55Z
+_EVENT_TIME = re.compile(r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})Z")
+
+
+def parse_event_time(value: str) -> int:
+    """
+    Parse the time of a CloudWatch event.
+    Times in CloudWatch's format are parsed directly, anything else falls back to dateutil's generic parser.
+    :param value: The event's time.
+    :return: Epoch timestamp in whole seconds, the most precise CloudWatch sends.
+    """
+    match = _EVENT_TIME.fullmatch(value)
+    if match:
+        try:
+            year, month, day, hour, minute, second = map(int, match.groups())
+            return int(datetime(year, month, day, hour, minute, second, tzinfo=timezone.utc).timestamp())
+        except ValueError:
+            pass
+
+    # Only imported for the odd time in another format, keeping dateutil out of the Lambda's cold start
+    from dateutil.parser import parse  # pylint: disable=import-outside-toplevel
+
+    return int(parse(value).timestamp())
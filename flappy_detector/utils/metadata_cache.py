@@ -0,0 +1,164 @@
+"""Cache of the standardized tags of EC2 instances"""
+from __future__ import annotations
+
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+from amplify_aws_utils.resource_helper import throttled_call
+
+from flappy_detector.utils.dynamodb import batch_write
+
+if TYPE_CHECKING:
+    import botostubs
+
+logger = logging.getLogger(__name__)
+
+# The most keys DynamoDB accepts in a single BatchGetItem request
+BATCH_GET_SIZE = 100
+
+
+class InstanceMetadataCache:
+    """
+    Caches the standardized tags of instances by account, region and instance id.
+
+    Lookups check an in-process LRU first, then the DynamoDB table if one is given. The table outlives
+    the Lambda container and keeps the tags of instances EC2 no longer describes once terminated.
+
+    Instances are often described before their group tags are added, so tags without a group_name are only
+    cached for ungrouped_ttl, and looked up again once the group is likely tagged.
+    """
+
+    def __init__(
+            self,
+            max_size: int = 10000,
+            ttl: timedelta = timedelta(hours=6),
+            ungrouped_ttl: timedelta = timedelta(minutes=1),
+            dynamodb_table: Optional[botostubs.DynamoDB.DynamodbResource.Table] = None,
+    ):
+        """
+        :param max_size: The most instances to keep in process.
+        :param ttl: How long cached tags are used for.
+        :param ungrouped_ttl: How long cached tags without a group_name are used for.
+        :param dynamodb_table: Table resource for the shared cache keyed by cache_key, None to skip it.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.ungrouped_ttl = ungrouped_ttl
+        self.dynamodb_table = dynamodb_table
+        self._cache: "OrderedDict[Tuple[str, str, str], Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get_many(self, account: str, region: str, instance_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the cached tags of the given instances.
+        :param account: The account of the instances.
+        :param region: The region of the instances.
+        :param instance_ids: The instances to look up.
+        :return: The tags of each instance found in the cache, by instance id.
+        """
+        found: Dict[str, Dict[str, Any]] = {}
+        missing: List[str] = []
+        now = time.time()
+        with self._lock:
+            for instance_id in instance_ids:
+                key = (account, region, instance_id)
+                entry = self._cache.get(key)
+                if entry and entry[1] > now:
+                    self._cache.move_to_end(key)
+                    found[instance_id] = entry[0]
+                else:
+                    missing.append(instance_id)
+
+        if missing and self.dynamodb_table:
+            from_table = self._get_from_table(account=account, region=region, instance_ids=missing)
+            self._put_in_process(account=account, region=region, metadata=from_table)
+            found.update(from_table)
+
+        return found
+
+    def put_many(self, account: str, region: str, metadata: Dict[str, Dict[str, Any]]):
+        """
+        Cache the tags of the given instances.
+        :param account: The account of the instances.
+        :param region: The region of the instances.
+        :param metadata: The tags of each instance, by instance id.
+        """
+        if not metadata:
+            return
+
+        self._put_in_process(account=account, region=region, metadata=metadata)
+
+        if self.dynamodb_table:
+            now = time.time()
+            batch_write(
+                dynamodb_table=self.dynamodb_table,
+                items=[
+                    {
+                        "cache_key": self._get_cache_key(account, region, instance_id),
+                        "metadata": tags,
+                        "expires_at": int(now + self._get_ttl(tags).total_seconds()),
+                    }
+                    for instance_id, tags in metadata.items()
+                ],
+            )
+
+    def _put_in_process(self, account: str, region: str, metadata: Dict[str, Dict[str, Any]]):
+        now = time.time()
+        with self._lock:
+            for instance_id, tags in metadata.items():
+                key = (account, region, instance_id)
+                self._cache[key] = (tags, now + self._get_ttl(tags).total_seconds())
+                self._cache.move_to_end(key)
+
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def _get_from_table(
+            self,
+            account: str,
+            region: str,
+            instance_ids: List[str],
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the tags of the given instances from the shared cache table.
+        Keys DynamoDB leaves unprocessed are treated as misses rather than retried.
+        :param account: The account of the instances.
+        :param region: The region of the instances.
+        :param instance_ids: The instances to look up.
+        :return: The tags of each instance found in the table, by instance id.
+        """
+        # botostubs' Table doesn't describe the resource's name and meta
+        table_name: str = self.dynamodb_table.name  # type: ignore
+        client = self.dynamodb_table.meta.client  # type: ignore
+
+        found = {}
+        now = time.time()
+        for start in range(0, len(instance_ids), BATCH_GET_SIZE):
+            response = throttled_call(
+                client.batch_get_item,
+                RequestItems={
+                    table_name: {
+                        "Keys": [
+                            {"cache_key": self._get_cache_key(account, region, instance_id)}
+                            for instance_id in instance_ids[start:start + BATCH_GET_SIZE]
+                        ],
+                    },
+                },
+            )
+            for item in response["Responses"].get(table_name, []):
+                # Expired items may not have been deleted by the table's TTL yet
+                if item["expires_at"] > now:
+                    found[item["cache_key"].rsplit(":", 1)[1]] = item["metadata"]
+
+        return found
+
+    def _get_ttl(self, tags: Dict[str, Any]) -> timedelta:
+        return self.ttl if tags.get("group_name") else self.ungrouped_ttl
+
+    @staticmethod
+    def _get_cache_key(account: str, region: str, instance_id: str) -> str:
+        return f"{account}:{region}:{instance_id}"
@@ -0,0 +1,115 @@
+"""Helpers for publishing the flappiness of every group as Datadog metrics"""
+import heapq
+import logging
+import time
+from typing import Any, Dict, List
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.alerting import RETRYABLE_EXCEPTIONS, _has_error
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "flappy_detector"
+
+
+class MetricSender:
+    """
+    Sends the count, spread and flap ratio of each group as gauges, batched into as few requests as possible.
+
+    Only the most active groups are sent, capping the number of series each run adds to Datadog.
+    """
+
+    def __init__(
+            self,
+            datadog_client,
+            batch_size: int = 500,
+            max_groups: int = 1000,
+    ):
+        """
+        :param datadog_client: Datadog API Client.
+        :param batch_size: The most series sent in one request.
+        :param max_groups: The most groups sent each run, those with the most events are kept.
+        """
+        self.datadog_client = datadog_client
+        self.batch_size = batch_size
+        self.max_groups = max_groups
+
+    def send(self, flappy_events: List[FlappyEvent]) -> int:
+        """
+        Send the metrics of each group.
+        Failures are logged rather than raised, so they never hold up alerting.
+        :param flappy_events: The FlappyEvents of every group, flapping or not.
+        :return: How many series were sent.
+        """
+        if len(flappy_events) > self.max_groups:
+            logger.warning(
+                "Sending metrics for %s of %s groups",
+                self.max_groups,
+                len(flappy_events),
+            )
+            flappy_events = heapq.nlargest(self.max_groups, flappy_events, key=lambda event: event.count)
+
+        series = get_series(flappy_events=flappy_events, timestamp=int(time.time()))
+        sent = 0
+        for start in range(0, len(series), self.batch_size):
+            batch = series[start:start + self.batch_size]
+            try:
+                response = self.datadog_client.Metric.send(
+                    metrics=batch,
+                    attach_host_name=False,
+                    compress_payload=True,
+                )
+            except RETRYABLE_EXCEPTIONS as exc:
+                response = {"errors": [str(exc)]}
+
+            if _has_error(response, ()):
+                logger.error(
+                    "Could not send %s metric series",
+                    len(batch),
+                    extra={"errors": response["errors"]},
+                )
+                continue
+
+            sent += len(batch)
+
+        logger.info("Sent %s metric series for %s groups", sent, len(flappy_events))
+        return sent
+
+
+def get_series(flappy_events: List[FlappyEvent], timestamp: int) -> List[Dict[str, Any]]:
+    """
+    Build the gauge series of each group.
+    :param flappy_events: The FlappyEvents of the groups.
+    :param timestamp: Epoch timestamp of the points.
+    :return: List of series as accepted by Metric.send.
+    """
+    series = []
+    for flappy_event in flappy_events:
+        tags = flappy_event.tags
+        for name, value in (
+                ("count", flappy_event.count),
+                ("spread", flappy_event.spread),
+                ("flap_ratio", get_flap_ratio(flappy_event)),
+        ):
+            series.append(
+                {
+                    "metric": f"{METRIC_PREFIX}.{name}",
+                    "type": "gauge",
+                    "points": [(timestamp, value)],
+                    "tags": tags,
+                }
+            )
+
+    return series
+
+
+def get_flap_ratio(flappy_event: FlappyEvent) -> float:
+    """
+    The share of a group's starts and stops that cancelled each other out.
+    :param flappy_event: The FlappyEvent of the group.
+    :return: 1.0 when the host count ended where it started, 0.0 when every event moved it the same way.
+    """
+    if not flappy_event.count:
+        return 0.0
+
+    return (flappy_event.count - abs(flappy_event.spread)) / flappy_event.count
@@ -0,0 +1,371 @@
+"""
+Replay of exported EC2 records through the detector's logic, to evaluate thresholds against history offline.
+
+Exports are split into chunks read by worker processes, each folding its records into per group buckets the
+way the detector's snapshot does. The buckets are then sharded by group key, and each shard is merged and
+evaluated window by window, as the scheduled detector would have evaluated it.
+
+Ingest writes a record again each time its event is redelivered, so each chunk also keeps the event_ids it
+counted for each group. Events counted by an earlier chunk of the shard are taken back out as it is merged.
+"""
+import csv
+import gzip
+import json
+import logging
+import os
+import zlib
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from decimal import Decimal
+from itertools import accumulate
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from boto3.dynamodb.types import TypeDeserializer
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.snapshot import DetectionSnapshot, GroupState, get_event_change
+from flappy_detector.utils.time_bucket import ROLLUP_BUCKET_SIZE_IN_SECS, get_time_bucket
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("jsonl", "csv")
+
+
+@dataclass
+class ExportChunk:
+    """A byte range of an export file, holding the lines starting within it"""
+
+    path: str
+    export_format: str
+    start: int = 0
+    end: Optional[int] = None
+
+
+@dataclass
+class ChunkGroup:
+    """A group's buckets from one chunk, along with the events counted in them"""
+
+    state: GroupState
+    # The time bucket, change in host count and whether the state is known of each event, by event_id
+    events: Dict[str, Tuple[int, int, int]] = field(default_factory=dict)
+
+
+@dataclass
+class ReplayConfig:
+    """The detector's thresholds, along with how often it is run"""
+
+    max_event_age_in_secs: int
+    min_number_of_events: int
+    min_spread: int
+    step_in_secs: int
+    bucket_size: int = ROLLUP_BUCKET_SIZE_IN_SECS
+
+
+def get_export_format(path: str) -> str:
+    """
+    Guess the format of an export file from its name.
+    :param path: Path to the export file, optionally gzipped.
+    :return: One of EXPORT_FORMATS.
+    """
+    name = path[:-len(".gz")] if path.endswith(".gz") else path
+    return "csv" if name.endswith(".csv") else "jsonl"
+
+
+def get_chunks(
+        paths: Iterable[str],
+        chunk_size: int,
+        export_format: Optional[str] = None,
+) -> List[ExportChunk]:
+    """
+    Split export files into chunks of roughly equal size. Gzipped files can't be split, so are one chunk each.
+    :param paths: Paths to the export files.
+    :param chunk_size: Number of bytes per chunk.
+    :param export_format: One of EXPORT_FORMATS, None to guess each file's from its name.
+    :return: List of chunks, in file order.
+    """
+    chunks = []
+    for path in paths:
+        file_format = export_format or get_export_format(path)
+        if path.endswith(".gz"):
+            chunks.append(ExportChunk(path=path, export_format=file_format))
+            continue
+
+        size = os.path.getsize(path)
+        chunks.extend(
+            ExportChunk(path=path, export_format=file_format, start=start, end=min(start + chunk_size, size))
+            for start in range(0, max(size, 1), chunk_size)
+        )
+
+    return chunks
+
+
+def read_lines(chunk: ExportChunk) -> Iterator[str]:
+    """
+    Read the lines starting within a chunk.
+    :param chunk: The chunk to read.
+    :return: Iterator of the decoded lines, header included for the first chunk of a file.
+    """
+    if chunk.end is None:
+        with _open_text(chunk.path) as lines:
+            yield from lines
+        return
+
+    with open(chunk.path, "rb") as export_file:
+        if chunk.start:
+            # The line running over the start belongs to the previous chunk
+            export_file.seek(chunk.start - 1)
+            export_file.readline()
+
+        while export_file.tell() < chunk.end:
+            line = export_file.readline()
+            if not line:
+                return
+            yield line.decode("utf-8")
+
+
+def _open_text(path: str):
+    return gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8")
+
+
+def read_header(path: str) -> List[str]:
+    """
+    Read the column names of a CSV export.
+    :param path: Path to the export file, optionally gzipped.
+    :return: The column names.
+    """
+    with _open_text(path) as lines:
+        return next(csv.reader(lines))
+
+
+def parse_records(chunk: ExportChunk) -> Iterator[Dict[str, Any]]:
+    """
+    Parse the records of a chunk.
+    JSON lines may hold plain records, or items in DynamoDB JSON under "Item" as DynamoDB exports write them.
+    CSV rows must each be on a single line.
+    :param chunk: The chunk to read.
+    :return: Iterator of records, with numbers as Decimals like the ones read from DynamoDB.
+    """
+    lines = read_lines(chunk)
+    if chunk.export_format == "csv":
+        header = read_header(chunk.path)
+        if not chunk.start:
+            next(lines, None)
+
+        for row in csv.DictReader(lines, fieldnames=header):
+            yield {
+                **row,
+                "timestamp": Decimal(row["timestamp"]),
+            }
+        return
+
+    deserializer = TypeDeserializer()
+    for line in lines:
+        if not line.strip():
+            continue
+
+        record = json.loads(line, parse_float=Decimal)
+        if isinstance(record.get("Item"), dict):
+            record = {name: deserializer.deserialize(value) for name, value in record["Item"].items()}
+
+        yield record
+
+
+def get_shard(key: str, shards: int) -> int:
+    """
+    Get the shard of a group, the same in every process unlike hash().
+    :param key: The key of the group.
+    :param shards: Number of shards.
+    :return: The group's shard.
+    """
+    return zlib.crc32(key.encode()) % shards
+
+
+def bucket_chunk(chunk: ExportChunk, bucket_size: int, shards: int) -> List[Dict[str, ChunkGroup]]:
+    """
+    Fold the records of a chunk into per group buckets, counting each event of a group once.
+    :param chunk: The chunk to read.
+    :param bucket_size: Size of each time bucket in seconds.
+    :param shards: Number of shards to split the groups into.
+    :return: The groups of each shard, by key.
+    """
+    snapshot = DetectionSnapshot(watermark=0, bucket_size=bucket_size)
+    events: Dict[str, Dict[str, Tuple[int, int, int]]] = {}
+    for record in parse_records(chunk):
+        event_id = record.get("event_id")
+        try:
+            key = FlappyEvent.get_key(record[attribute] for attribute in FlappyEvent.KEY_ATTRIBUTES)
+        except (KeyError, TypeError):
+            key = None
+
+        if event_id and key:
+            group_events = events.setdefault(key, {})
+            if event_id in group_events:
+                continue
+            time_bucket = get_time_bucket(record["timestamp"], bucket_size)
+            group_events[event_id] = (time_bucket, *get_event_change(record))
+
+        snapshot.add_event(record)
+
+    sharded_groups: List[Dict[str, ChunkGroup]] = [{} for _ in range(shards)]
+    for key, group in snapshot.groups.items():
+        sharded_groups[get_shard(key, shards)][key] = ChunkGroup(state=group, events=events.get(key, {}))
+
+    return sharded_groups
+
+
+def merge_groups(partial_groups: Iterable[Dict[str, ChunkGroup]]) -> Dict[str, GroupState]:
+    """
+    Merge the groups bucketed from each chunk, taking out the events an earlier chunk already counted.
+    :param partial_groups: The groups of each chunk, by key, in chunk order.
+    :return: The merged groups, by key.
+    """
+    groups: Dict[str, GroupState] = {}
+    event_ids: Dict[str, Set[str]] = {}
+    for partial in partial_groups:
+        for key, partial_group in partial.items():
+            _drop_counted(partial_group=partial_group, event_ids=event_ids.setdefault(key, set()))
+            group = groups.get(key)
+            if not group:
+                groups[key] = partial_group.state
+                continue
+
+            if not group.team:
+                group.team = partial_group.state.team
+
+            for time_bucket, (count, spread, known) in partial_group.state.buckets.items():
+                bucket = group.buckets.setdefault(time_bucket, [0, 0, 0])
+                bucket[0] += count
+                bucket[1] += spread
+                bucket[2] += known
+
+    return groups
+
+
+def _drop_counted(partial_group: ChunkGroup, event_ids: Set[str]):
+    """
+    Take the events already counted out of a group's buckets from one chunk.
+    :param partial_group: The group's buckets from the chunk.
+    :param event_ids: The ids of the group's events counted so far, updated with the chunk's.
+    """
+    for event_id, (time_bucket, change, known) in partial_group.events.items():
+        if event_id in event_ids:
+            bucket = partial_group.state.buckets[time_bucket]
+            bucket[0] -= 1
+            bucket[1] -= change
+            bucket[2] -= known
+        event_ids.add(event_id)
+
+
+def find_flapping_periods(group: GroupState, config: ReplayConfig) -> List[Dict[str, Any]]:
+    """
+    Evaluate a group at every run of the detector that would have seen its records.
+    :param group: The group's buckets.
+    :param config: The thresholds and schedule to evaluate with.
+    :return: Each period the group was flapping for, with when it was first and last seen flapping.
+    """
+    flappy_event = group.get_flappy_event()
+    time_buckets = sorted(group.buckets)
+    counts = [0, *accumulate(group.buckets[time_bucket][0] for time_bucket in time_buckets)]
+    spreads = [0, *accumulate(group.buckets[time_bucket][1] for time_bucket in time_buckets)]
+    knowns = [0, *accumulate(group.buckets[time_bucket][2] for time_bucket in time_buckets)]
+
+    periods: List[Dict[str, Any]] = []
+    period: Optional[Dict[str, Any]] = None
+    # The first run after the group's first record, until the last run whose window reaches its last one
+    run_at = (time_buckets[0] // config.step_in_secs + 1) * config.step_in_secs
+    cut_off_bucket = get_time_bucket(run_at - config.max_event_age_in_secs, config.bucket_size)
+    while cut_off_bucket <= time_buckets[-1]:
+        start = bisect_left(time_buckets, cut_off_bucket)
+        end = bisect_left(time_buckets, run_at)
+        flappy_event.count = counts[end] - counts[start]
+        flappy_event.spread = spreads[end] - spreads[start]
+
+        # As in the detector's loop, a window without any record with a known state isn't evaluated
+        if knowns[end] > knowns[start] and flappy_event.is_flapping(
+                min_number_of_events=config.min_number_of_events,
+                min_spread=config.min_spread,
+        ):
+            if not period:
+                period = {
+                    **dict(zip(FlappyEvent.KEY_ATTRIBUTES, group.attributes)),
+                    "team": flappy_event.team,
+                    "key": flappy_event.key,
+                    "first_flapping_at": run_at,
+                    "runs": 0,
+                    "max_count": 0,
+                }
+                periods.append(period)
+
+            period["last_flapping_at"] = run_at
+            period["runs"] += 1
+            period["max_count"] = max(period["max_count"], flappy_event.count)
+        else:
+            period = None
+
+        run_at += config.step_in_secs
+        cut_off_bucket = get_time_bucket(run_at - config.max_event_age_in_secs, config.bucket_size)
+
+    return periods
+
+
+def evaluate_shard(
+        partial_groups: Sequence[Dict[str, ChunkGroup]],
+        config: ReplayConfig,
+) -> List[Dict[str, Any]]:
+    """
+    Merge the groups of a shard and evaluate them.
+    :param partial_groups: The shard's groups from each chunk, in chunk order.
+    :param config: The thresholds and schedule to evaluate with.
+    :return: Each period a group of the shard was flapping for.
+    """
+    return [
+        period
+        for group in merge_groups(partial_groups).values()
+        for period in find_flapping_periods(group=group, config=config)
+    ]
+
+
+def _bucket_chunk(args) -> List[Dict[str, ChunkGroup]]:
+    return bucket_chunk(*args)
+
+
+def _evaluate_shard(args) -> List[Dict[str, Any]]:
+    return evaluate_shard(*args)
+
+
+def replay(chunks: List[ExportChunk], config: ReplayConfig, workers: int = 1) -> List[Dict[str, Any]]:
+    """
+    Replay the records of the given chunks through the detector.
+    :param chunks: The chunks of the export files.
+    :param config: The thresholds and schedule to evaluate with.
+    :param workers: Number of worker processes, 1 to replay in this process.
+    :return: Each period a group was flapping for, in the order they started.
+    """
+    if workers > 1:
+        with Pool(processes=workers) as pool:
+            periods = _map_reduce(chunks=chunks, config=config, shards=workers, map_function=pool.imap)
+    else:
+        periods = _map_reduce(chunks=chunks, config=config, shards=1, map_function=map)
+
+    return sorted(periods, key=lambda period: (period["first_flapping_at"], period["key"]))
+
+
+def _map_reduce(
+        chunks: List[ExportChunk],
+        config: ReplayConfig,
+        shards: int,
+        map_function: Callable,
+) -> List[Dict[str, Any]]:
+    shard_groups: List[List[Dict[str, ChunkGroup]]] = [[] for _ in range(shards)]
+    bucket_args = [(chunk, config.bucket_size, shards) for chunk in chunks]
+    for sharded_groups in map_function(_bucket_chunk, bucket_args):
+        for shard, groups in enumerate(sharded_groups):
+            shard_groups[shard].append(groups)
+
+    logger.info("Bucketed %s chunks into %s shards", len(chunks), shards)
+    return [
+        period
+        for periods in map_function(_evaluate_shard, [(groups, config) for groups in shard_groups])
+        for period in periods
+    ]
@@ -0,0 +1,179 @@
+"""
+Rule sets evaluating each group over several windows, with thresholds overridden per application or team.
+"""
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.snapshot import GroupState
+from flappy_detector.utils.time_bucket import ROLLUP_BUCKET_SIZE_IN_SECS, get_time_bucket
+
+
+@dataclass(frozen=True)
+class Rule:
+    """Thresholds a group is flapping at, over the given window"""
+
+    window: timedelta
+    min_number_of_events: int
+    min_spread: int
+
+
+class RuleIndex:
+    """
+    The rules of every group, looked up by the group's application, else its team, else the defaults.
+
+    Each rule set is sorted by window once when the index is built, so looking up a group's rules is one or
+    two dict lookups, and its buckets are swept once whatever the number of windows.
+
+    Buckets hold sums rather than records, so each window starts at the start of the bucket its cut off falls
+    in, as the snapshot's and the stream's windows do. A window can take in up to one bucket, five minutes,
+    more than it's configured for.
+    """
+
+    def __init__(
+            self,
+            default: Sequence[Rule],
+            applications: Optional[Dict[str, Sequence[Rule]]] = None,
+            teams: Optional[Dict[str, Sequence[Rule]]] = None,
+    ):
+        """
+        :param default: Rules of the groups without an override.
+        :param applications: Rules overriding the defaults, by application.
+        :param teams: Rules overriding the defaults, by team. Application overrides take precedence.
+        """
+        if not default:
+            raise ValueError("At least one default rule is needed")
+
+        self.default = _compile(default)
+        self.applications: Dict[Optional[str], Tuple[Rule, ...]] = {
+            application: _compile(rules)
+            for application, rules in (applications or {}).items()
+        }
+        self.teams: Dict[Optional[str], Tuple[Rule, ...]] = {
+            team: _compile(rules)
+            for team, rules in (teams or {}).items()
+        }
+        self.max_window = max(
+            rules[-1].window
+            for rules in [self.default, *self.applications.values(), *self.teams.values()]
+        )
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], default: Optional[Sequence[Rule]] = None) -> "RuleIndex":
+        """
+        Build the index from its configuration, as set in FLAPPY_DETECTOR_RULES. For example:
+            {
+                "default": [{"max_event_age_in_mins": 15, "min_num_events": 4, "min_spread": 1}, ...],
+                "applications": {"web": [...]},
+                "teams": {"batch": [...]}
+            }
+        :param config: The rule sets, each a list of rules.
+        :param default: Rules of the groups without an override, when the configuration has none.
+        :return: The RuleIndex.
+        """
+        return cls(
+            default=_parse_rules(config["default"]) if config.get("default") else default or [],
+            applications={
+                application: _parse_rules(rules)
+                for application, rules in config.get("applications", {}).items()
+            },
+            teams={
+                team: _parse_rules(rules)
+                for team, rules in config.get("teams", {}).items()
+            },
+        )
+
+    @classmethod
+    def loads(cls, data: str, default: Optional[Sequence[Rule]] = None) -> "RuleIndex":
+        """
+        Build the index from its JSON configuration.
+        :param data: The JSON configuration, see from_config.
+        :param default: Rules of the groups without an override, when the configuration has none.
+        :return: The RuleIndex.
+        """
+        return cls.from_config(config=json.loads(data), default=default)
+
+    def get_rules(self, application: Optional[str], team: Optional[str]) -> Tuple[Rule, ...]:
+        """
+        Get the rules of a group.
+        :param application: The group's application.
+        :param team: The team owning the group.
+        :return: The group's rules, by increasing window.
+        """
+        return self.applications.get(application) or self.teams.get(team) or self.default
+
+    def find_flapping(self, groups: Iterable[GroupState], now: datetime) -> List[FlappyEvent]:
+        """
+        Evaluate every group against its rules.
+        :param groups: The per group buckets, covering at least the longest window.
+        :param now: The end of every window.
+        :return: List of the flapping FlappyEvents, each with the count and spread of the shortest window
+            it is flapping over. As in the detector's loop, a window without any record with a known state
+            isn't flapping.
+        """
+        flapping_events = []
+        for group in groups:
+            flappy_event = group.get_flappy_event()
+            rules = self.get_rules(application=flappy_event.application, team=flappy_event.team)
+            if _evaluate(flappy_event=flappy_event, buckets=group.buckets, rules=rules, now=now):
+                flapping_events.append(flappy_event)
+
+        return flapping_events
+
+
+def _compile(rules: Sequence[Rule]) -> Tuple[Rule, ...]:
+    if not rules:
+        raise ValueError("Rule sets can't be empty")
+
+    return tuple(sorted(rules, key=lambda rule: rule.window))
+
+
+def _parse_rules(rules: List[Dict[str, Any]]) -> List[Rule]:
+    return [
+        Rule(
+            window=timedelta(minutes=int(rule["max_event_age_in_mins"])),
+            min_number_of_events=int(rule["min_num_events"]),
+            min_spread=int(rule["min_spread"]),
+        )
+        for rule in rules
+    ]
+
+
+def _evaluate(
+        flappy_event: FlappyEvent,
+        buckets: Dict[int, List[int]],
+        rules: Sequence[Rule],
+        now: datetime,
+) -> bool:
+    """
+    Sweep a group's buckets from the newest, checking each rule as the sweep passes its window's cut off.
+    :param flappy_event: The group's FlappyEvent, left with the count and spread of the window it flaps over.
+    :param buckets: The group's count, spread and number of records with a known state by time bucket.
+    :param rules: The group's rules, by increasing window.
+    :param now: The end of every window.
+    :return: Whether the group is flapping over any of its windows.
+    """
+    time_buckets = sorted(buckets, reverse=True)
+    position = count = spread = known = 0
+    for rule in rules:
+        cut_off_bucket = get_time_bucket(
+            (now - rule.window).timestamp(),
+            bucket_size=ROLLUP_BUCKET_SIZE_IN_SECS,
+        )
+        while position < len(time_buckets) and time_buckets[position] >= cut_off_bucket:
+            bucket_count, bucket_spread, bucket_known = buckets[time_buckets[position]]
+            count += bucket_count
+            spread += bucket_spread
+            known += bucket_known
+            position += 1
+
+        flappy_event.count, flappy_event.spread = count, spread
+        if known and flappy_event.is_flapping(
+                min_number_of_events=rule.min_number_of_events,
+                min_spread=rule.min_spread,
+        ):
+            return True
+
+    return False
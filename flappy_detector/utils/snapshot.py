@@ -0,0 +1,350 @@
+"""Snapshot of the scheduled detector's per group state, carried between runs"""
+from __future__ import annotations
+
+import json
+import logging
+import zlib
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from amplify_aws_utils.resource_helper import throttled_call
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.time_bucket import (
+    ROLLUP_BUCKET_SIZE_IN_SECS,
+    TIME_BUCKET_ATTRIBUTE,
+    get_time_bucket,
+)
+
+if TYPE_CHECKING:
+    import botostubs
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the encoded layout changes, snapshots of any other version are discarded
+SNAPSHOT_FORMAT_VERSION = 2
+# The most bytes of an encoded snapshot held in one item, leaving room under DynamoDB's 400KB item limit
+MAX_SHARD_SIZE = 350 * 1024
+
+
+def get_event_change(event: Dict[str, Any]) -> Tuple[int, int]:
+    """
+    Get a record's change in host count, and whether its state is known.
+    As in the detector's loop, records with an unknown state are counted without changing the spread.
+    :param event: DynamoDB record.
+    :return: The change in host count, and 1 if the record's state is known else 0.
+    """
+    try:
+        return Ec2State(event["state"]).change, 1
+    except (KeyError, TypeError, ValueError):
+        return 0, 0
+
+
+def get_rollup_known(rollup: Dict[str, Any]) -> int:
+    """
+    Get how many records with a known state a group's counter for a time bucket holds.
+    :param rollup: Counter written by ingest.
+    :return: The number of records, all of them for counters written before unknown states were counted.
+    """
+    return int(rollup.get("known", rollup["count"]))
+
+
+@dataclass
+class GroupState:
+    """
+    The team of a group along with its count, spread and number of records with a known state per time bucket.
+    """
+
+    attributes: List[str]
+    team: Optional[str] = None
+    buckets: Dict[int, List[int]] = field(default_factory=dict)
+
+    def get_flappy_event(self) -> FlappyEvent:
+        """
+        Build a FlappyEvent for the group, without any events summed yet.
+        :return: The group's FlappyEvent.
+        """
+        account, region, environment, application, group_name = self.attributes
+        return FlappyEvent(
+            account=account,
+            region=region,
+            environment=environment,
+            application=application,
+            group_name=group_name,
+            team=self.team,
+        )
+
+
+@dataclass
+class DetectionSnapshot:
+    """
+    Per group counts and spreads by time bucket, for every event up to the watermark.
+    """
+
+    watermark: int
+    bucket_size: int = ROLLUP_BUCKET_SIZE_IN_SECS
+    groups: Dict[str, GroupState] = field(default_factory=dict)
+
+    def add_event(self, event: Dict[str, Any]):
+        """
+        Fold an ingested record into the state of its group.
+        As in the detector's loop, records with an unknown state are counted without changing the spread.
+        Records missing key attributes are skipped.
+        :param event: DynamoDB record.
+        """
+        try:
+            attributes = [event[attribute] for attribute in FlappyEvent.KEY_ATTRIBUTES]
+            key = "_".join(attributes)
+        except (KeyError, TypeError):
+            logger.debug(
+                "Not adding event to snapshot",
+                extra={"event": event},
+            )
+            return
+
+        change, known = get_event_change(event)
+        group = self.groups.get(key)
+        if not group:
+            group = self.groups[key] = GroupState(attributes=attributes)
+
+        if not group.team:
+            group.team = event.get("team")
+
+        bucket = group.buckets.setdefault(get_time_bucket(event["timestamp"], self.bucket_size), [0, 0, 0])
+        bucket[0] += 1
+        bucket[1] += change
+        bucket[2] += known
+
+    def add_rollup(self, rollup: Dict[str, Any]):
+        """
+        Fold a group's counter for a time bucket into the state of the group.
+        :param rollup: Counter written by ingest, with the snapshot's bucket size.
+        """
+        group = self.groups.get(rollup["key"])
+        if not group:
+            group = self.groups[rollup["key"]] = GroupState(
+                attributes=[rollup[attribute] for attribute in FlappyEvent.KEY_ATTRIBUTES],
+            )
+
+        if not group.team:
+            group.team = rollup.get("team")
+
+        bucket = group.buckets.setdefault(int(rollup[TIME_BUCKET_ATTRIBUTE]), [0, 0, 0])
+        bucket[0] += int(rollup["count"])
+        bucket[1] += int(rollup["spread"])
+        bucket[2] += get_rollup_known(rollup)
+
+    def expire(self, cut_off_bucket: int):
+        """
+        Drop buckets older than the cut off, and groups left without any.
+        :param cut_off_bucket: The oldest bucket still in the window.
+        """
+        for key in list(self.groups):
+            group = self.groups[key]
+            group.buckets = {
+                time_bucket: counts
+                for time_bucket, counts in group.buckets.items()
+                if time_bucket >= cut_off_bucket
+            }
+            if not group.buckets:
+                del self.groups[key]
+
+    def get_flappy_events(self) -> List[FlappyEvent]:
+        """
+        Sum the buckets of every group.
+        As in the detector's loop, groups without any record with a known state are left out.
+        :return: List of FlappyEvents, one per group.
+        """
+        flappy_events = []
+        for group in self.groups.values():
+            flappy_event = group.get_flappy_event()
+            known = 0
+            for count, spread, bucket_known in group.buckets.values():
+                flappy_event.count += count
+                flappy_event.spread += spread
+                known += bucket_known
+            if known:
+                flappy_events.append(flappy_event)
+
+        return flappy_events
+
+    def dumps(self) -> bytes:
+        """
+        Encode the snapshot as compressed JSON.
+        :return: The encoded snapshot.
+        """
+        return zlib.compress(
+            json.dumps(
+                {
+                    "watermark": self.watermark,
+                    "bucket_size": self.bucket_size,
+                    "groups": [
+                        [
+                            group.attributes,
+                            group.team,
+                            [[time_bucket, *counts] for time_bucket, counts in group.buckets.items()],
+                        ]
+                        for group in self.groups.values()
+                    ],
+                },
+                separators=(",", ":"),
+            ).encode()
+        )
+
+    @classmethod
+    def loads(cls, data: bytes) -> "DetectionSnapshot":
+        """
+        Decode a snapshot encoded by dumps.
+        :param data: The encoded snapshot.
+        :return: The DetectionSnapshot.
+        """
+        decoded = json.loads(zlib.decompress(data))
+        snapshot = cls(watermark=decoded["watermark"], bucket_size=decoded["bucket_size"])
+        for attributes, team, buckets in decoded["groups"]:
+            snapshot.groups["_".join(attributes)] = GroupState(
+                attributes=attributes,
+                team=team,
+                buckets={time_bucket: counts for time_bucket, *counts in buckets},
+            )
+
+        return snapshot
+
+
+class SnapshotStore:
+    """
+    Stores a DetectionSnapshot in a DynamoDB item, along with the version of its format.
+
+    Snapshots too large for one item are split into shards. The shards after the first are written under the
+    snapshot's watermark before the item pointing at them, so a snapshot is never read with another's shards.
+    The previous snapshot's shards are deleted once it is replaced.
+    """
+
+    def __init__(
+            self,
+            dynamodb_table: botostubs.DynamoDB.DynamodbResource.Table,
+            snapshot_id: str = "detect",
+            max_shard_size: int = MAX_SHARD_SIZE,
+    ):
+        """
+        :param dynamodb_table: Table resource for the snapshots, keyed by snapshot_id.
+        :param snapshot_id: The key of the snapshot's item.
+        :param max_shard_size: The most bytes of the encoded snapshot held in each item.
+        """
+        self.dynamodb_table = dynamodb_table
+        self.snapshot_id = snapshot_id
+        self.max_shard_size = max_shard_size
+
+    def load(self) -> Optional[DetectionSnapshot]:
+        """
+        Load the stored snapshot.
+        :return: The DetectionSnapshot, or None if there isn't one or it was stored in another format.
+        """
+        item = throttled_call(
+            self.dynamodb_table.get_item,
+            Key={"snapshot_id": self.snapshot_id},
+            ConsistentRead=True,
+        ).get("Item")
+        if not item:
+            return None
+
+        if item.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            logger.warning(
+                "Discarding snapshot in format_version=%s",
+                item.get("format_version"),
+                extra={"snapshot_id": self.snapshot_id},
+            )
+            return None
+
+        shards = [item]
+        for index in range(1, int(item.get("shards", 1))):
+            shard = throttled_call(
+                self.dynamodb_table.get_item,
+                Key={"snapshot_id": self._get_shard_id(watermark=int(item["watermark"]), index=index)},
+                ConsistentRead=True,
+            ).get("Item")
+            if not shard:
+                logger.warning(
+                    "Discarding snapshot missing shard %s, replaced while it was read",
+                    index,
+                    extra={"snapshot_id": self.snapshot_id},
+                )
+                return None
+            shards.append(shard)
+
+        # Binary attributes are read back wrapped in boto3's Binary
+        return DetectionSnapshot.loads(
+            b"".join(getattr(shard["data"], "value", shard["data"]) for shard in shards)
+        )
+
+    def save(self, snapshot: DetectionSnapshot) -> bool:
+        """
+        Store the snapshot, unless a run that read further has already stored a later one.
+        :param snapshot: The DetectionSnapshot to store.
+        :return: True if the snapshot was stored.
+        """
+        data = snapshot.dumps()
+        shards = [
+            data[start:start + self.max_shard_size]
+            for start in range(0, len(data), self.max_shard_size)
+        ]
+        for index, shard in enumerate(shards[1:], start=1):
+            throttled_call(
+                self.dynamodb_table.put_item,
+                Item={
+                    "snapshot_id": self._get_shard_id(watermark=snapshot.watermark, index=index),
+                    "data": shard,
+                },
+            )
+
+        try:
+            previous = throttled_call(
+                self.dynamodb_table.put_item,
+                Item={
+                    "snapshot_id": self.snapshot_id,
+                    "format_version": SNAPSHOT_FORMAT_VERSION,
+                    "watermark": snapshot.watermark,
+                    "shards": len(shards),
+                    "data": shards[0],
+                },
+                ConditionExpression=Attr("watermark").not_exists() | Attr("watermark").lt(snapshot.watermark),
+                ReturnValues="ALL_OLD",
+            ).get("Attributes")
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+            logger.warning(
+                "Not storing snapshot older than the stored one",
+                extra={"snapshot_id": self.snapshot_id, "watermark": snapshot.watermark},
+            )
+            self._delete_shards(watermark=snapshot.watermark, shards=len(shards))
+            return False
+
+        if previous:
+            self._delete_shards(watermark=int(previous["watermark"]), shards=int(previous.get("shards", 1)))
+
+        return True
+
+    def _delete_shards(self, watermark: int, shards: int):
+        """
+        Delete the shards after the first of a snapshot.
+        :param watermark: The snapshot's watermark.
+        :param shards: The snapshot's number of shards.
+        """
+        for index in range(1, shards):
+            throttled_call(
+                self.dynamodb_table.delete_item,
+                Key={"snapshot_id": self._get_shard_id(watermark=watermark, index=index)},
+            )
+
+    def _get_shard_id(self, watermark: int, index: int) -> str:
+        """
+        Get the key of one of a snapshot's shards.
+        :param watermark: The snapshot's watermark.
+        :param index: The position of the shard, from 1.
+        :return: The shard's snapshot_id.
+        """
+        return f"{self.snapshot_id}#{watermark}#{index}"
@@ -0,0 +1,41 @@
+"""Helpers for bucketing event timestamps"""
+from decimal import Decimal
+from typing import List, Union
+
+TIME_BUCKET_ATTRIBUTE = "time_bucket"
+TIME_BUCKET_SIZE_IN_SECS = 60 * 60
+# Rollups use smaller buckets, since the detection window starts at the start of a bucket
+ROLLUP_BUCKET_SIZE_IN_SECS = 5 * 60
+
+Timestamp = Union[int, float, Decimal]
+
+
+def get_time_bucket(timestamp: Timestamp, bucket_size: int = TIME_BUCKET_SIZE_IN_SECS) -> int:
+    """
+    Get the bucket a timestamp falls in.
+    :param timestamp: Epoch timestamp in seconds.
+    :param bucket_size: Size of each bucket in seconds.
+    :return: Epoch timestamp of the start of the bucket.
+    """
+    return int(timestamp) // bucket_size * bucket_size
+
+
+def get_time_buckets(
+        start: Timestamp,
+        end: Timestamp,
+        bucket_size: int = TIME_BUCKET_SIZE_IN_SECS,
+) -> List[int]:
+    """
+    Get every bucket overlapping the given time range.
+    :param start: Epoch timestamp in seconds of the start of the range.
+    :param end: Epoch timestamp in seconds of the end of the range.
+    :param bucket_size: Size of each bucket in seconds.
+    :return: List of bucket start timestamps, oldest first.
+    """
+    return list(
+        range(
+            get_time_bucket(start, bucket_size),
+            get_time_bucket(end, bucket_size) + 1,
+            bucket_size,
+        )
+    )
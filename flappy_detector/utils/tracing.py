@@ -0,0 +1,17 @@
+"""X-Ray tracing of the libraries each Lambda calls out through"""
+from typing import Iterable
+
+from aws_xray_sdk.core import patch, xray_recorder
+
+
+def patch_libraries(libraries: Iterable[str]):
+    """
+    Trace calls made through the given libraries.
+    Unlike patch_all, only the libraries a Lambda uses are imported and patched at its cold start.
+    :param libraries: Names of the libraries, as known to aws_xray_sdk.
+    """
+    xray_recorder.configure(
+        context_missing='LOG_ERROR',
+    )
+
+    patch(libraries)
@@ -0,0 +1,117 @@
+"""
+Ordered analysis of each group's state changes, telling rapid on/off cycling apart from a scale up and down.
+"""
+import heapq
+import logging
+from dataclasses import dataclass
+from statistics import median
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.enum import Ec2State
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TransitionStats:
+    """How a group's host count moved, from its changes in timestamp order"""
+
+    # Number of times the host count changed direction
+    reversals: int = 0
+    # Most changes in a row in the same direction
+    longest_run: int = 0
+    # Seconds between consecutive changes, None with fewer than two
+    min_interval: Optional[float] = None
+    median_interval: Optional[float] = None
+
+
+class GroupTransitions:
+    """
+    The FlappyEvent of a group along with its most recent changes.
+
+    Only the newest max_events changes are held, in a min-heap on timestamp, so a group's memory is bounded
+    however many records it has. Its count and spread still cover every record.
+    """
+
+    def __init__(self, flappy_event: FlappyEvent, max_events: int):
+        """
+        :param flappy_event: The group's FlappyEvent.
+        :param max_events: The most changes held for the ordered analysis.
+        """
+        self.flappy_event = flappy_event
+        self.max_events = max_events
+        self.changes: List[Tuple[Any, int, int]] = []
+
+    def add(self, timestamp, sequence: int, change: int):
+        """
+        Fold a change into the group.
+        :param timestamp: Epoch timestamp of the change.
+        :param sequence: Position of the record read, ordering changes with the same timestamp.
+        :param change: Change in host count, 1 or -1.
+        """
+        self.flappy_event.count += 1
+        self.flappy_event.spread += change
+        if len(self.changes) < self.max_events:
+            heapq.heappush(self.changes, (timestamp, sequence, change))
+        else:
+            # Drops the oldest change, or the new one if it is older still
+            heapq.heappushpop(self.changes, (timestamp, sequence, change))
+
+    def get_stats(self) -> TransitionStats:
+        """
+        Analyse the held changes in timestamp order.
+        :return: The group's TransitionStats.
+        """
+        changes = sorted(self.changes)
+        stats = TransitionStats()
+        run = 0
+        for position, (_, _, change) in enumerate(changes):
+            if position and change != changes[position - 1][2]:
+                stats.reversals += 1
+                run = 0
+            run += 1
+            stats.longest_run = max(stats.longest_run, run)
+
+        intervals = [float(later[0] - earlier[0]) for earlier, later in zip(changes, changes[1:])]
+        if intervals:
+            stats.min_interval = min(intervals)
+            stats.median_interval = median(intervals)
+
+        return stats
+
+
+def group_transitions(events: Iterable[Dict[str, Any]], max_events: int) -> List[GroupTransitions]:
+    """
+    Fold the given events into their groups' transitions.
+    Records with an unknown state are skipped, as are those with missing attributes or key attributes that
+    can't be joined into a key.
+    :param events: Iterable of DynamoDB records.
+    :param max_events: The most changes held per group for the ordered analysis.
+    :return: List of GroupTransitions, one per group.
+    """
+    groups: Dict[Tuple[Any, ...], GroupTransitions] = {}
+
+    for sequence, event in enumerate(events):
+        try:
+            key_attributes = tuple(event[attribute] for attribute in FlappyEvent.KEY_ATTRIBUTES)
+            change = Ec2State(event["state"]).change
+            timestamp = event["timestamp"]
+            group = groups.get(key_attributes) or GroupTransitions(
+                flappy_event=FlappyEvent(*key_attributes),
+                max_events=max_events,
+            )
+        except (KeyError, TypeError, ValueError):
+            logger.debug(
+                "Not adding event to transitions",
+                extra={"event": event},
+            )
+            continue
+
+        if not group.flappy_event.team:
+            group.flappy_event.team = event.get("team")
+
+        group.add(timestamp=timestamp, sequence=sequence, change=change)
+        groups[key_attributes] = group
+
+    return list(groups.values())
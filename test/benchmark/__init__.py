@@ -0,0 +1 @@
+"""Benchmarks -- run by hand, e.g. python -m test.benchmark.bench_parallel_scan"""
@@ -0,0 +1,58 @@
+"""
+Benchmark of summing records by group with the numpy engine against the pure Python loop.
+
+Reports the time each engine takes at growing window sizes, and the smallest size where numpy is faster.
+
+Usage: python -m test.benchmark.bench_columnar
+"""
+import time
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+from flappy_detector.handlers.detect import ENGINES, FlappyDetector
+from test.benchmark.local_table import make_events
+
+NUMBERS_OF_EVENTS = (10, 100, 1000, 10000, 100000, 1000000)
+REPEATS = 3
+
+
+def main():
+    """Prints the best time of each engine for each number of records"""
+    detectors = {
+        engine: FlappyDetector(
+            datadog_client=MagicMock(),
+            dynamodb_table=MagicMock(),
+            max_event_age=timedelta(hours=2),
+            min_number_of_events=4,
+            min_spread=2,
+            engine=engine,
+        )
+        for engine in ENGINES
+    }
+
+    crossover = None
+    for number_of_events in NUMBERS_OF_EVENTS:
+        events = make_events(number_of_events)
+        results = {}
+        for engine, detector in detectors.items():
+            elapsed = []
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                flappy_events = detector._group_events(events=events)  # pylint: disable=protected-access
+                elapsed.append(time.perf_counter() - start)
+            results[engine] = (min(elapsed), flappy_events)
+
+        assert results["numpy"][1] == results["python"][1], f"Engines differ on {number_of_events} records"
+        speedup = results["python"][0] / results["numpy"][0]
+        if crossover is None and speedup > 1:
+            crossover = number_of_events
+        print(
+            f"{number_of_events} records: python {results['python'][0] * 1e3:.2f}ms, "
+            f"numpy {results['numpy'][0] * 1e3:.2f}ms, numpy is {speedup:.2f}x as fast"
+        )
+
+    print(f"numpy is faster from {crossover} records" if crossover else "numpy was never faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of parsing the time of CloudWatch events, with dateutil and with the fast path.
+
+Usage: python -m test.benchmark.bench_event_time
+"""
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, List
+from unittest.mock import MagicMock, patch
+
+from dateutil.parser import parse
+
+from flappy_detector.handlers.ingest import Ingestor
+from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.event_time import parse_event_time
+
+NUMBER_OF_EVENTS = 100000
+
+
+def make_cloudwatch_events(number_of_events: int) -> List[Dict[str, Any]]:
+    """Builds CloudWatch EC2 state change events, a second apart"""
+    start = datetime(2021, 1, 30, tzinfo=timezone.utc)
+    return [
+        {
+            "id": f"event-{index}",
+            "account": f"account-{index % 5}",
+            "region": "us-west-2",
+            "time": (start + timedelta(seconds=index)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "detail": {
+                "instance-id": f"i-{index % 1000:017x}",
+                "state": Ec2State.RUNNING.value if index % 2 else Ec2State.TERMINATED.value,
+            },
+        }
+        for index in range(number_of_events)
+    ]
+
+
+def parse_event_time_before(value: str) -> Decimal:
+    """How the ingest loop parsed the time of every event before"""
+    return Decimal(parse(value).timestamp())
+
+
+def main():
+    """Prints the time taken to parse the events' times, and to group the events, before and after"""
+    events = make_cloudwatch_events(NUMBER_OF_EVENTS)
+    ingestor = Ingestor(sts_client=MagicMock(), dynamodb_table=MagicMock())
+
+    for name, parse_function in (
+            ("before", parse_event_time_before),
+            ("after", parse_event_time),
+    ):
+        start = time.perf_counter()
+        for event in events:
+            parse_function(event["time"])
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name}: parsed {len(events)} times in {elapsed:.2f}s, "
+            f"{elapsed / len(events) * 1e9:.0f}ns per event"
+        )
+
+        with patch("flappy_detector.handlers.ingest.parse_event_time", parse_function):
+            start = time.perf_counter()
+            ingestor._group_events(events=events)  # pylint: disable=protected-access
+            elapsed = time.perf_counter() - start
+        print(f"{name}: grouped {len(events)} events in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
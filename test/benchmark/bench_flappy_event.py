@@ -0,0 +1,167 @@
+"""
+Micro-benchmark of grouping records into FlappyEvents and reading their tags, before and after slotting them.
+
+The dataclass and grouping loop the detector used before are kept here to compare against.
+
+Usage: python -m test.benchmark.bench_flappy_event
+"""
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Callable, Dict, List, Optional
+from unittest.mock import MagicMock, patch
+
+from flappy_detector.handlers.detect import FlappyDetector
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.enum import Ec2State
+from test.benchmark.local_table import make_events
+
+NUMBER_OF_EVENTS = 1000000
+
+
+@dataclass
+class DataclassFlappyEvent:
+    """FlappyEvent as it was before being slotted"""
+
+    account: str
+    region: str
+    environment: str
+    application: str
+    group_name: str
+    team: Optional[str] = None
+    key: str = field(init=False)
+    count: int = 0
+    spread: int = 0
+
+    def __post_init__(self):
+        self.key = "_".join(
+            [
+                getattr(self, attribute)
+                for attribute in FlappyEvent.KEY_ATTRIBUTES
+            ]
+        )
+
+    @property
+    def tags(self):
+        """Returns the DD tags for the flappy event"""
+        tags = [
+            f"account:{self.account}",
+            f"region:{self.region}",
+            f"environment:{self.environment}",
+            f"application:{self.application}",
+            f"env:{self.environment}",
+            f"service:{self.application}",
+            f"group_name:{self.group_name}",
+            "source:flappy_detector",
+        ]
+
+        if self.team:
+            tags.append(f"team:{self.team}")
+
+        return tags
+
+
+def group_events_before(events: List[Dict[str, Any]], flappy_event_class=DataclassFlappyEvent) -> List[Any]:
+    """The detector's grouping loop before, building a FlappyEvent for every record"""
+    flappy_events: Dict[str, Any] = {}
+    for event in events:
+        flappy_event = flappy_event_class(
+            account=event["account"],
+            region=event["region"],
+            environment=event["environment"],
+            application=event["application"],
+            group_name=event["group_name"],
+        )
+        flappy_event = flappy_events.get(flappy_event.key, flappy_event)
+
+        if not flappy_event.team:
+            flappy_event.team = event.get("team")
+
+        flappy_event.count += 1
+        try:
+            flappy_event.spread += Ec2State(event["state"]).change
+        except ValueError:
+            continue
+
+        flappy_events[flappy_event.key] = flappy_event
+
+    return list(flappy_events.values())
+
+
+def group_events_after(events: List[Dict[str, Any]]) -> List[FlappyEvent]:
+    """The detector's grouping loop now"""
+    flappy_detector = FlappyDetector(
+        datadog_client=MagicMock(),
+        dynamodb_table=MagicMock(),
+        max_event_age=timedelta(hours=2),
+        min_number_of_events=4,
+        min_spread=2,
+    )
+    return flappy_detector._group_events(events=events)  # pylint: disable=protected-access
+
+
+def count_built(flappy_event_class, group_events: Callable) -> int:
+    """Counts the FlappyEvents built by a grouping loop"""
+    built = []
+
+    def build(*args, **kwargs):
+        built.append(None)
+        return flappy_event_class(*args, **kwargs)
+
+    with patch("flappy_detector.handlers.detect.FlappyEvent", build):
+        group_events(build)
+
+    return len(built)
+
+
+def get_instance_size(flappy_event: Any) -> int:
+    """Bytes held by a FlappyEvent itself, its attribute dict included"""
+    return sys.getsizeof(flappy_event) + (
+        sys.getsizeof(flappy_event.__dict__) if hasattr(flappy_event, "__dict__") else 0
+    )
+
+
+def main():
+    """Prints the allocations and time taken to group the records and read the tags, before and after"""
+    events = make_events(NUMBER_OF_EVENTS)
+
+    for name, group_events, flappy_event_class, built in (
+            (
+                "before",
+                group_events_before,
+                DataclassFlappyEvent,
+                count_built(
+                    DataclassFlappyEvent,
+                    lambda build: group_events_before(events, flappy_event_class=build),
+                ),
+            ),
+            (
+                "after",
+                group_events_after,
+                FlappyEvent,
+                count_built(FlappyEvent, lambda _: group_events_after(events)),
+            ),
+    ):
+        start = time.perf_counter()
+        flappy_events = group_events(events)
+        elapsed = time.perf_counter() - start
+
+        instance_size = get_instance_size(flappy_events[0])
+        print(
+            f"{name}: grouped {len(events)} records into {len(flappy_events)} groups in {elapsed:.2f}s, "
+            f"{elapsed / len(events) * 1e9:.0f}ns per record, "
+            f"built {built} FlappyEvents of {instance_size} bytes, "
+            f"{built * instance_size / len(events):.1f} bytes per record"
+        )
+
+        flappy_event = flappy_event_class(*FlappyEvent.KEY_ATTRIBUTES, team="team")
+        start = time.perf_counter()
+        for _ in range(len(events)):
+            flappy_event.tags  # pylint: disable=pointless-statement
+        elapsed = time.perf_counter() - start
+        print(f"{name}: read tags {len(events)} times in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
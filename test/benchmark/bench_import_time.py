@@ -0,0 +1,54 @@
+"""
+Benchmark of each Lambda's cold start imports, timed by python -X importtime in a fresh interpreter.
+
+Usage: python -m test.benchmark.bench_import_time
+"""
+import subprocess
+import sys
+from typing import Dict
+
+HANDLERS = ("ingest", "detect", "stream")
+# Modules slowest to import, by their cumulative time
+SLOWEST_MODULES = 5
+
+
+def get_import_times(module: str) -> Dict[str, int]:
+    """
+    Import a module in a fresh interpreter.
+    :param module: Name of the module.
+    :return: Cumulative microseconds taken to import each module it imported, including itself.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    import_times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        import_times[fields[2].strip()] = int(fields[1])
+
+    return import_times
+
+
+def main():
+    """Prints the time taken to import each handler, along with the modules slowest to import"""
+    for handler in HANDLERS:
+        module = f"flappy_detector.handlers.{handler}"
+        import_times = get_import_times(module)
+        print(f"{handler}: imported {len(import_times)} modules in {import_times[module] / 1e6:.2f}s")
+        slowest = sorted(
+            (name for name in import_times if name != module),
+            key=import_times.__getitem__,
+            reverse=True,
+        )
+        for name in slowest[:SLOWEST_MODULES]:
+            print(f"    {name}: {import_times[name] / 1e6:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Benchmark of the detector's read path using a parallel scan against a local stand-in table.
+
+Usage: python -m test.benchmark.bench_parallel_scan
+"""
+import time
+
+from flappy_detector.utils.dynamodb import iterate_pages, parallel_scan
+from test.benchmark.local_table import LocalTable, make_events
+
+NUMBER_OF_EVENTS = 200000
+SEGMENT_COUNTS = (1, 2, 4, 8, 16, 32)
+
+
+def main():
+    """Prints the time taken to scan the table for each segment count"""
+    table = LocalTable(items=make_events(NUMBER_OF_EVENTS))
+
+    start = time.perf_counter()
+    expected = sum(len(page) for page in iterate_pages(table.scan))
+    baseline = time.perf_counter() - start
+    print(f"serial: {expected} items, {table.requests} requests, {baseline:.2f}s")
+
+    for total_segments in SEGMENT_COUNTS:
+        table.requests = 0
+        start = time.perf_counter()
+        actual = sum(1 for _ in parallel_scan(lambda: table.scan, total_segments=total_segments))
+        elapsed = time.perf_counter() - start
+
+        assert actual == expected, f"Read {actual} items, expected {expected}"
+        print(
+            f"segments={total_segments}: {table.requests} requests, {elapsed:.2f}s, "
+            f"speedup={baseline / elapsed:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of the bytes and time saved by projecting only the attributes the detector reads.
+
+Records are encoded the way DynamoDB returns them on the wire, then decoded the way boto3 does for every page.
+
+Usage: python -m test.benchmark.bench_projection
+"""
+import json
+import time
+from typing import Any, Dict, List
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.time_bucket import TIME_BUCKET_ATTRIBUTE, get_time_bucket
+from test.benchmark.local_table import make_events
+
+NUMBER_OF_EVENTS = 500000
+
+
+def encode(items: List[Dict[str, Any]]) -> bytes:
+    """Encodes items as a DynamoDB response body"""
+    serializer = TypeSerializer()
+    return json.dumps(
+        {
+            "Items": [
+                {name: serializer.serialize(value) for name, value in item.items()}
+                for item in items
+            ]
+        },
+        default=str,
+    ).encode()
+
+
+def decode(body: bytes) -> List[Dict[str, Any]]:
+    """Decodes a DynamoDB response body into items"""
+    deserializer = TypeDeserializer()
+    return [
+        {name: deserializer.deserialize(value) for name, value in item.items()}
+        for item in json.loads(body)["Items"]
+    ]
+
+
+def main():
+    """Prints the response size and decode time with and without the projection"""
+    items = [
+        {**event, TIME_BUCKET_ATTRIBUTE: get_time_bucket(event["timestamp"])}
+        for event in make_events(NUMBER_OF_EVENTS)
+    ]
+    projected_items = [
+        {name: item[name] for name in FlappyEvent.RECORD_ATTRIBUTES if name in item}
+        for item in items
+    ]
+
+    results = {}
+    for name, body in (("full", encode(items)), ("projected", encode(projected_items))):
+        start = time.perf_counter()
+        decode(body)
+        results[name] = (len(body), time.perf_counter() - start)
+        print(f"{name}: {len(body) / 2 ** 20:.1f} MiB, decoded in {results[name][1]:.2f}s")
+
+    print(
+        f"projection saves {1 - results['projected'][0] / results['full'][0]:.0%} of bytes "
+        f"and {1 - results['projected'][1] / results['full'][1]:.0%} of decode time"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""In-process stand-in for a DynamoDB table, used by the benchmarks"""
+import random
+import time
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+from flappy_detector.utils.enum import Ec2State
+
+
+def make_events(
+        number_of_events: int,
+        number_of_groups: int = 500,
+        start: int = 1577836800,
+        duration: int = 2 * 60 * 60,
+) -> List[Dict[str, Any]]:
+    """
+    Build synthetic records shaped like the ones ingest writes.
+    :param number_of_events: The number of records to build.
+    :param number_of_groups: The number of distinct groups to spread the records over.
+    :param start: Epoch timestamp of the oldest record.
+    :param duration: Number of seconds the records are spread over.
+    :return: List of records.
+    """
+    rng = random.Random(0)
+    states = [state.value for state in Ec2State]
+    events = []
+    for index in range(number_of_events):
+        group = rng.randrange(number_of_groups)
+        events.append(
+            {
+                "account": f"{100000000000 + group % 20}",
+                "region": "us-west-2" if group % 2 else "us-east-1",
+                "environment": "prod" if group % 3 else "staging",
+                "application": f"application-{group}",
+                "group_name": f"sig-{group:08x}",
+                "team": f"team-{group % 10}",
+                "instance_id": f"i-{index:017x}",
+                "state": rng.choice(states),
+                "timestamp": Decimal(start + rng.randrange(duration)),
+            }
+        )
+
+    return events
+
+
+class LocalTable:
+    """
+    Serves Scan requests from memory, sleeping to simulate the latency of each request.
+
+    Like DynamoDB, items are split into segments by hashing and each page holds a fixed number of items.
+    """
+
+    def __init__(
+            self,
+            items: List[Dict[str, Any]],
+            page_size: int = 1000,
+            request_latency: float = 0.05,
+    ):
+        """
+        :param items: The items in the table.
+        :param page_size: The number of items returned per page.
+        :param request_latency: Seconds each request takes.
+        """
+        self.items = items
+        self.page_size = page_size
+        self.request_latency = request_latency
+        self.requests = 0
+
+    def scan(  # pylint: disable=invalid-name
+            self,
+            Segment: int = 0,
+            TotalSegments: int = 1,
+            ExclusiveStartKey: Optional[Dict[str, int]] = None,
+            **_,
+    ) -> Dict[str, Any]:
+        """Returns one page of the requested segment"""
+        self.requests += 1
+        time.sleep(self.request_latency)
+
+        start = ExclusiveStartKey["index"] if ExclusiveStartKey else Segment
+        stop = min(start + self.page_size * TotalSegments, len(self.items))
+        response: Dict[str, Any] = {
+            "Items": self.items[start:stop:TotalSegments],
+        }
+        if stop < len(self.items):
+            response["LastEvaluatedKey"] = {"index": stop + (Segment - stop) % TotalSegments}
+
+        return response
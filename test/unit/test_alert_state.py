@@ -0,0 +1,168 @@
+"""Tests for the alert state store"""
+from datetime import timedelta
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.alert_state import AlertStateStore
+
+MOCK_TIME_NOW = 1577836800
+MOCK_TEAM = "MOCK_TEAM"
+MOCK_FLAPPY_EVENT = FlappyEvent(
+    account="MOCK_ACCOUNT",
+    region="MOCK_REGION",
+    environment="MOCK_ENVIRONMENT",
+    application="MOCK_APPLICATION",
+    group_name="MOCK_GROUP_NAME",
+    team=MOCK_TEAM,
+    count=6,
+    spread=0,
+)
+MOCK_STATE = {
+    "key": MOCK_FLAPPY_EVENT.key,
+    "account": "MOCK_ACCOUNT",
+    "region": "MOCK_REGION",
+    "environment": "MOCK_ENVIRONMENT",
+    "application": "MOCK_APPLICATION",
+    "group_name": "MOCK_GROUP_NAME",
+    "team": MOCK_TEAM,
+    "flapping": True,
+    "last_count": 6,
+    "last_spread": 0,
+    "version": 1,
+}
+
+
+@patch("flappy_detector.utils.alert_state.time.time", MagicMock(return_value=MOCK_TIME_NOW))
+class TestAlertStateStore(TestCase):
+    """Tests for the alert state store"""
+
+    def setUp(self) -> None:
+        self.dynamodb_table = MagicMock()
+        self.alert_state_store = AlertStateStore(
+            dynamodb_table=self.dynamodb_table,
+            cooldown=timedelta(hours=2),
+            escalation_factor=2,
+        )
+
+    def _mock_states(self, *states):
+        self.dynamodb_table.scan.return_value = {"Items": list(states)}
+
+    def test_claim_new_group(self):
+        """Test a group without any state is alerted on, and its state recorded"""
+        self._mock_states()
+
+        alerts, recoveries = self.alert_state_store.claim(flapping_events=[MOCK_FLAPPY_EVENT])
+
+        self.assertEqual((alerts, recoveries), ([MOCK_FLAPPY_EVENT], []))
+        self.dynamodb_table.put_item.assert_called_once()
+        item = self.dynamodb_table.put_item.call_args[1]["Item"]
+        self.assertEqual(
+            {name: item[name] for name in ("key", "team", "flapping", "last_alerted_at", "version")},
+            {
+                "key": MOCK_FLAPPY_EVENT.key,
+                "team": MOCK_TEAM,
+                "flapping": True,
+                "last_alerted_at": MOCK_TIME_NOW,
+                "version": 1,
+            },
+        )
+        self.assertEqual(item["expires_at"], MOCK_TIME_NOW + 24 * 60 * 60)
+
+    def test_claim_suppressed(self):
+        """Test a group still flapping within its cooldown, and not much worse, isn't alerted on"""
+        self._mock_states({**MOCK_STATE, "last_alerted_at": MOCK_TIME_NOW - 60})
+
+        alerts, recoveries = self.alert_state_store.claim(flapping_events=[MOCK_FLAPPY_EVENT])
+
+        self.assertEqual((alerts, recoveries), ([], []))
+        self.dynamodb_table.put_item.assert_not_called()
+
+    def test_claim_escalated(self):
+        """Test a group flapping materially worse is alerted on within its cooldown"""
+        self._mock_states({**MOCK_STATE, "last_count": 3, "last_alerted_at": MOCK_TIME_NOW - 60})
+
+        alerts, _ = self.alert_state_store.claim(flapping_events=[MOCK_FLAPPY_EVENT])
+
+        self.assertEqual(alerts, [MOCK_FLAPPY_EVENT])
+        self.assertEqual(self.dynamodb_table.put_item.call_args[1]["Item"]["version"], 2)
+
+    def test_claim_cooldown_passed(self):
+        """Test a group still flapping is alerted on again once its cooldown passes"""
+        self._mock_states({**MOCK_STATE, "last_alerted_at": MOCK_TIME_NOW - 2 * 60 * 60})
+
+        alerts, _ = self.alert_state_store.claim(flapping_events=[MOCK_FLAPPY_EVENT])
+
+        self.assertEqual(alerts, [MOCK_FLAPPY_EVENT])
+
+    def test_claim_recovered(self):
+        """Test a group that stopped flapping is recovered once, and recovered groups are left alone"""
+        self._mock_states(
+            {**MOCK_STATE, "last_alerted_at": MOCK_TIME_NOW - 60},
+            {**MOCK_STATE, "key": "MOCK_RECOVERED", "flapping": False, "last_alerted_at": MOCK_TIME_NOW},
+        )
+
+        alerts, recoveries = self.alert_state_store.claim(flapping_events=[])
+
+        self.assertEqual((alerts, recoveries), ([], [MOCK_FLAPPY_EVENT]))
+        self.dynamodb_table.put_item.assert_called_once()
+        self.assertFalse(self.dynamodb_table.put_item.call_args[1]["Item"]["flapping"])
+
+    def test_claim_raced(self):
+        """Test an alert claimed by another run isn't alerted on"""
+        self._mock_states()
+        self.dynamodb_table.put_item.side_effect = ClientError(
+            {"Error": {"Code": "ConditionalCheckFailedException"}},
+            "PutItem",
+        )
+
+        alerts, _ = self.alert_state_store.claim(flapping_events=[MOCK_FLAPPY_EVENT])
+
+        self.assertEqual(alerts, [])
+
+    def test_claim_alert(self):
+        """Test a single group is claimed against its own state, without recovering any other group"""
+        for state, expected in [
+                (None, True),
+                ({**MOCK_STATE, "last_alerted_at": MOCK_TIME_NOW - 60}, False),
+                ({**MOCK_STATE, "last_alerted_at": MOCK_TIME_NOW - 2 * 60 * 60}, True),
+        ]:
+            with self.subTest(state=state):
+                self.dynamodb_table.reset_mock()
+                self.dynamodb_table.get_item.return_value = {"Item": state} if state else {}
+
+                self.assertEqual(self.alert_state_store.claim_alert(flappy_event=MOCK_FLAPPY_EVENT), expected)
+                self.dynamodb_table.get_item.assert_called_once_with(
+                    Key={"key": MOCK_FLAPPY_EVENT.key},
+                    ConsistentRead=True,
+                )
+                self.dynamodb_table.scan.assert_not_called()
+                self.assertEqual(self.dynamodb_table.put_item.called, expected)
+
+    def test_release(self):
+        """Test releasing a claim restores the state it replaced, or deletes the state it created"""
+        previous_state = {**MOCK_STATE, "key": "MOCK_OTHER", "last_alerted_at": 0}
+        other_event = FlappyEvent(
+            account="MOCK_ACCOUNT",
+            region="MOCK_REGION",
+            environment="MOCK_ENVIRONMENT",
+            application="MOCK_APPLICATION",
+            group_name="MOCK_OTHER",
+            count=6,
+        )
+        self._mock_states({**previous_state, "key": other_event.key})
+        self.alert_state_store.claim(flapping_events=[MOCK_FLAPPY_EVENT, other_event])
+
+        self.alert_state_store.release(flappy_events=[MOCK_FLAPPY_EVENT, other_event])
+
+        self.dynamodb_table.delete_item.assert_called_once()
+        self.assertEqual(
+            self.dynamodb_table.delete_item.call_args[1]["Key"],
+            {"key": MOCK_FLAPPY_EVENT.key},
+        )
+        self.assertEqual(
+            self.dynamodb_table.put_item.call_args[1]["Item"],
+            {**previous_state, "key": other_event.key},
+        )
@@ -0,0 +1,239 @@
+"""Tests for alerting through Datadog"""
+import json
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import List
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from datadog import api, initialize
+from datadog.api.exceptions import HTTPError
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.alerting import AlertSender, DatadogKeys, TokenBucket, send_flappy_event
+
+MOCK_TIME_NOW = 1577836800
+MOCK_API_KEY = "MOCK_API_KEY"
+MOCK_APP_KEY = "MOCK_APP_KEY"
+MOCK_FLAPPY_EVENT = FlappyEvent(
+    account="MOCK_ACCOUNT",
+    region="MOCK_REGION",
+    environment="MOCK_ENVIRONMENT",
+    application="MOCK_APPLICATION",
+    group_name="MOCK_GROUP_NAME",
+    count=6,
+    spread=0,
+)
+
+
+@patch("flappy_detector.utils.alerting.time.time", MagicMock(return_value=MOCK_TIME_NOW))
+@patch("flappy_detector.utils.alerting.initialize")
+@patch("boto3.client")
+class TestDatadogKeys(TestCase):
+    """Tests for the Datadog keys"""
+
+    def setUp(self) -> None:
+        self.datadog_keys = DatadogKeys(ttl=timedelta(minutes=1))
+
+    def test_initialize(self, mock_boto3_client, mock_initialize):
+        """Test both keys are read in one call and only while fresh"""
+        mock_boto3_client.return_value.get_parameters.return_value = {
+            "Parameters": [
+                {"Name": "/account/app_auth/datadog/api_key", "Value": MOCK_API_KEY},
+                {"Name": "/account/app_auth/datadog/flappy_detector_app_key", "Value": MOCK_APP_KEY},
+            ]
+        }
+
+        self.datadog_keys.initialize()
+        self.datadog_keys.initialize()
+
+        mock_boto3_client.return_value.get_parameters.assert_called_once_with(
+            Names=[
+                "/account/app_auth/datadog/api_key",
+                "/account/app_auth/datadog/flappy_detector_app_key",
+            ],
+            WithDecryption=True,
+        )
+        mock_initialize.assert_called_once_with(api_key=MOCK_API_KEY, app_key=MOCK_APP_KEY)
+
+    def test_initialize_expired(self, mock_boto3_client, mock_initialize):
+        """Test the keys are read again once the TTL passes, or when forced to"""
+        mock_boto3_client.return_value.get_parameters.return_value = {
+            "Parameters": [
+                {"Name": "/account/app_auth/datadog/api_key", "Value": MOCK_API_KEY},
+                {"Name": "/account/app_auth/datadog/flappy_detector_app_key", "Value": MOCK_APP_KEY},
+            ]
+        }
+
+        self.datadog_keys.initialize()
+        with patch("flappy_detector.utils.alerting.time.time", MagicMock(return_value=MOCK_TIME_NOW + 61)):
+            self.datadog_keys.initialize()
+        self.datadog_keys.initialize(force_refresh=True)
+
+        self.assertEqual(mock_boto3_client.return_value.get_parameters.call_count, 3)
+        self.assertEqual(mock_initialize.call_count, 3)
+
+
+class TestSendFlappyEvent(TestCase):
+    """Tests for sending flappy events"""
+
+    @patch("flappy_detector.utils.alerting.initialize_datadog")
+    def test_send_flappy_event(self, mock_initialize_datadog):
+        """Test the event is sent once"""
+        datadog_client = MagicMock()
+        datadog_client.Event.create.return_value = {"status": "ok"}
+
+        send_flappy_event(datadog_client=datadog_client, flappy_event=MOCK_FLAPPY_EVENT)
+
+        datadog_client.Event.create.assert_called_once()
+        mock_initialize_datadog.assert_not_called()
+
+    @patch("flappy_detector.utils.alerting.initialize_datadog")
+    def test_send_flappy_event_auth_failure(self, mock_initialize_datadog):
+        """Test the keys are refreshed and the event resent when Datadog rejects the keys"""
+        datadog_client = MagicMock()
+        datadog_client.Event.create.side_effect = [{"errors": ["Forbidden"]}, {"status": "ok"}]
+
+        send_flappy_event(datadog_client=datadog_client, flappy_event=MOCK_FLAPPY_EVENT)
+
+        self.assertEqual(datadog_client.Event.create.call_count, 2)
+        mock_initialize_datadog.assert_called_once_with(force_refresh=True)
+
+
+class TestTokenBucket(TestCase):
+    """Tests for the token bucket"""
+
+    @patch("flappy_detector.utils.alerting.time.sleep")
+    @patch("flappy_detector.utils.alerting.time.monotonic")
+    def test_acquire(self, mock_monotonic, mock_sleep):
+        """Test tokens are taken up to the capacity, then waited for"""
+        mock_monotonic.return_value = 0.0
+        token_bucket = TokenBucket(rate=2)
+        mock_sleep.side_effect = lambda seconds: setattr(
+            mock_monotonic, "return_value", mock_monotonic.return_value + seconds
+        )
+
+        for _ in range(3):
+            token_bucket.acquire()
+
+        mock_sleep.assert_called_once_with(0.5)
+
+
+@patch("flappy_detector.utils.alerting.time.sleep", MagicMock())
+class TestAlertSender(TestCase):
+    """Tests for the alert sender"""
+
+    def setUp(self) -> None:
+        self.datadog_client = MagicMock()
+        self.alert_sender = AlertSender(datadog_client=self.datadog_client, rate_per_sec=1000)
+
+    def test_send(self):
+        """Test every event is sent"""
+        self.datadog_client.Event.create.return_value = {"status": "ok"}
+
+        result = self.alert_sender.send(flappy_events=[MOCK_FLAPPY_EVENT] * 5)
+
+        self.assertEqual((result.sent, result.retried, result.failed), (5, 0, []))
+        self.assertEqual(self.datadog_client.Event.create.call_count, 5)
+
+    def test_send_with_alert_state(self):
+        """Test only claimed alerts are sent, along with recoveries, and failed claims are released"""
+        recovered_event = FlappyEvent(
+            account="MOCK_ACCOUNT",
+            region="MOCK_REGION",
+            environment="MOCK_ENVIRONMENT",
+            application="MOCK_APPLICATION",
+            group_name="MOCK_RECOVERED",
+        )
+        alert_state_store = MagicMock()
+        alert_state_store.claim.return_value = ([MOCK_FLAPPY_EVENT], [recovered_event])
+        self.alert_sender.alert_state_store = alert_state_store
+        self.datadog_client.Event.create.side_effect = lambda alert_type, **_: (
+            {"status": "ok"} if alert_type == "warning" else {"errors": ["Bad Request"]}
+        )
+
+        result = self.alert_sender.send(flappy_events=[MOCK_FLAPPY_EVENT] * 2)
+
+        self.assertEqual(
+            (result.sent, result.recovered, result.suppressed, result.failed),
+            (1, 0, 1, [recovered_event]),
+        )
+        alert_state_store.release.assert_called_once_with(flappy_events=[recovered_event])
+
+    def test_send_retried(self):
+        """Test rate limited events and server errors are retried"""
+        self.datadog_client.Event.create.side_effect = [
+            {"errors": ["Rate limit exceeded"]},
+            HTTPError(503),
+            {"status": "ok"},
+        ]
+
+        result = self.alert_sender.send(flappy_events=[MOCK_FLAPPY_EVENT])
+
+        self.assertEqual((result.sent, result.retried, result.failed), (1, 2, []))
+
+    def test_send_failed(self):
+        """Test events are given up on after the last attempt, or straight away for other errors"""
+        self.datadog_client.Event.create.side_effect = [HTTPError(500)] * 4 + [{"errors": ["Bad Request"]}]
+
+        result = self.alert_sender.send(flappy_events=[MOCK_FLAPPY_EVENT] * 2)
+
+        self.assertEqual((result.sent, result.retried, result.failed), (0, 3, [MOCK_FLAPPY_EVENT] * 2))
+        self.assertEqual(self.datadog_client.Event.create.call_count, 5)
+
+
+class _StandInServer(ThreadingHTTPServer):
+    """Local stand-in for the Datadog API, counting the requests it answers"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.statuses: List[int] = []
+        self.requests = 0
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """Answers each request with the next status from the server's list, then with 202s"""
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Respond to an event being created"""
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests += 1
+        status = self.server.statuses.pop(0) if self.server.statuses else 202
+        body = {"errors": ["Rate limit exceeded"]} if status == 429 else {"status": "ok"}
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *_):
+        """Keep the test output quiet"""
+
+
+@patch("flappy_detector.utils.alerting.time.sleep", MagicMock())
+class TestAlertSenderStandIn(TestCase):
+    """Tests for the alert sender against a local stand-in for the Datadog API"""
+
+    def setUp(self) -> None:
+        self.server = _StandInServer()
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        initialize(
+            api_key="MOCK_API_KEY",
+            app_key="MOCK_APP_KEY",
+            api_host=f"http://127.0.0.1:{self.server.server_address[1]}",
+        )
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_send(self):
+        """Test events are sent through rate limiting and server errors"""
+        self.server.statuses = [429, 500, 503]
+
+        alert_sender = AlertSender(datadog_client=api, rate_per_sec=1000)
+        result = alert_sender.send(flappy_events=[MOCK_FLAPPY_EVENT] * 10)
+
+        self.assertEqual((result.sent, result.retried, result.failed), (10, 3, []))
+        self.assertEqual(self.server.requests, 13)
@@ -0,0 +1,78 @@
+"""Tests for the assumed-role client cache"""
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from flappy_detector.utils.client_cache import AssumedRoleClientCache
+
+MOCK_ACCOUNT = "MOCK_ACCOUNT"
+MOCK_ROLE = "MOCK_ROLE"
+MOCK_REGION = "MOCK_REGION"
+MOCK_OTHER_REGION = "MOCK_OTHER_REGION"
+
+
+@patch("flappy_detector.utils.client_cache.boto3.session.Session")
+class TestAssumedRoleClientCache(TestCase):
+    """Tests for the assumed-role client cache"""
+
+    def setUp(self) -> None:
+        self.sts_client = MagicMock()
+        self.sts_client.assume_role.return_value = self._credentials(expires_in=timedelta(hours=1))
+        self.cache = AssumedRoleClientCache(sts_client=self.sts_client)
+
+    @staticmethod
+    def _credentials(expires_in: timedelta):
+        return {
+            "Credentials": {
+                "AccessKeyId": "MOCK_ACCESS_KEY_ID",
+                "SecretAccessKey": "MOCK_SECRET_ACCESS_KEY",
+                "SessionToken": "MOCK_SESSION_TOKEN",
+                "Expiration": datetime.now(timezone.utc) + expires_in,
+            }
+        }
+
+    def _get_client(self, region_name=MOCK_REGION):
+        return self.cache.get_boto3_client_for_account(
+            account_id=MOCK_ACCOUNT,
+            role_name=MOCK_ROLE,
+            client_name="ec2",
+            region_name=region_name,
+        )
+
+    def test_get_client(self, mock_session):
+        """Test the client is built from the assumed role's credentials"""
+        actual = self._get_client()
+
+        self.assertEqual(actual, mock_session.return_value.client.return_value)
+        self.sts_client.assume_role.assert_called_once_with(
+            RoleArn=f"arn:aws:iam::{MOCK_ACCOUNT}:role/{MOCK_ROLE}",
+            RoleSessionName="flappy_detector",
+        )
+        mock_session.assert_called_once_with(
+            aws_access_key_id="MOCK_ACCESS_KEY_ID",
+            aws_secret_access_key="MOCK_SECRET_ACCESS_KEY",
+            aws_session_token="MOCK_SESSION_TOKEN",
+        )
+        mock_session.return_value.client.assert_called_once_with("ec2", region_name=MOCK_REGION)
+
+    def test_get_client_cached(self, mock_session):
+        """Test clients are reused, and credentials are shared between regions"""
+        self._get_client()
+        self._get_client()
+        self._get_client(region_name=MOCK_OTHER_REGION)
+
+        self.sts_client.assume_role.assert_called_once()
+        self.assertEqual(mock_session.return_value.client.call_count, 2)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_get_client_expired(self, mock_session):
+        """Test clients aren't reused once their credentials are about to expire"""
+        self.sts_client.assume_role.return_value = self._credentials(expires_in=timedelta(minutes=1))
+
+        self._get_client()
+        self._get_client()
+
+        self.assertEqual(self.sts_client.assume_role.call_count, 2)
+        self.assertEqual(mock_session.return_value.client.call_count, 2)
+        self.assertEqual(self.cache.hits, 0)
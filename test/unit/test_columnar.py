@@ -0,0 +1,118 @@
+"""Tests for the columnar group-by"""
+import random
+from datetime import timedelta
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from flappy_detector.handlers.detect import FlappyDetector
+from flappy_detector.utils import columnar
+from flappy_detector.utils.enum import Ec2State
+
+MOCK_TEAM = "MOCK_TEAM"
+MOCK_RECORD = {
+    "account": "MOCK_ACCOUNT",
+    "region": "MOCK_REGION",
+    "environment": "MOCK_ENVIRONMENT",
+    "application": "MOCK_APPLICATION",
+    "group_name": "MOCK_GROUP_NAME",
+}
+
+
+class TestGroupEvents(TestCase):
+    """Tests for the columnar group-by, against the detector's loop"""
+
+    def setUp(self) -> None:
+        self.flappy_detector = FlappyDetector(
+            datadog_client=MagicMock(),
+            dynamodb_table=MagicMock(),
+            max_event_age=timedelta(minutes=120),
+            min_number_of_events=4,
+            min_spread=2,
+        )
+
+    def assert_same_as_loop(self, events):
+        """Assert both engines give the same FlappyEvents, in the same order"""
+        self.assertEqual(
+            columnar.group_events(events=events),
+            self.flappy_detector._group_events(events=events),
+        )
+
+    def test_group_events_unknown_state(self):
+        """Test a group starts at its first known state, and counts unknown states after that"""
+        self.assert_same_as_loop(
+            [
+                {**MOCK_RECORD, "state": "pending", "team": MOCK_TEAM},
+                {**MOCK_RECORD, "state": Ec2State.RUNNING.value},
+                {**MOCK_RECORD, "state": "pending"},
+                {**MOCK_RECORD, "state": Ec2State.TERMINATED},
+                {**MOCK_RECORD, "group_name": "MOCK_UNKNOWN", "state": "pending"},
+            ]
+        )
+
+    def test_group_events_team(self):
+        """Test groups take the first team set, or whatever their last record held without one"""
+        self.assert_same_as_loop(
+            [
+                {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "team": ""},
+                {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "team": MOCK_TEAM},
+                {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "team": "MOCK_OTHER"},
+                {**MOCK_RECORD, "group_name": "MOCK_NO_TEAM", "state": Ec2State.RUNNING.value},
+                {**MOCK_RECORD, "group_name": "MOCK_NO_TEAM", "state": Ec2State.RUNNING.value, "team": ""},
+            ]
+        )
+
+    def test_group_events_malformed(self):
+        """Test records with key attributes that can't be joined, or hashed, are skipped"""
+        self.assert_same_as_loop(
+            [
+                {**MOCK_RECORD, "application": None, "state": Ec2State.RUNNING.value},
+                {**MOCK_RECORD, "application": ["MOCK_APPLICATION"], "state": Ec2State.RUNNING.value},
+                {**MOCK_RECORD, "state": Ec2State.RUNNING.value},
+            ]
+        )
+
+    @patch("flappy_detector.utils.columnar.CHUNK_SIZE", 7)
+    def test_group_events_random(self):
+        """Test random records spread over chunks give the same FlappyEvents as the loop"""
+        rng = random.Random(0)
+        events = [
+            {
+                **MOCK_RECORD,
+                "group_name": f"MOCK_GROUP_{rng.randrange(5)}",
+                "state": rng.choice([Ec2State.RUNNING.value, Ec2State.TERMINATED.value, "pending"]),
+                **({"team": rng.choice([MOCK_TEAM, "", None])} if rng.random() < 0.5 else {}),
+            }
+            for _ in range(200)
+        ]
+
+        self.assert_same_as_loop(events)
+
+    @patch("flappy_detector.utils.columnar.CHUNK_SIZE", 2)
+    def test_group_events_across_chunks(self):
+        """Test groups started, teamed and malformed in one chunk are carried into the next"""
+        self.assert_same_as_loop(
+            [
+                {**MOCK_RECORD, "state": "pending"},
+                {**MOCK_RECORD, "application": None, "state": Ec2State.RUNNING.value},
+                {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "team": ""},
+                {**MOCK_RECORD, "application": None, "state": Ec2State.RUNNING.value},
+                {**MOCK_RECORD, "state": "pending", "team": MOCK_TEAM},
+                {**MOCK_RECORD, "state": Ec2State.TERMINATED.value, "team": "MOCK_OTHER"},
+            ]
+        )
+
+    def test_group_events_empty(self):
+        """Test no records give no FlappyEvents"""
+        self.assertEqual(columnar.group_events(events=iter([])), [])
+
+    def test_unknown_engine(self):
+        """Test the detector rejects engines it doesn't have"""
+        with self.assertRaises(ValueError):
+            FlappyDetector(
+                datadog_client=MagicMock(),
+                dynamodb_table=MagicMock(),
+                max_event_age=timedelta(minutes=120),
+                min_number_of_events=4,
+                min_spread=2,
+                engine="MOCK_ENGINE",
+            )
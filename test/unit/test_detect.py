@@ -1,14 +1,19 @@
 """Tests for the Detect lambda"""
+import json
 from decimal import Decimal
 from datetime import timedelta, datetime
 from unittest import TestCase
 from unittest.mock import MagicMock, patch, call, ANY
 
-from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.conditions import Attr, Key
 
-from flappy_detector.handlers.detect import FlappyDetector, handler
+from flappy_detector.handlers.detect import ENGINES, FlappyDetector, handler
 from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.alerting import _get_datadog_keys
 from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.rules import Rule, RuleIndex
+from flappy_detector.utils.snapshot import DetectionSnapshot
+from flappy_detector.utils.transitions import group_transitions
 
 
 MOCK_TEAM = "MOCK_TEAM"
@@ -21,7 +26,10 @@ MOCK_APPLICATION_FLAPPY = "MOCK_APPLICATION_FLAPPY"
 MOCK_ENVIRONMENT = "MOCK_ENVIRONMENT"
 MOCK_REGION = "MOCK_REGION"
 MOCK_ACCOUNT = "MOCK_ACCOUNT"
+MOCK_EVENT_ID = "MOCK_EVENT_ID"
 MOCK_EC2_TABLE = "MOCK_FLAPPY_DETECTOR_EC2_TABLE"
+MOCK_TIME_INDEX = "MOCK_FLAPPY_DETECTOR_EC2_TABLE_TIME_INDEX"
+MOCK_SNAPSHOT_TABLE = "MOCK_FLAPPY_DETECTOR_SNAPSHOT_TABLE"
 MOCK_MAX_EVENT_AGE_IN_MINS = 120
 MOCK_MIN_NUM_EVENTS = 4
 MOCK_MIN_SPREAD = 2
@@ -32,6 +40,25 @@ ENVIRONMENT_VARIABLES = {
     "FLAPPY_DETECTOR_MIN_SPREAD": str(MOCK_MIN_SPREAD),
 }
 MOCK_TIME_NOW = datetime(2020, 1, 1)
+MOCK_RECORD = {
+    "account": MOCK_ACCOUNT,
+    "region": MOCK_REGION,
+    "environment": MOCK_ENVIRONMENT,
+    "application": MOCK_APPLICATION_FLAPPY,
+    "group_name": MOCK_GROUP_NAME,
+}
+MOCK_PROJECTION = {
+    "ProjectionExpression": (
+        "#account, #region, #environment, #application, #group_name, #team, #state, #timestamp, #event_id"
+    ),
+    "ExpressionAttributeNames": {
+        f"#{attribute}": attribute
+        for attribute in [
+            "account", "region", "environment", "application", "group_name",
+            "team", "state", "timestamp", "event_id",
+        ]
+    },
+}
 
 
 @patch.dict("os.environ", ENVIRONMENT_VARIABLES)
@@ -39,6 +66,7 @@ class TestHandlerDetect(TestCase):
     """Tests for the Detect lambda"""
 
     def setUp(self) -> None:
+        _get_datadog_keys.cache_clear()
         self.datadog_client = MagicMock()
         self.dynamodb_table = MagicMock()
         self.max_event_age = timedelta(minutes=MOCK_MAX_EVENT_AGE_IN_MINS)
@@ -53,75 +81,628 @@ class TestHandlerDetect(TestCase):
             min_spread=self.min_spread,
         )
 
+    @patch("flappy_detector.utils.alerting.initialize", MagicMock())
     @patch("flappy_detector.handlers.detect.FlappyDetector")
     @patch("boto3.client")
     @patch("boto3.resource")
     def test_handler(self, mock_boto3_resource, mock_boto3_client, mock_flappy_detector):
         """Tests the Detect lambda handler function"""
+        mock_boto3_client.return_value.get_parameters.return_value = {
+            "Parameters": [
+                {"Name": "/account/app_auth/datadog/api_key", "Value": "MOCK_API_KEY"},
+                {"Name": "/account/app_auth/datadog/flappy_detector_app_key", "Value": "MOCK_APP_KEY"},
+            ]
+        }
+
         handler({}, None)
 
-        mock_boto3_client.return_value.get_parameter.assert_has_calls(
-            calls=[
-                call(
-                    Name="/account/app_auth/datadog/api_key",
-                    WithDecryption=True,
-                ),
-                call(
-                    Name="/account/app_auth/datadog/flappy_detector_app_key",
-                    WithDecryption=True,
-                ),
+        mock_boto3_client.return_value.get_parameters.assert_called_once_with(
+            Names=[
+                "/account/app_auth/datadog/api_key",
+                "/account/app_auth/datadog/flappy_detector_app_key",
             ],
-            any_order=True,
+            WithDecryption=True,
         )
         mock_boto3_resource.return_value.Table.assert_called_once_with(MOCK_EC2_TABLE)
         mock_flappy_detector.assert_called_once_with(
             datadog_client=ANY,
+            alert_sender=ANY,
+            metric_sender=ANY,
+            rule_index=None,
             dynamodb_table=mock_boto3_resource.return_value.Table.return_value,
             max_event_age=timedelta(minutes=MOCK_MAX_EVENT_AGE_IN_MINS),
             min_number_of_events=MOCK_MIN_NUM_EVENTS,
             min_spread=MOCK_MIN_SPREAD,
+            time_index_name=None,
+            include_legacy_events=False,
+            scan_segments=1,
+            engine="python",
+            detection="spread",
+            min_reversals=4,
+            max_transitions_per_group=1000,
+            rollup_table=None,
+            snapshot_store=None,
+            late_record_window=timedelta(minutes=30),
+        )
+        mock_flappy_detector.return_value.detect_flaps.assert_called_once_with(force_full_recompute=False)
+
+    @patch("flappy_detector.handlers.detect.initialize_datadog", MagicMock())
+    @patch("flappy_detector.handlers.detect.SnapshotStore")
+    @patch("flappy_detector.handlers.detect.FlappyDetector")
+    @patch("boto3.resource")
+    def test_handler_snapshot(self, mock_boto3_resource, mock_flappy_detector, mock_snapshot_store):
+        """Tests the Detect lambda handler function forcing a full recompute of the snapshot"""
+        with patch.dict("os.environ", {"FLAPPY_DETECTOR_SNAPSHOT_TABLE": MOCK_SNAPSHOT_TABLE}):
+            handler({"force_full_recompute": True}, None)
+
+        mock_boto3_resource.return_value.Table.assert_called_with(MOCK_SNAPSHOT_TABLE)
+        mock_snapshot_store.assert_called_once_with(
+            dynamodb_table=mock_boto3_resource.return_value.Table.return_value,
         )
-        mock_flappy_detector.return_value.detect_flaps.assert_called_once()
+        self.assertEqual(
+            mock_flappy_detector.call_args[1]["snapshot_store"],
+            mock_snapshot_store.return_value,
+        )
+        mock_flappy_detector.return_value.detect_flaps.assert_called_once_with(force_full_recompute=True)
 
-    def test_detect_flaps(self):
+    @patch.object(FlappyDetector, "_find_flapping")
+    @patch.object(FlappyDetector, "_group_events")
+    def test_detect_flaps(self, mock_group_events, mock_find_flapping):
         """Tests Detect detect_flaps"""
         self.handler._get_events = MagicMock()
-        self.handler._find_flapping_events = MagicMock()
         self.handler._send_alerts = MagicMock()
+        self.handler.metric_sender = MagicMock()
 
         self.handler.detect_flaps()
 
         self.handler._get_events.assert_called_once_with()
-        self.handler._find_flapping_events.assert_called_once_with(
+        mock_group_events.assert_called_once_with(
+            events=self.handler._get_events.return_value,
+        )
+        mock_find_flapping.assert_called_once_with(
+            flappy_events=mock_group_events.return_value,
+        )
+        self.handler._send_alerts.assert_called_once_with(
+            flapping_events=mock_find_flapping.return_value,
+        )
+        self.handler.metric_sender.send.assert_called_once_with(
+            flappy_events=mock_group_events.return_value,
+        )
+
+    @patch.object(FlappyDetector, "_find_cycling")
+    @patch("flappy_detector.handlers.detect.group_transitions")
+    def test_detect_flaps_transitions(self, mock_group_transitions, mock_find_cycling):
+        """Tests Detect detect_flaps ordering each group's changes"""
+        self.handler.detection = "transitions"
+        self.handler._get_events = MagicMock()
+        self.handler._send_alerts = MagicMock()
+        self.handler.metric_sender = MagicMock()
+        mock_group = MagicMock()
+        mock_group_transitions.return_value = [mock_group]
+
+        self.handler.detect_flaps()
+
+        mock_group_transitions.assert_called_once_with(
             events=self.handler._get_events.return_value,
+            max_events=1000,
         )
+        mock_find_cycling.assert_called_once_with(groups=[mock_group])
         self.handler._send_alerts.assert_called_once_with(
-            flapping_events=self.handler._find_flapping_events.return_value,
+            flapping_events=mock_find_cycling.return_value,
+        )
+        self.handler.metric_sender.send.assert_called_once_with(
+            flappy_events=[mock_group.flappy_event],
+        )
+
+    def test_detection(self):
+        """Tests unknown detections, and transitions without the individual records, are rejected"""
+        for kwargs in [
+                {"detection": "MOCK_DETECTION"},
+                {"detection": "transitions", "rollup_table": MagicMock()},
+                {"detection": "transitions", "snapshot_store": MagicMock()},
+        ]:
+            with self.subTest(**kwargs), self.assertRaises(ValueError):
+                FlappyDetector(
+                    datadog_client=self.datadog_client,
+                    dynamodb_table=self.dynamodb_table,
+                    max_event_age=self.max_event_age,
+                    min_number_of_events=self.min_number_of_events,
+                    min_spread=self.min_spread,
+                    **kwargs,
+                )
+
+    def test_find_cycling(self):
+        """Tests only groups reversing often enough are flapping, however their changes net out"""
+        events = []
+        for group_name, states in [
+                # Changed direction after every change
+                (MOCK_GROUP_NAME, [Ec2State.RUNNING, Ec2State.TERMINATED] * 3),
+                # Scaled up then back down, netting out like the above
+                (MOCK_GROUP_NAME_SCALE_UP, [Ec2State.RUNNING] * 3 + [Ec2State.TERMINATED] * 3),
+                # Reversed often, but too few changes
+                (MOCK_GROUP_NAME_SCALE_DOWN, [Ec2State.RUNNING, Ec2State.TERMINATED]),
+        ]:
+            events.extend(
+                {
+                    "account": MOCK_ACCOUNT,
+                    "region": MOCK_REGION,
+                    "environment": MOCK_ENVIRONMENT,
+                    "application": MOCK_APPLICATION_FLAPPY,
+                    "group_name": group_name,
+                    "state": state.value,
+                    "timestamp": Decimal(offset),
+                }
+                for offset, state in enumerate(states)
+            )
+
+        self.assertEqual(
+            [
+                flappy_event.group_name
+                for flappy_event in self.handler._find_cycling(
+                    groups=group_transitions(events=reversed(events), max_events=1000),
+                )
+            ],
+            [MOCK_GROUP_NAME],
+        )
+
+    @patch.object(FlappyDetector, "_get_snapshot")
+    def test_detect_flaps_rules(self, mock_get_snapshot):
+        """Tests Detect detect_flaps evaluating each group against its rules"""
+        self.handler.rule_index = MagicMock()
+        self.handler._send_alerts = MagicMock()
+        self.handler.metric_sender = MagicMock()
+
+        self.handler.detect_flaps(force_full_recompute=True)
+
+        mock_get_snapshot.assert_called_once_with(force_full_recompute=True)
+        self.handler.rule_index.find_flapping.assert_called_once_with(
+            groups=mock_get_snapshot.return_value.groups.values.return_value,
+            now=ANY,
+        )
+        self.handler._send_alerts.assert_called_once_with(
+            flapping_events=self.handler.rule_index.find_flapping.return_value,
+        )
+        self.handler.metric_sender.send.assert_called_once_with(
+            flappy_events=mock_get_snapshot.return_value.get_flappy_events.return_value,
+        )
+
+    @patch.dict(
+        "os.environ",
+        {
+            "FLAPPY_DETECTOR_RULES": json.dumps(
+                {
+                    "teams": {
+                        MOCK_TEAM: [{"max_event_age_in_mins": 360, "min_num_events": 10, "min_spread": 3}],
+                    },
+                }
+            ),
+        },
+    )
+    @patch("flappy_detector.handlers.detect.initialize_datadog", MagicMock())
+    @patch("flappy_detector.handlers.detect.FlappyDetector")
+    @patch("boto3.resource", MagicMock())
+    def test_handler_rules(self, mock_flappy_detector):
+        """Tests the Detect lambda handler with rule sets, defaulting to the global thresholds"""
+        handler({}, None)
+
+        rule_index = mock_flappy_detector.call_args.kwargs["rule_index"]
+        self.assertEqual(
+            rule_index.default,
+            (
+                Rule(
+                    window=self.max_event_age,
+                    min_number_of_events=MOCK_MIN_NUM_EVENTS,
+                    min_spread=MOCK_MIN_SPREAD,
+                ),
+            ),
+        )
+        self.assertEqual(
+            rule_index.teams,
+            {MOCK_TEAM: (Rule(window=timedelta(hours=6), min_number_of_events=10, min_spread=3),)},
+        )
+
+    def test_rules_widen_window(self):
+        """Tests the window read covers the longest rule"""
+        flappy_detector = FlappyDetector(
+            datadog_client=self.datadog_client,
+            dynamodb_table=self.dynamodb_table,
+            max_event_age=self.max_event_age,
+            min_number_of_events=self.min_number_of_events,
+            min_spread=self.min_spread,
+            rule_index=RuleIndex(
+                default=[Rule(window=timedelta(hours=6), min_number_of_events=4, min_spread=2)],
+            ),
+        )
+
+        self.assertEqual(flappy_detector.max_event_age, timedelta(hours=6))
+
+    @patch.object(FlappyDetector, "_get_rollups")
+    @patch.object(FlappyDetector, "_get_events")
+    def test_get_snapshot(self, mock_get_events, mock_get_rollups):
+        """Tests the records, or else the rollups, are bucketed by group"""
+        mock_get_events.return_value = [
+            {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "timestamp": Decimal(MOCK_TIME_NOW.timestamp())},
+        ]
+        mock_get_rollups.return_value = [
+            {
+                **MOCK_RECORD,
+                "key": FlappyEvent(**MOCK_RECORD).key,
+                "team": MOCK_TEAM,
+                "time_bucket": Decimal(int(MOCK_TIME_NOW.timestamp())),
+                "count": Decimal(3),
+                "spread": Decimal(-1),
+            },
+        ]
+
+        snapshot = self.handler._get_snapshot()
+        self.handler.rollup_table = MagicMock()
+        rollup_snapshot = self.handler._get_snapshot()
+
+        self.assertEqual(
+            [(group.team, group.buckets) for group in snapshot.groups.values()],
+            [(None, {int(MOCK_TIME_NOW.timestamp()): [1, 1, 1]})],
+        )
+        self.assertEqual(
+            [(group.team, group.buckets) for group in rollup_snapshot.groups.values()],
+            [(MOCK_TEAM, {int(MOCK_TIME_NOW.timestamp()): [3, -1, 3]})],
+        )
+        mock_get_rollups.assert_called_once_with(rollup_table=self.handler.rollup_table)
+
+    @patch.object(FlappyDetector, "_find_flapping")
+    @patch.object(FlappyDetector, "_group_rollups")
+    @patch.object(FlappyDetector, "_get_rollups")
+    def test_detect_flaps_rollups(self, mock_get_rollups, mock_group_rollups, mock_find_flapping):
+        """Tests Detect detect_flaps reading the rollups"""
+        self.handler.rollup_table = MagicMock()
+        self.handler._get_events = MagicMock()
+        self.handler._send_alerts = MagicMock()
+
+        self.handler.detect_flaps()
+
+        self.handler._get_events.assert_not_called()
+        mock_group_rollups.assert_called_once_with(
+            rollups=mock_get_rollups.return_value,
+        )
+        mock_get_rollups.assert_called_once_with(
+            rollup_table=self.handler.rollup_table,
+        )
+        mock_find_flapping.assert_called_once_with(
+            flappy_events=mock_group_rollups.return_value,
+        )
+        self.handler._send_alerts.assert_called_once_with(
+            flapping_events=mock_find_flapping.return_value,
+        )
+
+    @patch.object(FlappyDetector, "_find_flapping")
+    @patch.object(FlappyDetector, "_update_snapshot")
+    def test_detect_flaps_snapshot(self, mock_update_snapshot, mock_find_flapping):
+        """Tests Detect detect_flaps updating the snapshot"""
+        self.handler.snapshot_store = MagicMock()
+        self.handler._get_events = MagicMock()
+        self.handler._send_alerts = MagicMock()
+
+        self.handler.detect_flaps(force_full_recompute=True)
+
+        self.handler._get_events.assert_not_called()
+        mock_update_snapshot.assert_called_once_with(
+            snapshot_store=self.handler.snapshot_store,
+            force_full_recompute=True,
+        )
+        mock_find_flapping.assert_called_once_with(
+            flappy_events=mock_update_snapshot.return_value.get_flappy_events.return_value,
+        )
+        self.handler._send_alerts.assert_called_once_with(
+            flapping_events=mock_find_flapping.return_value,
+        )
+
+    @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+    def test_update_snapshot(self):
+        """Tests Detect update_snapshot stores records older than the late record window, and rereads newer"""
+        cut_off_bucket = int((MOCK_TIME_NOW - self.max_event_age).timestamp()) // 300 * 300
+        watermark = int(MOCK_TIME_NOW.timestamp()) - 30 * 60
+        expired_event = {**self._get_mock_record(Ec2State.RUNNING), "timestamp": cut_off_bucket - 1}
+        snapshot = DetectionSnapshot(watermark=watermark - 300)
+        snapshot.add_event(expired_event)
+        mock_snapshot_store = MagicMock()
+        mock_snapshot_store.load.return_value = snapshot
+        saved = []
+        mock_snapshot_store.save.side_effect = lambda snapshot: saved.append(snapshot.dumps())
+        settled_event = {**self._get_mock_record(Ec2State.TERMINATED), "timestamp": watermark - 60}
+        late_event = {**self._get_mock_record(Ec2State.RUNNING), "timestamp": watermark + 60}
+        self.handler._get_events = MagicMock(side_effect=[[settled_event], [late_event]])
+
+        actual = self.handler._update_snapshot(snapshot_store=mock_snapshot_store)
+
+        self.handler._get_events.assert_has_calls(
+            calls=[
+                call(after=Decimal(watermark - 300), until=Decimal(watermark)),
+                call(after=Decimal(watermark)),
+            ]
+        )
+        self.assertEqual(len(saved), 1)
+        saved_snapshot = DetectionSnapshot.loads(saved[0])
+        self.assertEqual(saved_snapshot.watermark, watermark)
+        self.assertEqual(
+            [(event.count, event.spread) for event in saved_snapshot.get_flappy_events()],
+            [(1, -1)],
+        )
+        self.assertEqual(
+            [(event.count, event.spread) for event in actual.get_flappy_events()],
+            [(2, 0)],
+        )
+
+    @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+    def test_update_snapshot_ahead(self):
+        """Tests Detect update_snapshot doesn't store a snapshot whose watermark hasn't moved"""
+        watermark = int(MOCK_TIME_NOW.timestamp()) - 10 * 60
+        mock_snapshot_store = MagicMock(load=MagicMock(return_value=DetectionSnapshot(watermark=watermark)))
+        self.handler._get_events = MagicMock(return_value=[])
+
+        self.handler._update_snapshot(snapshot_store=mock_snapshot_store)
+
+        self.handler._get_events.assert_called_once_with(after=Decimal(watermark))
+        mock_snapshot_store.save.assert_not_called()
+
+    @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+    def test_update_snapshot_full_recompute(self):
+        """Tests Detect update_snapshot reads the whole window when forced to"""
+        mock_snapshot_store = MagicMock()
+        self.handler._get_events = MagicMock(return_value=[])
+        cut_off_bucket = int((MOCK_TIME_NOW - self.max_event_age).timestamp()) // 300 * 300
+        watermark = int(MOCK_TIME_NOW.timestamp()) - 30 * 60
+
+        self.handler._update_snapshot(snapshot_store=mock_snapshot_store, force_full_recompute=True)
+
+        mock_snapshot_store.load.assert_not_called()
+        self.handler._get_events.assert_has_calls(
+            calls=[
+                call(after=Decimal(cut_off_bucket), until=Decimal(watermark)),
+                call(after=Decimal(watermark)),
+            ]
+        )
+
+    @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+    def test_get_events_since_watermark(self):
+        """Tests Detect get_events bounded by the watermarks"""
+        self.handler.time_index_name = MOCK_TIME_INDEX
+        self.dynamodb_table.query.return_value = {
+            "Items": []
+        }
+        after = Decimal(int(MOCK_TIME_NOW.timestamp()) - 600)
+        until = Decimal(int(MOCK_TIME_NOW.timestamp()) - 120)
+
+        list(self.handler._get_events(after=after, until=until))
+
+        self.dynamodb_table.query.assert_called_once_with(
+            IndexName=MOCK_TIME_INDEX,
+            KeyConditionExpression=(
+                Key("time_bucket").eq(int(after) // 3600 * 3600) & Key("timestamp").gte(after)
+            ),
+            FilterExpression=Attr("timestamp").lt(until),
+            **MOCK_PROJECTION,
+        )
+
+    @staticmethod
+    def _get_mock_record(state: Ec2State):
+        return {
+            "account": MOCK_ACCOUNT,
+            "region": MOCK_REGION,
+            "environment": MOCK_ENVIRONMENT,
+            "application": MOCK_APPLICATION_FLAPPY,
+            "group_name": MOCK_GROUP_NAME,
+            "state": state.value,
+        }
+
+    @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+    def test_get_rollups(self):
+        """Tests Detect get_rollups reads every bucket in the window"""
+        mock_rollup_table = MagicMock()
+        mock_rollup = {}
+        mock_rollup_table.query.return_value = {
+            "Items": [mock_rollup]
+        }
+        first_bucket = int((MOCK_TIME_NOW - self.max_event_age).timestamp()) // 300 * 300
+
+        rollups = list(self.handler._get_rollups(rollup_table=mock_rollup_table))
+
+        # Two hours of five minute buckets, inclusive of both ends
+        self.assertEqual(rollups, [mock_rollup] * 25)
+        mock_rollup_table.query.assert_has_calls(
+            calls=[
+                call(
+                    KeyConditionExpression=Key("time_bucket").eq(first_bucket + 300 * index),
+                    ProjectionExpression=(
+                        "#account, #region, #environment, #application, #group_name, #key, #team, #count, "
+                        "#spread, #known, #time_bucket"
+                    ),
+                    ExpressionAttributeNames={
+                        f"#{attribute}": attribute
+                        for attribute in [
+                            "account", "region", "environment", "application", "group_name",
+                            "key", "team", "count", "spread", "known", "time_bucket",
+                        ]
+                    },
+                )
+                for index in range(25)
+            ]
+        )
+
+    def test_group_rollups(self):
+        """Test Detect group_rollups sums each group's counters"""
+        base_rollup = {
+            "account": MOCK_ACCOUNT,
+            "region": MOCK_REGION,
+            "environment": MOCK_ENVIRONMENT,
+            "group_name": MOCK_GROUP_NAME,
+        }
+        flappy_key = "_".join(
+            [MOCK_ACCOUNT, MOCK_REGION, MOCK_ENVIRONMENT, MOCK_APPLICATION_FLAPPY, MOCK_GROUP_NAME]
+        )
+        scale_up_key = "_".join(
+            [MOCK_ACCOUNT, MOCK_REGION, MOCK_ENVIRONMENT, MOCK_APPLICATION_SCALE_UP, MOCK_GROUP_NAME]
+        )
+        rollups = [
+            {
+                **base_rollup,
+                "key": flappy_key,
+                "application": MOCK_APPLICATION_FLAPPY,
+                "count": Decimal(3),
+                "spread": Decimal(1),
+            },
+            {
+                **base_rollup,
+                "key": scale_up_key,
+                "application": MOCK_APPLICATION_SCALE_UP,
+                "count": Decimal(10),
+                "spread": Decimal(10),
+            },
+            {
+                **base_rollup,
+                "key": flappy_key,
+                "application": MOCK_APPLICATION_FLAPPY,
+                "team": MOCK_TEAM,
+                "count": Decimal(3),
+                "spread": Decimal(-1),
+            },
+        ]
+
+        actual = self.handler._group_rollups(rollups=rollups)
+
+        self.assertEqual(
+            actual,
+            [
+                FlappyEvent(
+                    account=MOCK_ACCOUNT,
+                    region=MOCK_REGION,
+                    environment=MOCK_ENVIRONMENT,
+                    application=MOCK_APPLICATION_FLAPPY,
+                    group_name=MOCK_GROUP_NAME,
+                    team=MOCK_TEAM,
+                    count=6,
+                    spread=0,
+                ),
+                FlappyEvent(
+                    account=MOCK_ACCOUNT,
+                    region=MOCK_REGION,
+                    environment=MOCK_ENVIRONMENT,
+                    application=MOCK_APPLICATION_SCALE_UP,
+                    group_name=MOCK_GROUP_NAME,
+                    count=10,
+                    spread=10,
+                ),
+            ]
         )
 
     @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
     def test_get_events(self):
-        """Tests Detect get_events"""
+        """Tests Detect get_events, scanning records in no particular order so none are dropped"""
+        mock_items = [{"event_id": MOCK_EVENT_ID}, {}, {"event_id": MOCK_EVENT_ID}, {}]
+        self.dynamodb_table.scan.return_value = {"Items": mock_items}
+
+        events = list(self.handler._get_events())
+
+        self.assertEqual(events, mock_items)
+        self.dynamodb_table.scan.assert_called_once_with(
+            FilterExpression=(
+                Attr("timestamp").gte(Decimal((MOCK_TIME_NOW - self.max_event_age).timestamp()))
+            ),
+            ConsistentRead=True,
+            **MOCK_PROJECTION,
+        )
+
+    @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+    @patch("boto3.session.Session")
+    def test_get_events_parallel_scan(self, mock_session):
+        """Tests Detect get_events using a parallel scan, each segment through a session of its own"""
+        self.handler.scan_segments = 2
+        self.dynamodb_table.name = MOCK_EC2_TABLE
+        mock_table = mock_session.return_value.resource.return_value.Table
+        mock_table.return_value.scan.side_effect = lambda Segment, **_: {"Items": [{"segment": Segment}]}
+
+        events = list(self.handler._get_events())
+
+        self.assertCountEqual(
+            events,
+            [{"segment": 0}, {"segment": 1}],
+        )
+        self.assertEqual(mock_session.call_count, 2)
+        mock_session.return_value.resource.assert_called_with("dynamodb")
+        mock_table.assert_called_with(MOCK_EC2_TABLE)
+        self.dynamodb_table.scan.assert_not_called()
+        mock_table.return_value.scan.assert_has_calls(
+            calls=[
+                call(
+                    FilterExpression=(
+                        Attr("timestamp").gte(Decimal((MOCK_TIME_NOW - self.max_event_age).timestamp()))
+                    ),
+                    ConsistentRead=True,
+                    Segment=segment,
+                    **MOCK_PROJECTION,
+                    TotalSegments=2,
+                )
+                for segment in range(2)
+            ],
+            any_order=True,
+        )
+
+    @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+    def test_get_events_time_index(self):
+        """Tests Detect get_events using the time index, reading the records of a redelivered event once"""
+        self.handler.time_index_name = MOCK_TIME_INDEX
+        mock_item = {"event_id": MOCK_EVENT_ID, "timestamp": Decimal(1)}
+        self.dynamodb_table.query.side_effect = [{"Items": [mock_item, mock_item]}] + [{"Items": []}] * 2
+        cut_off = Decimal((MOCK_TIME_NOW - self.max_event_age).timestamp())
+        first_bucket = int(cut_off) // 3600 * 3600
+
+        events = list(self.handler._get_events())
+
+        # A two hour window always overlaps three hourly buckets
+        self.assertEqual(events, [mock_item])
+        self.dynamodb_table.query.assert_has_calls(
+            calls=[
+                call(
+                    IndexName=MOCK_TIME_INDEX,
+                    KeyConditionExpression=(
+                        Key("time_bucket").eq(first_bucket + offset) & Key("timestamp").gte(cut_off)
+                    ),
+                    **MOCK_PROJECTION,
+                )
+                for offset in (0, 3600, 7200)
+            ]
+        )
+        self.dynamodb_table.scan.assert_not_called()
+
+    @patch("flappy_detector.handlers.detect.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+    def test_get_events_time_index_legacy(self):
+        """Tests Detect get_events using the time index while still reading legacy records"""
+        self.handler.time_index_name = MOCK_TIME_INDEX
+        self.handler.include_legacy_events = True
         mock_item = {}
-        self.dynamodb_table.scan.return_value = {
+        mock_legacy_item = {}
+        self.dynamodb_table.query.return_value = {
             "Items": [mock_item]
         }
+        self.dynamodb_table.scan.return_value = {
+            "Items": [mock_legacy_item]
+        }
+        cut_off = Decimal((MOCK_TIME_NOW - self.max_event_age).timestamp())
 
-        events = self.handler._get_events()
+        events = list(self.handler._get_events())
 
         self.assertEqual(
             events,
-            [mock_item],
+            [mock_item, mock_item, mock_item, mock_legacy_item],
         )
         self.dynamodb_table.scan.assert_called_once_with(
             FilterExpression=(
-                Attr("timestamp").gte(Decimal((MOCK_TIME_NOW - self.max_event_age).timestamp()))
+                Attr("timestamp").gte(cut_off) & Attr("time_bucket").not_exists()
             ),
             ConsistentRead=True,
+            **MOCK_PROJECTION,
         )
 
-    def test_find_flapping_events(self):
-        """Test Detect find_flapping_events"""
+    def test_group_events(self):
+        """Test Detect group_events"""
         base_event = {
             "account": MOCK_ACCOUNT,
             "region": MOCK_REGION,
@@ -165,24 +746,29 @@ class TestHandlerDetect(TestCase):
             ]
         ]
 
-        actual = self.handler._find_flapping_events(events=events)
-        self.assertEqual(
-            actual,
-            [
-                FlappyEvent(
-                    account=MOCK_ACCOUNT,
-                    region=MOCK_REGION,
-                    environment=MOCK_ENVIRONMENT,
-                    application=MOCK_APPLICATION_FLAPPY,
-                    group_name=MOCK_GROUP_NAME,
-                    count=6,
-                    spread=0,
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                self.handler.engine = engine
+                actual = self.handler._find_flapping(
+                    flappy_events=self.handler._group_events(events=events),
+                )
+                self.assertEqual(
+                    actual,
+                    [
+                        FlappyEvent(
+                            account=MOCK_ACCOUNT,
+                            region=MOCK_REGION,
+                            environment=MOCK_ENVIRONMENT,
+                            application=MOCK_APPLICATION_FLAPPY,
+                            group_name=MOCK_GROUP_NAME,
+                            count=6,
+                            spread=0,
+                        )
+                    ]
                 )
-            ]
-        )
 
-    def test_find_flapping_events_by_group(self):
-        """Test Detect find_flapping_events separated by group"""
+    def test_group_events_by_group(self):
+        """Test Detect group_events separated by group"""
         base_event = {
             "account": MOCK_ACCOUNT,
             "region": MOCK_REGION,
@@ -226,24 +812,63 @@ class TestHandlerDetect(TestCase):
             ]
         ]
 
-        actual = self.handler._find_flapping_events(events=events)
-        self.assertEqual(
-            actual,
-            [
-                FlappyEvent(
-                    account=MOCK_ACCOUNT,
-                    region=MOCK_REGION,
-                    environment=MOCK_ENVIRONMENT,
-                    application=MOCK_APPLICATION_FLAPPY,
-                    group_name=MOCK_GROUP_NAME,
-                    count=6,
-                    spread=0,
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                self.handler.engine = engine
+                actual = self.handler._find_flapping(
+                    flappy_events=self.handler._group_events(events=events),
+                )
+                self.assertEqual(
+                    actual,
+                    [
+                        FlappyEvent(
+                            account=MOCK_ACCOUNT,
+                            region=MOCK_REGION,
+                            environment=MOCK_ENVIRONMENT,
+                            application=MOCK_APPLICATION_FLAPPY,
+                            group_name=MOCK_GROUP_NAME,
+                            count=6,
+                            spread=0,
+                        )
+                    ]
                 )
-            ]
-        )
 
-    def test_find_flapping_events_malformed(self):
-        """Test Detect find_flapping_events with malformed event"""
+    def test_group_events_streaming(self):
+        """Test Detect group_events consumes events lazily"""
+        def events():
+            for state in [Ec2State.RUNNING, Ec2State.TERMINATED] * 3:
+                yield {
+                    "account": MOCK_ACCOUNT,
+                    "region": MOCK_REGION,
+                    "environment": MOCK_ENVIRONMENT,
+                    "application": MOCK_APPLICATION_FLAPPY,
+                    "group_name": MOCK_GROUP_NAME,
+                    "state": state.value,
+                }
+
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                self.handler.engine = engine
+                actual = self.handler._find_flapping(
+                    flappy_events=self.handler._group_events(events=events()),
+                )
+                self.assertEqual(
+                    actual,
+                    [
+                        FlappyEvent(
+                            account=MOCK_ACCOUNT,
+                            region=MOCK_REGION,
+                            environment=MOCK_ENVIRONMENT,
+                            application=MOCK_APPLICATION_FLAPPY,
+                            group_name=MOCK_GROUP_NAME,
+                            count=6,
+                            spread=0,
+                        )
+                    ]
+                )
+
+    def test_group_events_malformed(self):
+        """Test Detect group_events with malformed event"""
         events = [
             {
                 "account": MOCK_ACCOUNT,
@@ -254,14 +879,19 @@ class TestHandlerDetect(TestCase):
             }
         ]
 
-        actual = self.handler._find_flapping_events(events=events)
-        self.assertEqual(
-            actual,
-            []
-        )
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                self.handler.engine = engine
+                actual = self.handler._find_flapping(
+                    flappy_events=self.handler._group_events(events=events),
+                )
+                self.assertEqual(
+                    actual,
+                    []
+                )
 
-    def test_find_flapping_events_team(self):
-        """Test Detect find_flapping_events with initially missing team"""
+    def test_group_events_team(self):
+        """Test Detect group_events with initially missing team"""
         events = [
             {
                 "account": MOCK_ACCOUNT,
@@ -298,22 +928,27 @@ class TestHandlerDetect(TestCase):
             },
         ]
 
-        actual = self.handler._find_flapping_events(events=events)
-        self.assertEqual(
-            actual,
-            [
-                FlappyEvent(
-                    account=MOCK_ACCOUNT,
-                    region=MOCK_REGION,
-                    environment=MOCK_ENVIRONMENT,
-                    application=MOCK_APPLICATION_FLAPPY,
-                    group_name=MOCK_GROUP_NAME,
-                    team=MOCK_TEAM,
-                    count=4,
-                    spread=0,
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                self.handler.engine = engine
+                actual = self.handler._find_flapping(
+                    flappy_events=self.handler._group_events(events=events),
+                )
+                self.assertEqual(
+                    actual,
+                    [
+                        FlappyEvent(
+                            account=MOCK_ACCOUNT,
+                            region=MOCK_REGION,
+                            environment=MOCK_ENVIRONMENT,
+                            application=MOCK_APPLICATION_FLAPPY,
+                            group_name=MOCK_GROUP_NAME,
+                            team=MOCK_TEAM,
+                            count=4,
+                            spread=0,
+                        )
+                    ],
                 )
-            ],
-        )
 
     def test_send_alerts(self):
         """Test Detect send alerts"""
@@ -0,0 +1,108 @@
+"""Tests for the DynamoDB helpers"""
+from unittest import TestCase
+from unittest.mock import MagicMock, call
+
+from flappy_detector.utils.dynamodb import build_projection, drop_redelivered, iterate_pages, parallel_scan
+
+
+class TestDynamoDB(TestCase):
+    """Tests for the DynamoDB helpers"""
+
+    def test_build_projection(self):
+        """Test build_projection aliases every attribute"""
+        self.assertEqual(
+            build_projection(["account", "timestamp"]),
+            {
+                "ProjectionExpression": "#account, #timestamp",
+                "ExpressionAttributeNames": {
+                    "#account": "account",
+                    "#timestamp": "timestamp",
+                },
+            },
+        )
+
+    def test_iterate_pages(self):
+        """Test iterate_pages follows LastEvaluatedKey"""
+        mock_scan = MagicMock(
+            side_effect=[
+                {"Items": [{"page": 1}], "LastEvaluatedKey": {"id": 1}},
+                {"Items": [{"page": 2}]},
+            ]
+        )
+
+        actual = list(iterate_pages(mock_scan, ConsistentRead=True))
+
+        self.assertEqual(
+            actual,
+            [[{"page": 1}], [{"page": 2}]],
+        )
+        mock_scan.assert_has_calls(
+            calls=[
+                call(ConsistentRead=True),
+                call(ConsistentRead=True, ExclusiveStartKey={"id": 1}),
+            ]
+        )
+
+    def test_drop_redelivered(self):
+        """Test drop_redelivered drops records of events already read, holding one timestamp's ids at once"""
+        records = [
+            {"timestamp": 1, "event_id": "MOCK_EVENT_ID"},
+            {"timestamp": 1},
+            {"timestamp": 1, "event_id": "MOCK_OTHER_EVENT_ID"},
+            {"timestamp": 1, "event_id": "MOCK_EVENT_ID"},
+            {"timestamp": 1},
+            {"timestamp": 2, "event_id": "MOCK_NEXT_EVENT_ID"},
+        ]
+        actual = drop_redelivered(records)
+
+        self.assertEqual([next(actual) for _ in range(5)], records[:3] + records[4:])
+        # Only the ids of the latest timestamp are held
+        self.assertEqual(actual.gi_frame.f_locals["event_ids"], {"MOCK_NEXT_EVENT_ID"})
+        self.assertEqual(list(actual), [])
+
+    def test_parallel_scan(self):
+        """Test parallel_scan reads every page of every segment"""
+        def mock_scan(Segment, TotalSegments, ExclusiveStartKey=None, **_):  # pylint: disable=invalid-name
+            if ExclusiveStartKey:
+                return {"Items": [(Segment, 2)]}
+            return {"Items": [(Segment, 1)], "LastEvaluatedKey": {"segment": Segment, "total": TotalSegments}}
+
+        actual = list(parallel_scan(lambda: mock_scan, total_segments=3, max_workers=2))
+
+        self.assertCountEqual(
+            actual,
+            [(segment, page) for segment in range(3) for page in (1, 2)],
+        )
+
+    def test_parallel_scan_error(self):
+        """Test parallel_scan raises errors from a segment"""
+        def mock_scan(Segment, **_):  # pylint: disable=invalid-name
+            if Segment == 1:
+                raise ValueError("MOCK_ERROR")
+            return {"Items": [Segment]}
+
+        with self.assertRaises(ValueError):
+            list(parallel_scan(lambda: mock_scan, total_segments=2))
+
+    def test_parallel_scan_isolated(self):
+        """Test each segment scans through its own scan function, with its own copy of the arguments"""
+        names = {"#timestamp": "timestamp"}
+        mock_scans = []
+
+        def get_scan():
+            def mock_scan(Segment, ExpressionAttributeNames, **_):  # pylint: disable=invalid-name
+                # Like boto3's injector, which adds the filter's placeholders in place
+                ExpressionAttributeNames[f"#n{Segment}"] = "segment"
+                return {"Items": [sorted(ExpressionAttributeNames)]}
+
+            mock_scans.append(mock_scan)
+            return mock_scan
+
+        actual = list(parallel_scan(get_scan, total_segments=3, ExpressionAttributeNames=names))
+
+        self.assertEqual(len(mock_scans), 3)
+        self.assertCountEqual(
+            actual,
+            [["#n0", "#timestamp"], ["#n1", "#timestamp"], ["#n2", "#timestamp"]],
+        )
+        self.assertEqual(names, {"#timestamp": "timestamp"})
@@ -0,0 +1,35 @@
+"""Tests for parsing the time of CloudWatch events"""
+from unittest import TestCase
+from unittest.mock import patch
+
+from flappy_detector.utils.event_time import parse_event_time
+
+
+class TestEventTime(TestCase):
+    """Tests for parsing the time of CloudWatch events"""
+
+    @patch("dateutil.parser.parse")
+    def test_parse_event_time(self, mock_parse):
+        """Test CloudWatch's format is parsed without dateutil"""
+        for value, timestamp in [
+                ("2021-01-30T03:37:55Z", 1611977875),
+                ("1970-01-01T00:00:00Z", 0),
+                ("2020-02-29T23:59:59Z", 1583020799),
+        ]:
+            with self.subTest(value=value):
+                self.assertEqual(parse_event_time(value), timestamp)
+
+        mock_parse.assert_not_called()
+
+    def test_parse_event_time_fallback(self):
+        """Test other formats, and invalid dates in CloudWatch's format, fall back to dateutil"""
+        for value, timestamp in [
+                ("2021-01-30T03:37:55.250Z", 1611977875),
+                ("2021-01-30T03:37:55+00:00", 1611977875),
+                ("2021-01-30T04:37:55+01:00", 1611977875),
+        ]:
+            with self.subTest(value=value):
+                self.assertEqual(parse_event_time(value), timestamp)
+
+        with self.assertRaises(ValueError):
+            parse_event_time("2021-02-30T03:37:55Z")
@@ -0,0 +1,50 @@
+"""Tests for the FlappyEvent model"""
+from unittest import TestCase
+
+from flappy_detector.models import FlappyEvent
+
+MOCK_TEAM = "MOCK_TEAM"
+MOCK_KEY_ATTRIBUTES = (
+    "MOCK_ACCOUNT",
+    "MOCK_REGION",
+    "MOCK_ENVIRONMENT",
+    "MOCK_APPLICATION",
+    "MOCK_GROUP_NAME",
+)
+
+
+class TestFlappyEvent(TestCase):
+    """Tests for the FlappyEvent model"""
+
+    def test_key(self):
+        """Test the key joins the key attributes, and can be built without a FlappyEvent"""
+        flappy_event = FlappyEvent(*MOCK_KEY_ATTRIBUTES)
+
+        self.assertEqual(flappy_event.key, "_".join(MOCK_KEY_ATTRIBUTES))
+        self.assertEqual(FlappyEvent.get_key(MOCK_KEY_ATTRIBUTES), flappy_event.key)
+
+    def test_eq(self):
+        """Test FlappyEvents are equal when all their attributes are"""
+        flappy_event = FlappyEvent(*MOCK_KEY_ATTRIBUTES, team=MOCK_TEAM, count=6)
+
+        self.assertEqual(flappy_event, FlappyEvent(*MOCK_KEY_ATTRIBUTES, team=MOCK_TEAM, count=6))
+        self.assertNotEqual(flappy_event, FlappyEvent(*MOCK_KEY_ATTRIBUTES, count=6))
+        self.assertNotEqual(flappy_event, FlappyEvent(*MOCK_KEY_ATTRIBUTES, team=MOCK_TEAM, spread=1))
+        self.assertNotEqual(flappy_event, flappy_event.key)
+
+    def test_slots(self):
+        """Test FlappyEvents don't carry a per instance dict"""
+        with self.assertRaises(AttributeError):
+            FlappyEvent(*MOCK_KEY_ATTRIBUTES).unknown = None  # pylint: disable=assigning-non-slot
+
+    def test_tags(self):
+        """Test the tags are built once, and again when the team changes"""
+        flappy_event = FlappyEvent(*MOCK_KEY_ATTRIBUTES)
+        tags = flappy_event.tags
+
+        self.assertIs(flappy_event.tags, tags)
+        self.assertNotIn(f"team:{MOCK_TEAM}", tags)
+
+        flappy_event.team = MOCK_TEAM
+
+        self.assertEqual(flappy_event.tags, tags + (f"team:{MOCK_TEAM}",))
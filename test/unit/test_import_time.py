@@ -0,0 +1,34 @@
+"""Tests for what each Lambda imports at its cold start"""
+from unittest import TestCase
+
+from test.benchmark.bench_import_time import HANDLERS, get_import_times
+
+# Modules none of the Lambdas need at runtime, each taking a noticeable part of a cold start
+UNNEEDED_MODULES = {
+    # Only used for type hints
+    "botostubs",
+    # Imports setuptools, for strtobool
+    "distutils",
+    # Only imported when patch_all patches every library X-Ray supports
+    "aws_xray_sdk.ext.dbapi2",
+    "aws_xray_sdk.ext.sqlite3.patch",
+}
+
+
+class TestImportTime(TestCase):
+    """Tests for what each Lambda imports at its cold start"""
+
+    def test_import_time(self):
+        """Test no handler imports modules it doesn't need"""
+        for handler in HANDLERS:
+            with self.subTest(handler=handler):
+                import_times = get_import_times(f"flappy_detector.handlers.{handler}")
+
+                self.assertIn(f"flappy_detector.handlers.{handler}", import_times)
+                self.assertFalse(UNNEEDED_MODULES & set(import_times))
+
+    def test_import_time_ingest(self):
+        """Test the ingest Lambda doesn't import Datadog, which it never calls"""
+        import_times = get_import_times("flappy_detector.handlers.ingest")
+
+        self.assertNotIn("datadog", import_times)
@@ -1,22 +1,37 @@
 """Tests for the Ingest lambda"""
 import json
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest import TestCase
-from unittest.mock import MagicMock, patch, call, ANY
+from unittest.mock import MagicMock, patch, call
 
 from amplify_aws_utils.resource_helper import dict_to_boto3_tags
+from botocore.exceptions import ClientError
 
-from flappy_detector.handlers.ingest import Ingestor, handler
+from flappy_detector.handlers.detect import FlappyDetector
+from flappy_detector.handlers.ingest import (
+    Ingestor,
+    MetadataLookupError,
+    MetadataLookupFailure,
+    ROLLUP_MAX_ATTEMPTS,
+    handler,
+    _get_client_cache,
+    _get_dynamodb_table,
+    _get_metadata_cache,
+)
+from flappy_detector.utils.dynamodb import BatchWriteResult, UnprocessedItemsError
 from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.metadata_cache import InstanceMetadataCache
 
 
 MOCK_GROUP_NAME = "MOCK_GROUP_NAME"
 MOCK_INSTANCE_ID = "MOCK_INSTANCE_ID"
+MOCK_EVENT_ID = "MOCK_EVENT_ID"
 MOCK_TEAM = "MOCK_TEAM"
 MOCK_APPLICATION_FLAPPY = "MOCK_APPLICATION_FLAPPY"
 MOCK_ENVIRONMENT = "MOCK_ENVIRONMENT"
 MOCK_REGION = "MOCK_REGION"
+MOCK_REGION_FAILING = "MOCK_REGION_FAILING"
 MOCK_ACCOUNT = "MOCK_ACCOUNT"
 MOCK_EC2_TABLE = "MOCK_FLAPPY_DETECTOR_EC2_TABLE"
 MOCK_ROLE = "MOCK_FLAPPY_DETECTOR_ROLE"
@@ -25,6 +40,25 @@ ENVIRONMENT_VARIABLES = {
     "FLAPPY_DETECTOR_ROLE": MOCK_ROLE,
 }
 MOCK_TIME_NOW = datetime(2020, 1, 1)
+MOCK_GROUP = {
+    "account": MOCK_ACCOUNT,
+    "region": MOCK_REGION,
+    "environment": MOCK_ENVIRONMENT,
+    "application": MOCK_APPLICATION_FLAPPY,
+    "group_name": MOCK_GROUP_NAME,
+}
+
+
+def _mock_cloudwatch_event(event_id, **fields):
+    """A CloudWatch Event for an EC2 State Change, with the given fields replaced"""
+    return {
+        "id": event_id,
+        "account": MOCK_ACCOUNT,
+        "region": MOCK_REGION,
+        "time": "2021-01-30T03:37:55Z",
+        "detail": {"instance-id": MOCK_INSTANCE_ID, "state": Ec2State.RUNNING.value},
+        **fields,
+    }
 
 
 @patch.dict("os.environ", ENVIRONMENT_VARIABLES)
@@ -32,6 +66,9 @@ class TestHandlerIngest(TestCase):
     """Tests for the Ingest lambda"""
 
     def setUp(self) -> None:
+        _get_client_cache.cache_clear()
+        _get_dynamodb_table.cache_clear()
+        _get_metadata_cache.cache_clear()
         self.sts_client = MagicMock()
         self.dynamodb_table = MagicMock()
 
@@ -40,36 +77,125 @@ class TestHandlerIngest(TestCase):
             dynamodb_table=self.dynamodb_table,
         )
 
-    @patch("flappy_detector.handlers.ingest.STS")
+    @patch("flappy_detector.handlers.ingest.InstanceMetadataCache")
+    @patch("flappy_detector.handlers.ingest.AssumedRoleClientCache")
     @patch("flappy_detector.handlers.ingest.Ingestor")
     @patch("boto3.client")
     @patch("boto3.resource")
-    def test_handler(self, mock_boto3_resource, mock_boto3_client, mock_ingestor, mock_sts):
+    def test_handler(
+            self,
+            mock_boto3_resource,
+            mock_boto3_client,
+            mock_ingestor,
+            mock_client_cache,
+            mock_metadata_cache,
+    ):
         """Tests the Ingest lambda handler function"""
         mock_event = {}
-        handler(
-            {
-                "Records": [
-                    {
-                        "Sns": {
-                            "Message": json.dumps(mock_event)
-                        }
-                    },
-                ]
-            },
-            None,
-        )
+        lambda_event = {"Records": [{"Sns": {"Message": json.dumps(mock_event)}}]}
+
+        handler(lambda_event, None)
+        handler(lambda_event, None)
 
         mock_boto3_client.assert_called_once_with("sts")
-        mock_sts.assert_called_once_with(
+        mock_client_cache.assert_called_once_with(
             sts_client=mock_boto3_client.return_value,
         )
         mock_boto3_resource.return_value.Table.assert_called_once_with(MOCK_EC2_TABLE)
-        mock_ingestor.assert_called_once_with(
-            sts_client=ANY,
+        mock_ingestor.assert_called_with(
+            sts_client=mock_client_cache.return_value,
             dynamodb_table=mock_boto3_resource.return_value.Table.return_value,
+            max_workers=8,
+            metadata_cache=mock_metadata_cache.return_value,
+            rollup_table=None,
+        )
+        mock_metadata_cache.assert_called_once_with(
+            ttl=timedelta(minutes=360),
+            dynamodb_table=None,
+        )
+        mock_ingestor.return_value.ingest_events.assert_called_with(events=[mock_event])
+
+    @patch("flappy_detector.handlers.ingest.Ingestor")
+    @patch("flappy_detector.handlers.ingest._get_client_cache", MagicMock())
+    @patch("flappy_detector.handlers.ingest._get_metadata_cache", MagicMock())
+    @patch("flappy_detector.handlers.ingest._get_dynamodb_table", MagicMock())
+    def test_handler_sqs(self, mock_ingestor):
+        """Tests the Ingest lambda handler reports only the SQS messages whose events failed"""
+        mock_events = [_mock_cloudwatch_event(f"MOCK_EVENT_ID_{index}") for index in range(4)]
+        bad_events = [
+            {key: value for key, value in mock_events[0].items() if key != "account"},
+            _mock_cloudwatch_event("MOCK_EVENT_ID_6", time="MOCK_NOT_A_TIME"),
+            _mock_cloudwatch_event("MOCK_EVENT_ID_7", detail={"state": Ec2State.RUNNING.value}),
+            _mock_cloudwatch_event("MOCK_EVENT_ID_8", region=None),
+        ]
+        lambda_event = {
+            "Records": [
+                # Raw delivery
+                {"eventSource": "aws:sqs", "messageId": "0", "body": json.dumps(mock_events[0])},
+                # Wrapped in an SNS notification
+                *[
+                    {
+                        "eventSource": "aws:sqs",
+                        "messageId": str(index),
+                        "body": json.dumps({"Type": "Notification", "Message": json.dumps(mock_event)}),
+                    }
+                    for index, mock_event in enumerate(mock_events[1:], 1)
+                ],
+                {"eventSource": "aws:sqs", "messageId": "4", "body": "MOCK_NOT_JSON"},
+                # Missing or malformed fields are caught before any event is ingested
+                *[
+                    {"eventSource": "aws:sqs", "messageId": str(index), "body": json.dumps(bad_event)}
+                    for index, bad_event in enumerate(bad_events, 5)
+                ],
+            ]
+        }
+        mock_ingestor.return_value.metadata_failures = [
+            MetadataLookupFailure(
+                account=MOCK_ACCOUNT,
+                region=MOCK_REGION_FAILING,
+                events=[{"event_id": "MOCK_EVENT_ID_1"}],
+                error=Exception(),
+            ),
+        ]
+        mock_ingestor.return_value.rollup_error = None
+        mock_ingestor.return_value.ingest_events.side_effect = UnprocessedItemsError(
+            result=BatchWriteResult(unprocessed=[{"event_id": "MOCK_EVENT_ID_3"}]),
+        )
+
+        response = handler(lambda_event, None)
+
+        mock_ingestor.return_value.ingest_events.assert_called_once_with(events=mock_events)
+        self.assertEqual(
+            response,
+            {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in "4567831"]},
         )
-        mock_ingestor.return_value.ingest_events.assert_called_once_with(events=[mock_event])
+
+    @patch("flappy_detector.handlers.ingest.Ingestor")
+    @patch("flappy_detector.handlers.ingest._get_client_cache", MagicMock())
+    @patch("flappy_detector.handlers.ingest._get_metadata_cache", MagicMock())
+    @patch("flappy_detector.handlers.ingest._get_dynamodb_table", MagicMock())
+    def test_handler_sqs_success(self, mock_ingestor):
+        """Tests the Ingest lambda handler reports no failures, unless rollups failed along with a write"""
+        mock_ingestor.return_value.metadata_failures = []
+        lambda_event = {
+            "Records": [
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": message_id,
+                    "body": json.dumps(_mock_cloudwatch_event(message_id)),
+                }
+                for message_id in "01"
+            ]
+        }
+
+        for rollup_error, expected in [(None, []), (ValueError("MOCK_ERROR"), ["0", "1"])]:
+            with self.subTest(rollup_error=rollup_error):
+                mock_ingestor.return_value.rollup_error = rollup_error
+
+                self.assertEqual(
+                    handler(lambda_event, None),
+                    {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in expected]},
+                )
 
     def test_ingest_events(self):
         """Test Ingest ingest_events"""
@@ -90,20 +216,120 @@ class TestHandlerIngest(TestCase):
             events=self.handler._find_metadata.return_value,
         )
 
+    def test_ingest_events_rollups(self):
+        """Test Ingest ingest_events updates the rollups"""
+        self.handler.rollup_table = MagicMock()
+        self.handler._group_events = MagicMock()
+        self.handler._find_metadata = MagicMock()
+        self.handler._write_to_dynamodb = MagicMock()
+        self.handler._update_rollups = MagicMock()
+
+        self.handler.ingest_events(events=[{}])
+
+        self.handler._update_rollups.assert_called_once_with(
+            rollup_table=self.handler.rollup_table,
+            events=self.handler._find_metadata.return_value,
+        )
+
+    def test_ingest_events_unprocessed(self):
+        """Test Ingest ingest_events updates the rollups before failing on records that couldn't be written"""
+        self.handler.rollup_table = MagicMock()
+        self.handler._group_events = MagicMock()
+        self.handler._find_metadata = MagicMock()
+        self.handler._write_to_dynamodb = MagicMock(
+            side_effect=UnprocessedItemsError(result=BatchWriteResult(unprocessed=[{}])),
+        )
+
+        for rollup_error in [None, ValueError("MOCK_ERROR")]:
+            with self.subTest(rollup_error=rollup_error):
+                self.handler._update_rollups = MagicMock(side_effect=rollup_error)
+
+                # A rollup error doesn't replace the write's error, it's kept for the handler
+                with self.assertRaises(UnprocessedItemsError):
+                    self.handler.ingest_events(events=[{}])
+
+                self.assertIs(self.handler.rollup_error, rollup_error)
+                self.handler._update_rollups.assert_called_once_with(
+                    rollup_table=self.handler.rollup_table,
+                    events=self.handler._find_metadata.return_value,
+                )
+
+    def test_ingest_events_metadata_failure(self):
+        """Test Ingest ingest_events writes what it can before failing on metadata lookup errors"""
+        mock_failure = MetadataLookupFailure(
+            account=MOCK_ACCOUNT,
+            region=MOCK_REGION_FAILING,
+            events=[],
+            error=Exception(),
+        )
+        self.handler._group_events = MagicMock()
+        self.handler._write_to_dynamodb = MagicMock()
+
+        def mock_find_metadata(grouped_events):
+            self.handler.metadata_failures = [mock_failure]
+            return grouped_events
+
+        self.handler._find_metadata = MagicMock(side_effect=mock_find_metadata)
+
+        with self.assertRaises(MetadataLookupError) as context:
+            self.handler.ingest_events(events=[{}])
+
+        self.assertEqual(context.exception.failures, [mock_failure])
+        self.handler._write_to_dynamodb.assert_called_once_with(
+            events=self.handler._group_events.return_value,
+        )
+
     def test_group_events(self):
         """Test Ingest group_events"""
-        mock_events = [
-            {
-                "region": MOCK_REGION,
-                "account": MOCK_ACCOUNT,
-                "time": MOCK_TIME_NOW.isoformat(),
-                "detail": {
-                    "instance-id": MOCK_INSTANCE_ID,
-                    "state": Ec2State.TERMINATED.value,
-                }
+        for event_time, timestamp in [
+                # CloudWatch's format
+                ("2020-01-01T00:00:00Z", 1577836800),
+                # Anything else is parsed by dateutil
+                (MOCK_TIME_NOW.isoformat(), int(MOCK_TIME_NOW.timestamp())),
+        ]:
+            mock_events = [
+                _mock_cloudwatch_event(
+                    None,
+                    time=event_time,
+                    detail={"instance-id": MOCK_INSTANCE_ID, "state": Ec2State.TERMINATED.value},
+                ),
+            ]
+            expected = {
+                MOCK_ACCOUNT: {
+                    MOCK_REGION: [
+                        {
+                            "state": Ec2State.TERMINATED.value,
+                            "timestamp": timestamp,
+                            "instance_id": MOCK_INSTANCE_ID,
+                        },
+                    ]
+                },
             }
-        ]
-        expected = {
+
+            with self.subTest(event_time=event_time):
+                actual = self.handler._group_events(events=mock_events)
+
+                self.assertEqual(
+                    actual,
+                    expected,
+                )
+
+    def test_group_events_duplicates(self):
+        """Test Ingest group_events keeps each event's id, dropping events redelivered within the batch"""
+        mock_event = _mock_cloudwatch_event(MOCK_EVENT_ID)
+
+        actual = self.handler._group_events(
+            events=[mock_event, {**mock_event, "id": "MOCK_OTHER_EVENT_ID"}, mock_event],
+        )
+
+        self.assertEqual(
+            [record["event_id"] for record in actual[MOCK_ACCOUNT][MOCK_REGION]],
+            [MOCK_EVENT_ID, "MOCK_OTHER_EVENT_ID"],
+        )
+
+    def test_find_metadata(self):
+        """Test Ingest find_metadata for EGs and ASGs"""
+        mock_events = {
             MOCK_ACCOUNT: {
                 MOCK_REGION: [
                     {
@@ -114,16 +340,54 @@ class TestHandlerIngest(TestCase):
                 ]
             },
         }
+        ec2_client = self.sts_client.get_boto3_client_for_account.return_value
+        expected = [
+            {
+                **MOCK_GROUP,
+                "state": Ec2State.TERMINATED.value,
+                "timestamp": Decimal(MOCK_TIME_NOW.timestamp()),
+                "instance_id": MOCK_INSTANCE_ID,
+                "team": MOCK_TEAM,
+            }
+        ]
+
+        for group_tag in ["spotinst:aws:ec2:group:id", "aws:autoscaling:groupName"]:
+            with self.subTest(group_tag=group_tag):
+                self.sts_client.reset_mock()
+                self.handler.metadata_cache = InstanceMetadataCache()
+                ec2_client.describe_instances.return_value = {
+                    "Reservations": [
+                        {
+                            "Instances": [
+                                {
+                                    "InstanceId": MOCK_INSTANCE_ID,
+                                    "Tags": dict_to_boto3_tags(
+                                        {
+                                            "application": MOCK_APPLICATION_FLAPPY,
+                                            "environment": MOCK_ENVIRONMENT,
+                                            "team": MOCK_TEAM,
+                                            group_tag: MOCK_GROUP_NAME,
+                                        }
+                                    )
+                                }
+                            ]
+                        }
+                    ]
+                }
 
-        actual = self.handler._group_events(events=mock_events)
+                actual = self.handler._find_metadata(grouped_events=mock_events)
 
-        self.assertEqual(
-            actual,
-            expected,
-        )
+                self.assertEqual(actual, expected)
+                self.sts_client.get_boto3_client_for_account.assert_called_once_with(
+                    account_id=MOCK_ACCOUNT,
+                    role_name=MOCK_ROLE,
+                    client_name="ec2",
+                    region_name=MOCK_REGION,
+                )
+                ec2_client.describe_instances.assert_called_once_with(InstanceIds=[MOCK_INSTANCE_ID])
 
-    def test_find_metadata_eg(self):
-        """Test Ingest find_metadata for EGs"""
+    def test_find_metadata_no_group(self):
+        """Test Ingest find_metadata with no group"""
         mock_events = {
             MOCK_ACCOUNT: {
                 MOCK_REGION: [
@@ -147,7 +411,6 @@ class TestHandlerIngest(TestCase):
                                     "application": MOCK_APPLICATION_FLAPPY,
                                     "environment": MOCK_ENVIRONMENT,
                                     "team": MOCK_TEAM,
-                                    "spotinst:aws:ec2:group:id": MOCK_GROUP_NAME,
                                 }
                             )
                         }
@@ -155,19 +418,7 @@ class TestHandlerIngest(TestCase):
                 }
             ]
         }
-        expected = [
-            {
-                "account": MOCK_ACCOUNT,
-                "region": MOCK_REGION,
-                "state": Ec2State.TERMINATED.value,
-                "timestamp": Decimal(MOCK_TIME_NOW.timestamp()),
-                "instance_id": MOCK_INSTANCE_ID,
-                "application": MOCK_APPLICATION_FLAPPY,
-                "group_name": MOCK_GROUP_NAME,
-                "environment": MOCK_ENVIRONMENT,
-                "team": MOCK_TEAM,
-            }
-        ]
+        expected = []
 
         actual = self.handler._find_metadata(grouped_events=mock_events)
 
@@ -185,16 +436,17 @@ class TestHandlerIngest(TestCase):
             InstanceIds=[MOCK_INSTANCE_ID],
         )
 
-    def test_find_metadata_asg(self):
-        """Test Ingest find_metadata for ASGs"""
+    def test_find_metadata_cached(self):
+        """Test Ingest find_metadata only describes instances it hasn't seen"""
         mock_events = {
             MOCK_ACCOUNT: {
                 MOCK_REGION: [
                     {
-                        "state": Ec2State.TERMINATED.value,
+                        "state": state.value,
                         "timestamp": Decimal(MOCK_TIME_NOW.timestamp()),
                         "instance_id": MOCK_INSTANCE_ID,
-                    },
+                    }
+                    for state in [Ec2State.RUNNING, Ec2State.TERMINATED]
                 ]
             },
         }
@@ -218,38 +470,18 @@ class TestHandlerIngest(TestCase):
                 }
             ]
         }
-        expected = [
-            {
-                "account": MOCK_ACCOUNT,
-                "region": MOCK_REGION,
-                "state": Ec2State.TERMINATED.value,
-                "timestamp": Decimal(MOCK_TIME_NOW.timestamp()),
-                "instance_id": MOCK_INSTANCE_ID,
-                "application": MOCK_APPLICATION_FLAPPY,
-                "group_name": MOCK_GROUP_NAME,
-                "environment": MOCK_ENVIRONMENT,
-                "team": MOCK_TEAM,
-            }
-        ]
 
-        actual = self.handler._find_metadata(grouped_events=mock_events)
+        first = self.handler._find_metadata(grouped_events=mock_events)
+        second = self.handler._find_metadata(grouped_events=mock_events)
 
-        self.assertEqual(
-            actual,
-            expected,
-        )
-        self.sts_client.get_boto3_client_for_account.assert_called_once_with(
-            account_id=MOCK_ACCOUNT,
-            role_name=MOCK_ROLE,
-            client_name="ec2",
-            region_name=MOCK_REGION,
-        )
+        self.assertEqual(len(first), 2)
+        self.assertEqual(first, second)
         ec2_client.describe_instances.assert_called_once_with(
             InstanceIds=[MOCK_INSTANCE_ID],
         )
 
-    def test_find_metadata_no_group(self):
-        """Test Ingest find_metadata with no group"""
+    def test_find_metadata_not_described(self):
+        """Test Ingest find_metadata ignores instances EC2 no longer describes"""
         mock_events = {
             MOCK_ACCOUNT: {
                 MOCK_REGION: [
@@ -262,6 +494,123 @@ class TestHandlerIngest(TestCase):
             },
         }
         ec2_client = self.sts_client.get_boto3_client_for_account.return_value
+        ec2_client.describe_instances.return_value = {"Reservations": []}
+
+        actual = self.handler._find_metadata(grouped_events=mock_events)
+
+        self.assertEqual(actual, [])
+        self.assertEqual(self.handler.metadata_failures, [])
+
+    def test_find_metadata_chunked(self):
+        """Test Ingest find_metadata describes instances in chunks, following every page"""
+        instance_ids = [f"i-{index}" for index in range(250)]
+        mock_events = {
+            MOCK_ACCOUNT: {
+                MOCK_REGION: [
+                    {
+                        "state": Ec2State.RUNNING.value,
+                        "timestamp": Decimal(MOCK_TIME_NOW.timestamp()),
+                        "instance_id": instance_id,
+                    }
+                    for instance_id in instance_ids
+                ]
+            },
+        }
+
+        def mock_describe_instances(InstanceIds, NextToken=None):  # pylint: disable=invalid-name
+            # Return each chunk over two pages
+            page = InstanceIds[:1] if NextToken is None else InstanceIds[1:]
+            response = {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {
+                                "InstanceId": instance_id,
+                                "Tags": dict_to_boto3_tags({"aws:autoscaling:groupName": MOCK_GROUP_NAME}),
+                            }
+                            for instance_id in page
+                        ]
+                    }
+                ]
+            }
+            if NextToken is None:
+                response["NextToken"] = "MOCK_NEXT_TOKEN"
+            return response
+
+        ec2_client = self.sts_client.get_boto3_client_for_account.return_value
+        ec2_client.describe_instances.side_effect = mock_describe_instances
+
+        actual = self.handler._find_metadata(grouped_events=mock_events)
+
+        self.assertCountEqual(
+            [event["instance_id"] for event in actual],
+            instance_ids,
+        )
+        self.assertCountEqual(
+            [
+                len(mock_call[1]["InstanceIds"])
+                for mock_call in ec2_client.describe_instances.call_args_list
+                if "NextToken" not in mock_call[1]
+            ],
+            [100, 100, 50],
+        )
+
+    def test_find_metadata_invalid_instance(self):
+        """Test Ingest find_metadata isolates instances EC2 can't describe"""
+        instance_ids = ["i-1", "i-2", "MOCK_BAD_INSTANCE_ID", "i-3"]
+        mock_events = {
+            MOCK_ACCOUNT: {
+                MOCK_REGION: [
+                    {
+                        "state": Ec2State.RUNNING.value,
+                        "timestamp": Decimal(MOCK_TIME_NOW.timestamp()),
+                        "instance_id": instance_id,
+                    }
+                    for instance_id in instance_ids
+                ]
+            },
+        }
+
+        def mock_describe_instances(InstanceIds):  # pylint: disable=invalid-name
+            if "MOCK_BAD_INSTANCE_ID" in InstanceIds:
+                raise ClientError(
+                    {"Error": {"Code": "InvalidInstanceID.Malformed", "Message": "MOCK_MESSAGE"}},
+                    "DescribeInstances",
+                )
+            return {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {
+                                "InstanceId": instance_id,
+                                "Tags": dict_to_boto3_tags({"aws:autoscaling:groupName": MOCK_GROUP_NAME}),
+                            }
+                            for instance_id in InstanceIds
+                        ]
+                    }
+                ]
+            }
+
+        ec2_client = self.sts_client.get_boto3_client_for_account.return_value
+        ec2_client.describe_instances.side_effect = mock_describe_instances
+
+        actual = self.handler._find_metadata(grouped_events=mock_events)
+
+        self.assertEqual(
+            [event["instance_id"] for event in actual],
+            ["i-1", "i-2", "i-3"],
+        )
+        self.assertEqual(self.handler.metadata_failures, [])
+
+    def test_find_metadata_failure(self):
+        """Test Ingest find_metadata isolates failures to their account and region"""
+        mock_event = {
+            "state": Ec2State.TERMINATED.value,
+            "timestamp": Decimal(MOCK_TIME_NOW.timestamp()),
+            "instance_id": MOCK_INSTANCE_ID,
+        }
+        mock_error = Exception("MOCK_THROTTLED")
+        ec2_client = MagicMock()
         ec2_client.describe_instances.return_value = {
             "Reservations": [
                 {
@@ -272,7 +621,7 @@ class TestHandlerIngest(TestCase):
                                 {
                                     "application": MOCK_APPLICATION_FLAPPY,
                                     "environment": MOCK_ENVIRONMENT,
-                                    "team": MOCK_TEAM,
+                                    "aws:autoscaling:groupName": MOCK_GROUP_NAME,
                                 }
                             )
                         }
@@ -280,36 +629,328 @@ class TestHandlerIngest(TestCase):
                 }
             ]
         }
-        expected = []
 
-        actual = self.handler._find_metadata(grouped_events=mock_events)
+        def mock_get_client(region_name, **_):
+            if region_name == MOCK_REGION_FAILING:
+                raise mock_error
+            return ec2_client
+
+        self.sts_client.get_boto3_client_for_account.side_effect = mock_get_client
+
+        actual = self.handler._find_metadata(
+            grouped_events={
+                MOCK_ACCOUNT: {
+                    MOCK_REGION_FAILING: [mock_event],
+                    MOCK_REGION: [mock_event],
+                },
+            }
+        )
 
         self.assertEqual(
             actual,
-            expected,
-        )
-        self.sts_client.get_boto3_client_for_account.assert_called_once_with(
-            account_id=MOCK_ACCOUNT,
-            role_name=MOCK_ROLE,
-            client_name="ec2",
-            region_name=MOCK_REGION,
+            [
+                {**mock_event, **MOCK_GROUP, "team": None}
+            ],
         )
-        ec2_client.describe_instances.assert_called_once_with(
-            InstanceIds=[MOCK_INSTANCE_ID],
+        self.assertEqual(
+            self.handler.metadata_failures,
+            [
+                MetadataLookupFailure(
+                    account=MOCK_ACCOUNT,
+                    region=MOCK_REGION_FAILING,
+                    events=[mock_event],
+                    error=mock_error,
+                )
+            ],
         )
 
     def test_write_to_dynamodb(self):
         """Test Ingest write_to_dynamodb"""
+        self.dynamodb_table.name = MOCK_EC2_TABLE
+        self.dynamodb_table.meta.client.batch_write_item.return_value = {"UnprocessedItems": {}}
+        mock_events = [
+            {"foo": "bar", "timestamp": Decimal(3601)},
+            {"baz": "buzz", "timestamp": Decimal(7199)},
+        ]
+
+        actual = self.handler._write_to_dynamodb(events=mock_events)
+
+        self.assertEqual(actual.written, 2)
+        self.dynamodb_table.meta.client.batch_write_item.assert_called_once_with(
+            RequestItems={
+                MOCK_EC2_TABLE: [
+                    {"PutRequest": {"Item": {**event, "time_bucket": 3600}}}
+                    for event in mock_events
+                ]
+            }
+        )
+
+    def test_write_to_dynamodb_batches(self):
+        """Test Ingest write_to_dynamodb splits records into batches of 25"""
+        self.dynamodb_table.name = MOCK_EC2_TABLE
+        self.dynamodb_table.meta.client.batch_write_item.return_value = {"UnprocessedItems": {}}
+        mock_events = [
+            {"instance_id": str(index), "timestamp": Decimal(0)}
+            for index in range(60)
+        ]
+
+        actual = self.handler._write_to_dynamodb(events=mock_events)
+
+        self.assertEqual(actual.written, 60)
+        self.assertEqual(
+            [
+                len(mock_call[1]["RequestItems"][MOCK_EC2_TABLE])
+                for mock_call in self.dynamodb_table.meta.client.batch_write_item.call_args_list
+            ],
+            [25, 25, 10],
+        )
+
+    @patch("flappy_detector.utils.dynamodb.time.sleep")
+    def test_write_to_dynamodb_unprocessed(self, mock_sleep):
+        """Test Ingest write_to_dynamodb retries unprocessed records"""
+        self.dynamodb_table.name = MOCK_EC2_TABLE
+        mock_event = {"foo": "bar", "timestamp": Decimal(0)}
+        mock_request = {"PutRequest": {"Item": {**mock_event, "time_bucket": 0}}}
+        self.dynamodb_table.meta.client.batch_write_item.side_effect = [
+            {"UnprocessedItems": {MOCK_EC2_TABLE: [mock_request]}},
+            {"UnprocessedItems": {}},
+        ]
+
+        actual = self.handler._write_to_dynamodb(events=[mock_event])
+
+        self.assertEqual(actual.written, 1)
+        self.assertEqual(actual.retried, 1)
+        mock_sleep.assert_called_once()
+        self.dynamodb_table.meta.client.batch_write_item.assert_has_calls(
+            calls=[
+                call(RequestItems={MOCK_EC2_TABLE: [mock_request]}),
+                call(RequestItems={MOCK_EC2_TABLE: [mock_request]}),
+            ]
+        )
+
+    @patch("flappy_detector.utils.dynamodb.time.sleep", MagicMock())
+    def test_write_to_dynamodb_failed(self):
+        """Test Ingest write_to_dynamodb raises when records can't be written"""
+        self.dynamodb_table.name = MOCK_EC2_TABLE
+        mock_event = {"foo": "bar", "timestamp": Decimal(0)}
+        mock_request = {"PutRequest": {"Item": {**mock_event, "time_bucket": 0}}}
+        self.dynamodb_table.meta.client.batch_write_item.return_value = {
+            "UnprocessedItems": {MOCK_EC2_TABLE: [mock_request]},
+        }
+
+        with self.assertRaises(UnprocessedItemsError) as context:
+            self.handler._write_to_dynamodb(events=[mock_event])
+
+        self.assertEqual(context.exception.result.unprocessed, [mock_request["PutRequest"]["Item"]])
+
+    @patch("flappy_detector.handlers.ingest.time.time", MagicMock(return_value=0))
+    def test_update_rollups(self):
+        """Test Ingest update_rollups combines records by group and bucket"""
+        self.handler.rollup_table = MagicMock()
+        base_event = {**MOCK_GROUP, "instance_id": MOCK_INSTANCE_ID}
         mock_events = [
-            {"foo": "bar"},
-            {"baz": "buzz"},
+            {**base_event, "state": Ec2State.RUNNING.value, "timestamp": Decimal(600)},
+            {**base_event, "state": Ec2State.RUNNING.value, "timestamp": Decimal(650), "team": MOCK_TEAM},
+            {**base_event, "state": Ec2State.TERMINATED.value, "timestamp": Decimal(900)},
+            {**base_event, "state": "pending", "timestamp": Decimal(600)},
+            {**base_event, "application": None, "state": Ec2State.RUNNING.value, "timestamp": Decimal(600)},
         ]
+        key = "_".join(
+            [MOCK_ACCOUNT, MOCK_REGION, MOCK_ENVIRONMENT, MOCK_APPLICATION_FLAPPY, MOCK_GROUP_NAME]
+        )
+        group_names = {
+            f"#{name}": name
+            for name in [
+                "account", "region", "environment", "application", "group_name",
+                "count", "spread", "known", "expires_at",
+            ]
+        }
+        group_values = {
+            ":account": MOCK_ACCOUNT,
+            ":region": MOCK_REGION,
+            ":environment": MOCK_ENVIRONMENT,
+            ":application": MOCK_APPLICATION_FLAPPY,
+            ":group_name": MOCK_GROUP_NAME,
+            ":expires_at": 86400,
+        }
+        update_expression = (
+            "ADD #count :count, #spread :spread, #known :known SET #account = :account, #region = :region, "
+            "#environment = :environment, #application = :application, #group_name = :group_name, "
+            "#expires_at = :expires_at"
+        )
 
-        self.handler._write_to_dynamodb(events=mock_events)
+        self.handler._update_rollups(rollup_table=self.handler.rollup_table, events=mock_events)
 
-        self.dynamodb_table.put_item.assert_has_calls(
+        self.handler.rollup_table.update_item.assert_has_calls(
             calls=[
-                call(Item=event)
-                for event in mock_events
+                call(
+                    Key={"time_bucket": 600, "key": key},
+                    UpdateExpression=update_expression + ", #team = if_not_exists(#team, :team)",
+                    ExpressionAttributeNames={**group_names, "#team": "team"},
+                    ExpressionAttributeValues={**group_values, ":count": 3, ":spread": 2, ":known": 2,
+                                               ":team": MOCK_TEAM},
+                ),
+                call(
+                    Key={"time_bucket": 900, "key": key},
+                    UpdateExpression=update_expression,
+                    ExpressionAttributeNames=group_names,
+                    ExpressionAttributeValues={**group_values, ":count": 1, ":spread": -1, ":known": 1},
+                ),
             ]
         )
+        self.assertEqual(self.handler.rollup_table.update_item.call_count, 2)
+
+    @patch("flappy_detector.handlers.ingest.time.sleep")
+    def test_update_rollup_conflict(self, mock_sleep):
+        """Test Ingest update_rollup retries transactions conflicting with another, up to its attempts"""
+        conflict = ClientError(
+            {
+                "Error": {"Code": "TransactionCanceledException"},
+                "CancellationReasons": [{"Code": "TransactionConflict"}],
+            },
+            "TransactWriteItems",
+        )
+        rollup_table = MagicMock()
+        mock_transact = rollup_table.meta.client.transact_write_items
+        mock_transact.side_effect = [conflict, {}] + [conflict] * ROLLUP_MAX_ATTEMPTS
+        rollup = {
+            "rollup_table": rollup_table,
+            "rollup_key": {"time_bucket": 600, "key": "MOCK_KEY"},
+            "group": {**MOCK_GROUP, "expires_at": 86400},
+            "team": None,
+            "changes": [(MOCK_EVENT_ID, 1)],
+        }
+
+        self.handler._update_rollup(**rollup)
+        with self.assertRaises(ClientError):
+            self.handler._update_rollup(**rollup)
+
+        self.assertEqual(mock_transact.call_count, 2 + ROLLUP_MAX_ATTEMPTS)
+        self.assertEqual(mock_sleep.call_count, ROLLUP_MAX_ATTEMPTS)
+
+    def test_update_rollups_same_as_loop(self):
+        """Test summing the rollups gives the same FlappyEvents as the detector's loop over mixed states"""
+        self.handler.rollup_table = MagicMock()
+        states = [Ec2State.RUNNING.value, "pending", Ec2State.TERMINATED.value, "shutting-down"] * 2
+        mock_events = [
+            *[
+                {**MOCK_GROUP, "state": state, "timestamp": Decimal(600 + 60 * offset)}
+                for offset, state in enumerate(states)
+            ],
+            {**MOCK_GROUP, "group_name": "MOCK_UNKNOWN", "state": "pending", "timestamp": Decimal(600)},
+        ]
+        flappy_detector = FlappyDetector(
+            datadog_client=MagicMock(),
+            dynamodb_table=MagicMock(),
+            max_event_age=timedelta(minutes=120),
+            min_number_of_events=5,
+            min_spread=1,
+        )
+
+        self.handler._update_rollups(rollup_table=self.handler.rollup_table, events=mock_events)
+
+        rollups = [
+            {**kw["Key"], **{name[1:]: value for name, value in kw["ExpressionAttributeValues"].items()}}
+            for _, kw in self.handler.rollup_table.update_item.call_args_list
+        ]
+        flappy_events = flappy_detector._group_rollups(rollups=rollups)
+        self.assertEqual(flappy_events, flappy_detector._group_events(events=mock_events))
+        self.assertEqual(flappy_detector._find_flapping(flappy_events=flappy_events), flappy_events)
+
+    @patch("flappy_detector.handlers.ingest.time.time", MagicMock(return_value=0))
+    def test_update_rollups_event_ids(self):
+        """Test Ingest update_rollups claims each event id with a marker, one at a time on redelivery"""
+        self.handler.rollup_table = MagicMock()
+        self.handler.rollup_table.name = "MOCK_ROLLUP_TABLE"
+        mock_transact = self.handler.rollup_table.meta.client.transact_write_items
+        mock_transact.side_effect = [
+            ClientError(
+                {
+                    "Error": {"Code": "TransactionCanceledException"},
+                    "CancellationReasons": [
+                        {"Code": "ConditionalCheckFailed"}, {"Code": "None"}, {"Code": "None"},
+                    ],
+                },
+                "TransactWriteItems",
+            ),
+            ClientError(
+                {
+                    "Error": {"Code": "TransactionCanceledException"},
+                    "CancellationReasons": [{"Code": "ConditionalCheckFailed"}, {"Code": "None"}],
+                },
+                "TransactWriteItems",
+            ),
+            {},
+        ]
+        base_event = {**MOCK_GROUP, "instance_id": MOCK_INSTANCE_ID, "timestamp": Decimal(600)}
+        mock_events = [
+            {**base_event, "event_id": MOCK_EVENT_ID, "state": Ec2State.RUNNING.value},
+            {**base_event, "event_id": "MOCK_OTHER_EVENT_ID", "state": Ec2State.TERMINATED.value},
+        ]
+        key = "_".join(MOCK_GROUP.values())
+
+        def mock_marker(event_id):
+            return {
+                "Put": {
+                    "TableName": "MOCK_ROLLUP_TABLE",
+                    "Item": {"time_bucket": -600, "key": f"{key}#{event_id}", "expires_at": 86400},
+                    "ConditionExpression": "attribute_not_exists(#key)",
+                    "ExpressionAttributeNames": {"#key": "key"},
+                },
+            }
+
+        def mock_update(changes):
+            return {
+                "Update": {
+                    "TableName": "MOCK_ROLLUP_TABLE",
+                    "Key": {"time_bucket": 600, "key": key},
+                    **self.handler._build_rollup_update(
+                        group={**MOCK_GROUP, "expires_at": 86400},
+                        team=None,
+                        changes=changes,
+                    ),
+                },
+            }
+
+        self.handler._update_rollups(rollup_table=self.handler.rollup_table, events=mock_events)
+
+        self.assertEqual(
+            mock_transact.call_args_list,
+            [
+                call(
+                    TransactItems=[
+                        mock_marker(MOCK_EVENT_ID),
+                        mock_marker("MOCK_OTHER_EVENT_ID"),
+                        mock_update([(MOCK_EVENT_ID, 1), ("MOCK_OTHER_EVENT_ID", -1)]),
+                    ],
+                ),
+                call(TransactItems=[mock_marker(MOCK_EVENT_ID), mock_update([(MOCK_EVENT_ID, 1)])]),
+                call(
+                    TransactItems=[
+                        mock_marker("MOCK_OTHER_EVENT_ID"),
+                        mock_update([("MOCK_OTHER_EVENT_ID", -1)]),
+                    ],
+                ),
+            ],
+        )
+        self.handler.rollup_table.update_item.assert_not_called()
+
+    def test_update_rollups_error(self):
+        """Test Ingest update_rollups raises cancelled transactions other than for a redelivered event"""
+        self.handler.rollup_table = MagicMock()
+        self.handler.rollup_table.meta.client.transact_write_items.side_effect = ClientError(
+            {
+                "Error": {"Code": "TransactionCanceledException"},
+                "CancellationReasons": [{"Code": "TransactionConflict"}, {"Code": "None"}],
+            },
+            "TransactWriteItems",
+        )
+        mock_event = {
+            **MOCK_GROUP,
+            "event_id": MOCK_EVENT_ID,
+            "state": Ec2State.RUNNING.value,
+            "timestamp": Decimal(600),
+        }
+
+        with self.assertRaises(ClientError):
+            self.handler._update_rollups(rollup_table=self.handler.rollup_table, events=[mock_event])
@@ -0,0 +1,142 @@
+"""Tests for the instance metadata cache"""
+from datetime import timedelta
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from flappy_detector.utils.metadata_cache import InstanceMetadataCache
+
+MOCK_ACCOUNT = "MOCK_ACCOUNT"
+MOCK_REGION = "MOCK_REGION"
+MOCK_CACHE_TABLE = "MOCK_CACHE_TABLE"
+MOCK_TIME_NOW = 1577836800
+MOCK_METADATA = {
+    "application": "MOCK_APPLICATION",
+    "environment": "MOCK_ENVIRONMENT",
+    "team": "MOCK_TEAM",
+    "group_name": "MOCK_GROUP_NAME",
+}
+
+
+@patch("flappy_detector.utils.metadata_cache.time.time", MagicMock(return_value=MOCK_TIME_NOW))
+class TestInstanceMetadataCache(TestCase):
+    """Tests for the instance metadata cache"""
+
+    def test_get_many(self):
+        """Test cached instances are found and others aren't"""
+        cache = InstanceMetadataCache()
+        cache.put_many(account=MOCK_ACCOUNT, region=MOCK_REGION, metadata={"i-1": MOCK_METADATA})
+
+        self.assertEqual(
+            cache.get_many(account=MOCK_ACCOUNT, region=MOCK_REGION, instance_ids=["i-1", "i-2"]),
+            {"i-1": MOCK_METADATA},
+        )
+        self.assertEqual(
+            cache.get_many(account=MOCK_ACCOUNT, region="MOCK_OTHER_REGION", instance_ids=["i-1"]),
+            {},
+        )
+
+    def test_get_many_expired(self):
+        """Test expired instances aren't found"""
+        cache = InstanceMetadataCache(ttl=timedelta(minutes=1))
+        cache.put_many(account=MOCK_ACCOUNT, region=MOCK_REGION, metadata={"i-1": MOCK_METADATA})
+
+        mock_time = MagicMock(return_value=MOCK_TIME_NOW + 61)
+        with patch("flappy_detector.utils.metadata_cache.time.time", mock_time):
+            actual = cache.get_many(account=MOCK_ACCOUNT, region=MOCK_REGION, instance_ids=["i-1"])
+
+        self.assertEqual(actual, {})
+
+    def test_get_many_ungrouped(self):
+        """Test instances without a group are only cached briefly, so their group tag is looked up again"""
+        cache = InstanceMetadataCache(ungrouped_ttl=timedelta(minutes=1))
+        cache.put_many(
+            account=MOCK_ACCOUNT,
+            region=MOCK_REGION,
+            metadata={"i-1": MOCK_METADATA, "i-2": {**MOCK_METADATA, "group_name": None}},
+        )
+
+        mock_time = MagicMock(return_value=MOCK_TIME_NOW + 61)
+        with patch("flappy_detector.utils.metadata_cache.time.time", mock_time):
+            actual = cache.get_many(account=MOCK_ACCOUNT, region=MOCK_REGION, instance_ids=["i-1", "i-2"])
+
+        self.assertEqual(actual, {"i-1": MOCK_METADATA})
+
+    def test_get_many_evicted(self):
+        """Test the least recently used instances are evicted"""
+        cache = InstanceMetadataCache(max_size=2)
+        cache.put_many(account=MOCK_ACCOUNT, region=MOCK_REGION, metadata={"i-1": MOCK_METADATA})
+        cache.put_many(account=MOCK_ACCOUNT, region=MOCK_REGION, metadata={"i-2": MOCK_METADATA})
+        cache.get_many(account=MOCK_ACCOUNT, region=MOCK_REGION, instance_ids=["i-1"])
+        cache.put_many(account=MOCK_ACCOUNT, region=MOCK_REGION, metadata={"i-3": MOCK_METADATA})
+
+        self.assertEqual(
+            set(cache.get_many(account=MOCK_ACCOUNT, region=MOCK_REGION, instance_ids=["i-1", "i-2", "i-3"])),
+            {"i-1", "i-3"},
+        )
+
+    def test_dynamodb_table(self):
+        """Test instances missing in process are read from and written to the table"""
+        dynamodb_table = MagicMock()
+        dynamodb_table.name = MOCK_CACHE_TABLE
+        dynamodb_table.meta.client.batch_get_item.return_value = {
+            "Responses": {
+                MOCK_CACHE_TABLE: [
+                    {
+                        "cache_key": f"{MOCK_ACCOUNT}:{MOCK_REGION}:i-1",
+                        "metadata": MOCK_METADATA,
+                        "expires_at": MOCK_TIME_NOW + 1,
+                    },
+                    {
+                        "cache_key": f"{MOCK_ACCOUNT}:{MOCK_REGION}:i-2",
+                        "metadata": MOCK_METADATA,
+                        "expires_at": MOCK_TIME_NOW - 1,
+                    },
+                ]
+            }
+        }
+        dynamodb_table.meta.client.batch_write_item.return_value = {}
+        cache = InstanceMetadataCache(ttl=timedelta(hours=1), dynamodb_table=dynamodb_table)
+        ungrouped_metadata = {**MOCK_METADATA, "group_name": None}
+
+        actual = cache.get_many(account=MOCK_ACCOUNT, region=MOCK_REGION, instance_ids=["i-1", "i-2"])
+        cache.put_many(
+            account=MOCK_ACCOUNT,
+            region=MOCK_REGION,
+            metadata={"i-2": MOCK_METADATA, "i-3": ungrouped_metadata},
+        )
+
+        self.assertEqual(actual, {"i-1": MOCK_METADATA})
+        dynamodb_table.meta.client.batch_get_item.assert_called_once_with(
+            RequestItems={
+                MOCK_CACHE_TABLE: {
+                    "Keys": [
+                        {"cache_key": f"{MOCK_ACCOUNT}:{MOCK_REGION}:i-1"},
+                        {"cache_key": f"{MOCK_ACCOUNT}:{MOCK_REGION}:i-2"},
+                    ]
+                }
+            }
+        )
+        dynamodb_table.meta.client.batch_write_item.assert_called_once_with(
+            RequestItems={
+                MOCK_CACHE_TABLE: [
+                    {
+                        "PutRequest": {
+                            "Item": {
+                                "cache_key": f"{MOCK_ACCOUNT}:{MOCK_REGION}:i-2",
+                                "metadata": MOCK_METADATA,
+                                "expires_at": MOCK_TIME_NOW + 3600,
+                            }
+                        }
+                    },
+                    {
+                        "PutRequest": {
+                            "Item": {
+                                "cache_key": f"{MOCK_ACCOUNT}:{MOCK_REGION}:i-3",
+                                "metadata": ungrouped_metadata,
+                                "expires_at": MOCK_TIME_NOW + 60,
+                            }
+                        }
+                    },
+                ]
+            }
+        )
@@ -0,0 +1,116 @@
+"""Tests for the per group Datadog metrics"""
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from datadog.api.exceptions import HTTPError
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.metrics import MetricSender, get_flap_ratio, get_series
+
+MOCK_TIME_NOW = 1577836800
+
+
+def _flappy_event(group_name: str, count: int, spread: int) -> FlappyEvent:
+    return FlappyEvent(
+        account="MOCK_ACCOUNT",
+        region="MOCK_REGION",
+        environment="MOCK_ENVIRONMENT",
+        application="MOCK_APPLICATION",
+        group_name=group_name,
+        count=count,
+        spread=spread,
+    )
+
+
+class TestGetSeries(TestCase):
+    """Tests for building the metric series"""
+
+    def test_get_series(self):
+        """Test each group gets a count, spread and flap ratio gauge tagged like its events"""
+        flappy_event = _flappy_event("MOCK_GROUP_NAME", count=8, spread=-2)
+
+        self.assertEqual(
+            get_series(flappy_events=[flappy_event], timestamp=MOCK_TIME_NOW),
+            [
+                {
+                    "metric": f"flappy_detector.{name}",
+                    "type": "gauge",
+                    "points": [(MOCK_TIME_NOW, value)],
+                    "tags": flappy_event.tags,
+                }
+                for name, value in [("count", 8), ("spread", -2), ("flap_ratio", 0.75)]
+            ],
+        )
+
+    def test_get_flap_ratio(self):
+        """Test the flap ratio of groups without events, and of groups only scaling one way"""
+        self.assertEqual(get_flap_ratio(_flappy_event("MOCK_GROUP_NAME", count=0, spread=0)), 0.0)
+        self.assertEqual(get_flap_ratio(_flappy_event("MOCK_GROUP_NAME", count=5, spread=5)), 0.0)
+        self.assertEqual(get_flap_ratio(_flappy_event("MOCK_GROUP_NAME", count=6, spread=0)), 1.0)
+
+
+@patch("flappy_detector.utils.metrics.time.time", MagicMock(return_value=MOCK_TIME_NOW))
+class TestMetricSender(TestCase):
+    """Tests for the metric sender"""
+
+    def setUp(self) -> None:
+        self.datadog_client = MagicMock()
+        self.datadog_client.Metric.send.return_value = {"status": "ok"}
+
+    def test_send_batched(self):
+        """Test the series are sent in batches rather than one request per group"""
+        metric_sender = MetricSender(datadog_client=self.datadog_client, batch_size=4)
+
+        sent = metric_sender.send(
+            flappy_events=[_flappy_event(f"MOCK_GROUP_{index}", count=1, spread=1) for index in range(3)],
+        )
+
+        self.assertEqual(sent, 9)
+        self.assertEqual(
+            [len(call[1]["metrics"]) for call in self.datadog_client.Metric.send.call_args_list],
+            [4, 4, 1],
+        )
+        self.assertEqual(
+            {
+                (call[1]["attach_host_name"], call[1]["compress_payload"])
+                for call in self.datadog_client.Metric.send.call_args_list
+            },
+            {(False, True)},
+        )
+
+    def test_send_max_groups(self):
+        """Test only the groups with the most events are sent when there are too many"""
+        metric_sender = MetricSender(datadog_client=self.datadog_client, max_groups=2)
+
+        metric_sender.send(
+            flappy_events=[
+                _flappy_event("MOCK_QUIET", count=1, spread=1),
+                _flappy_event("MOCK_BUSY", count=10, spread=0),
+                _flappy_event("MOCK_BUSIER", count=20, spread=2),
+            ],
+        )
+
+        self.assertEqual(
+            {
+                tag
+                for series in self.datadog_client.Metric.send.call_args[1]["metrics"]
+                for tag in series["tags"]
+                if tag.startswith("group_name:")
+            },
+            {"group_name:MOCK_BUSY", "group_name:MOCK_BUSIER"},
+        )
+
+    def test_send_failed(self):
+        """Test failed batches are logged and skipped, never raised"""
+        metric_sender = MetricSender(datadog_client=self.datadog_client, batch_size=3)
+        self.datadog_client.Metric.send.side_effect = [
+            {"errors": ["Payload too large"]},
+            HTTPError(503),
+            {"status": "ok"},
+        ]
+
+        sent = metric_sender.send(
+            flappy_events=[_flappy_event(f"MOCK_GROUP_{index}", count=1, spread=1) for index in range(3)],
+        )
+
+        self.assertEqual(sent, 3)
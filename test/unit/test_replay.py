@@ -0,0 +1,184 @@
+"""Tests for the offline replay of exported records"""
+import csv
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from flappy_detector.__main__ import main
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.replay import (
+    ExportChunk,
+    ReplayConfig,
+    get_chunks,
+    parse_records,
+    read_lines,
+    replay,
+)
+
+MOCK_TEAM = "MOCK_TEAM"
+MOCK_TIMESTAMP = 1577836800
+MOCK_RECORD = {
+    "account": "MOCK_ACCOUNT",
+    "region": "MOCK_REGION",
+    "environment": "MOCK_ENVIRONMENT",
+    "application": "MOCK_APPLICATION",
+    "group_name": "MOCK_GROUP_NAME",
+}
+MOCK_CONFIG = ReplayConfig(
+    max_event_age_in_secs=2 * 60 * 60,
+    min_number_of_events=5,
+    min_spread=1,
+    step_in_secs=30 * 60,
+)
+
+
+def get_records():
+    """A flapping group, along with one only scaling up"""
+    flapping = [
+        {
+            **MOCK_RECORD,
+            "team": MOCK_TEAM,
+            "state": (Ec2State.RUNNING if offset % 2 else Ec2State.TERMINATED).value,
+            "timestamp": MOCK_TIMESTAMP + offset * 60,
+        }
+        for offset in range(6)
+    ]
+    scaling = [
+        {
+            **MOCK_RECORD,
+            "group_name": "MOCK_SCALING",
+            "state": Ec2State.RUNNING.value,
+            "timestamp": MOCK_TIMESTAMP + offset * 60,
+        }
+        for offset in range(6)
+    ]
+    return flapping + scaling
+
+
+EXPECTED_PERIODS = [
+    {
+        **MOCK_RECORD,
+        "team": MOCK_TEAM,
+        "key": FlappyEvent.get_key(MOCK_RECORD.values()),
+        "first_flapping_at": MOCK_TIMESTAMP + 30 * 60,
+        "last_flapping_at": MOCK_TIMESTAMP + 2 * 60 * 60,
+        "runs": 4,
+        "max_count": 6,
+    },
+]
+
+
+class TestReplay(TestCase):
+    """Tests for the offline replay of exported records"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_jsonl(self, records, name="export.jsonl"):
+        """Write records as JSON lines"""
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as export_file:
+            for record in records:
+                export_file.write(json.dumps(record) + "\n")
+        return path
+
+    def write_csv(self, records):
+        """Write records as CSV"""
+        path = os.path.join(self.directory.name, "export.csv")
+        with open(path, "w", encoding="utf-8", newline="") as export_file:
+            writer = csv.DictWriter(export_file, fieldnames=[*MOCK_RECORD, "team", "state", "timestamp"])
+            writer.writeheader()
+            writer.writerows(records)
+        return path
+
+    def test_read_lines(self):
+        """Test every line is read by exactly one chunk, however the file is split"""
+        path = self.write_jsonl(get_records())
+        with open(path, encoding="utf-8") as export_file:
+            lines = export_file.readlines()
+
+        for chunk_size in [1, 7, 100, 1000, 1000000]:
+            with self.subTest(chunk_size=chunk_size):
+                chunks = get_chunks(paths=[path], chunk_size=chunk_size)
+                self.assertEqual([line for chunk in chunks for line in read_lines(chunk)], lines)
+
+    def test_parse_records(self):
+        """Test plain and DynamoDB JSON lines, and CSV rows, are parsed alike"""
+        record = {
+            **MOCK_RECORD,
+            "team": MOCK_TEAM,
+            "state": Ec2State.RUNNING.value,
+            "timestamp": MOCK_TIMESTAMP,
+        }
+        dynamodb_record = {
+            "Item": {
+                **{name: {"S": value} for name, value in record.items() if name != "timestamp"},
+                "timestamp": {"N": str(MOCK_TIMESTAMP)},
+            },
+        }
+
+        for path, export_format in [
+                (self.write_jsonl([record]), "jsonl"),
+                (self.write_jsonl([dynamodb_record], name="dynamodb.json"), "jsonl"),
+                (self.write_csv([record]), "csv"),
+        ]:
+            with self.subTest(export_format=export_format):
+                chunk = ExportChunk(path=path, export_format=export_format)
+                self.assertEqual(list(parse_records(chunk)), [record])
+
+    def test_replay(self):
+        """Test the periods a group was flapping for are found, the same whatever the chunks and workers"""
+        for path_function in [self.write_jsonl, self.write_csv]:
+            path = path_function(get_records())
+            for chunk_size, workers in [(1000000, 1), (100, 1), (100, 2)]:
+                with self.subTest(path=path, chunk_size=chunk_size, workers=workers):
+                    self.assertEqual(
+                        replay(
+                            chunks=get_chunks(paths=[path], chunk_size=chunk_size),
+                            config=MOCK_CONFIG,
+                            workers=workers,
+                        ),
+                        EXPECTED_PERIODS,
+                    )
+
+    def test_replay_redelivered(self):
+        """Test redelivered events are counted once, and groups without a known state are never flapping"""
+        records = [{**record, "event_id": str(index)} for index, record in enumerate(get_records())]
+        unknown = [
+            {**MOCK_RECORD, "group_name": "MOCK_UNKNOWN", "state": "pending", "timestamp": timestamp}
+            for timestamp in range(MOCK_TIMESTAMP, MOCK_TIMESTAMP + 6)
+        ]
+        # Redelivered right after the original, and again in a later chunk
+        path = self.write_jsonl([records[0], *records, *unknown, *records[:6]])
+
+        for chunk_size, workers in [(1000000, 1), (100, 1), (100, 2)]:
+            with self.subTest(chunk_size=chunk_size, workers=workers):
+                self.assertEqual(
+                    replay(
+                        chunks=get_chunks(paths=[path], chunk_size=chunk_size),
+                        config=MOCK_CONFIG,
+                        workers=workers,
+                    ),
+                    EXPECTED_PERIODS,
+                )
+
+    def test_main(self):
+        """Test each flapping period is written as a JSON line"""
+        path = self.write_jsonl(get_records())
+
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            main([path, "--workers", "1"])
+
+        self.assertEqual([json.loads(line) for line in stdout.getvalue().splitlines()], EXPECTED_PERIODS)
+
+    def test_main_step(self):
+        """Test steps that aren't whole buckets are rejected"""
+        with patch("sys.stderr", new_callable=io.StringIO), self.assertRaises(SystemExit):
+            main([self.write_jsonl([]), "--step-mins", "7"])
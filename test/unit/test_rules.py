@@ -0,0 +1,115 @@
+"""Tests for the rule sets evaluated against each group"""
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from flappy_detector.utils.rules import Rule, RuleIndex
+from flappy_detector.utils.snapshot import GroupState
+
+MOCK_TEAM = "MOCK_TEAM"
+MOCK_APPLICATION = "MOCK_APPLICATION"
+MOCK_ATTRIBUTES = ["MOCK_ACCOUNT", "MOCK_REGION", "MOCK_ENVIRONMENT", MOCK_APPLICATION, "MOCK_GROUP_NAME"]
+MOCK_TIME_NOW = datetime(2020, 1, 1)
+MOCK_BUCKET = int(MOCK_TIME_NOW.timestamp())
+SHORT_RULE = Rule(window=timedelta(minutes=15), min_number_of_events=4, min_spread=1)
+LONG_RULE = Rule(window=timedelta(hours=6), min_number_of_events=10, min_spread=2)
+TEAM_RULE = Rule(window=timedelta(hours=1), min_number_of_events=2, min_spread=0)
+APPLICATION_RULE = Rule(window=timedelta(hours=1), min_number_of_events=100, min_spread=0)
+
+
+class TestRuleIndex(TestCase):
+    """Tests for the rule sets evaluated against each group"""
+
+    def test_get_rules(self):
+        """Test application overrides take precedence over team ones, and both over the defaults"""
+        rule_index = RuleIndex(
+            default=[LONG_RULE, SHORT_RULE],
+            applications={MOCK_APPLICATION: [APPLICATION_RULE]},
+            teams={MOCK_TEAM: [TEAM_RULE]},
+        )
+
+        for application, team, rules in [
+                (MOCK_APPLICATION, MOCK_TEAM, (APPLICATION_RULE,)),
+                ("MOCK_OTHER", MOCK_TEAM, (TEAM_RULE,)),
+                ("MOCK_OTHER", None, (SHORT_RULE, LONG_RULE)),
+        ]:
+            with self.subTest(application=application, team=team):
+                self.assertEqual(rule_index.get_rules(application=application, team=team), rules)
+
+        self.assertEqual(rule_index.max_window, timedelta(hours=6))
+
+    def test_from_config(self):
+        """Test rules are parsed, falling back to the given defaults"""
+        rule_index = RuleIndex.loads(
+            '{"applications": {"MOCK_APPLICATION": [{"max_event_age_in_mins": 60, "min_num_events": 100,'
+            ' "min_spread": 0}]}}',
+            default=[SHORT_RULE],
+        )
+
+        self.assertEqual(rule_index.default, (SHORT_RULE,))
+        self.assertEqual(rule_index.applications, {MOCK_APPLICATION: (APPLICATION_RULE,)})
+        self.assertEqual(rule_index.teams, {})
+
+    def test_empty(self):
+        """Test rule sets without any rules are rejected"""
+        for kwargs in [{"default": []}, {"default": [SHORT_RULE], "teams": {MOCK_TEAM: []}}]:
+            with self.subTest(**kwargs), self.assertRaises(ValueError):
+                RuleIndex(**kwargs)
+
+    def test_find_flapping(self):
+        """Test each group is flapping over the shortest of its windows it exceeds the thresholds of"""
+        recent = {MOCK_BUCKET - 300: [2, 0, 2], MOCK_BUCKET - 600: [2, 0, 2]}
+        older = {MOCK_BUCKET - 3 * 60 * 60: [7, 1, 7]}
+        groups = [
+            # Flapping over the short window
+            GroupState(attributes=[*MOCK_ATTRIBUTES[:4], "MOCK_RECENT"], buckets={**recent, **older}),
+            # Flapping over the long window only
+            GroupState(
+                attributes=[*MOCK_ATTRIBUTES[:4], "MOCK_OLDER"],
+                buckets={**older, MOCK_BUCKET - 300: [3, 1, 3]},
+            ),
+            # Not flapping over either
+            GroupState(
+                attributes=[*MOCK_ATTRIBUTES[:4], "MOCK_QUIET"],
+                buckets={MOCK_BUCKET - 600: [1, 1, 1]},
+            ),
+            # Flapping with its team's thresholds
+            GroupState(
+                attributes=[*MOCK_ATTRIBUTES[:4], "MOCK_TEAM"],
+                team=MOCK_TEAM,
+                buckets={MOCK_BUCKET: [2, 0, 2]},
+            ),
+        ]
+        rule_index = RuleIndex(default=[SHORT_RULE, LONG_RULE], teams={MOCK_TEAM: [TEAM_RULE]})
+
+        self.assertEqual(
+            [
+                (flappy_event.group_name, flappy_event.count, flappy_event.spread)
+                for flappy_event in rule_index.find_flapping(groups=groups, now=MOCK_TIME_NOW)
+            ],
+            [("MOCK_RECENT", 4, 0), ("MOCK_OLDER", 10, 2), ("MOCK_TEAM", 2, 0)],
+        )
+
+    def test_find_flapping_windows(self):
+        """Test windows start at the start of the bucket their cut off falls in, and need a known state"""
+        now = MOCK_TIME_NOW + timedelta(minutes=2)
+        groups = [
+            GroupState(attributes=[*MOCK_ATTRIBUTES[:4], group_name], buckets=buckets)
+            for group_name, buckets in [
+                # The cut off 15 minutes before now falls in this bucket, 17 minutes before now
+                ("MOCK_EDGE", {MOCK_BUCKET - 900: [4, 0, 4]}),
+                # The bucket before it is outside the window
+                ("MOCK_OUTSIDE", {MOCK_BUCKET - 1200: [4, 0, 4]}),
+                # Records with an unknown state are counted, but a window needs one with a known state
+                ("MOCK_MIXED", {MOCK_BUCKET: [4, 1, 1]}),
+                ("MOCK_UNKNOWN", {MOCK_BUCKET: [4, 0, 0]}),
+            ]
+        ]
+        rule_index = RuleIndex(default=[SHORT_RULE])
+
+        self.assertEqual(
+            [
+                (flappy_event.group_name, flappy_event.count, flappy_event.spread)
+                for flappy_event in rule_index.find_flapping(groups=groups, now=now)
+            ],
+            [("MOCK_EDGE", 4, 0), ("MOCK_MIXED", 4, 1)],
+        )
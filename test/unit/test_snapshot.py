@@ -0,0 +1,224 @@
+"""Tests for the detection snapshot"""
+from datetime import timedelta
+from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from botocore.exceptions import ClientError
+
+from flappy_detector.handlers.detect import FlappyDetector
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.snapshot import SNAPSHOT_FORMAT_VERSION, DetectionSnapshot, SnapshotStore
+
+MOCK_TEAM = "MOCK_TEAM"
+MOCK_TIMESTAMP = 1577836800
+MOCK_RECORD = {
+    "account": "MOCK_ACCOUNT",
+    "region": "MOCK_REGION",
+    "environment": "MOCK_ENVIRONMENT",
+    "application": "MOCK_APPLICATION",
+    "group_name": "MOCK_GROUP_NAME",
+}
+
+
+class TestDetectionSnapshot(TestCase):
+    """Tests for the detection snapshot"""
+
+    def test_add_event(self):
+        """Test events are summed by group and bucket, counting unknown states without a change"""
+        snapshot = DetectionSnapshot(watermark=MOCK_TIMESTAMP)
+        for state, offset in [
+                (Ec2State.RUNNING.value, 0),
+                (Ec2State.TERMINATED.value, 60),
+                (Ec2State.RUNNING.value, 300),
+                ("pending", 300),
+        ]:
+            snapshot.add_event({**MOCK_RECORD, "state": state, "timestamp": Decimal(MOCK_TIMESTAMP + offset)})
+        snapshot.add_event(
+            {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "team": MOCK_TEAM, "timestamp": 0}
+        )
+        snapshot.add_event({"state": Ec2State.RUNNING.value, "timestamp": MOCK_TIMESTAMP})
+
+        self.assertEqual(
+            {key: group.buckets for key, group in snapshot.groups.items()},
+            {
+                FlappyEvent(**MOCK_RECORD).key: {
+                    MOCK_TIMESTAMP: [2, 0, 2],
+                    MOCK_TIMESTAMP + 300: [2, 1, 1],
+                    0: [1, 1, 1],
+                },
+            },
+        )
+
+    def test_get_flappy_events_same_as_loop(self):
+        """Test a snapshot gives the same FlappyEvents as the detector's loop over mixed states"""
+        states = [Ec2State.RUNNING.value, "pending", Ec2State.TERMINATED.value, "shutting-down"] * 2
+        events = [
+            *[
+                {**MOCK_RECORD, "state": state, "timestamp": MOCK_TIMESTAMP + 60 * offset}
+                for offset, state in enumerate(states)
+            ],
+            {**MOCK_RECORD, "group_name": "MOCK_UNKNOWN", "state": "pending", "timestamp": MOCK_TIMESTAMP},
+        ]
+        flappy_detector = FlappyDetector(
+            datadog_client=MagicMock(),
+            dynamodb_table=MagicMock(),
+            max_event_age=timedelta(minutes=120),
+            min_number_of_events=5,
+            min_spread=1,
+        )
+        snapshot = DetectionSnapshot(watermark=MOCK_TIMESTAMP)
+        for event in events:
+            snapshot.add_event(event)
+
+        flappy_events = snapshot.get_flappy_events()
+
+        self.assertEqual(flappy_events, flappy_detector._group_events(events=events))
+        self.assertEqual(flappy_detector._find_flapping(flappy_events=flappy_events), flappy_events)
+
+    def test_expire(self):
+        """Test buckets before the cut off are dropped, along with empty groups"""
+        snapshot = DetectionSnapshot(watermark=MOCK_TIMESTAMP)
+        snapshot.add_event(
+            {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "timestamp": MOCK_TIMESTAMP - 300}
+        )
+        snapshot.add_event({**MOCK_RECORD, "state": Ec2State.RUNNING.value, "timestamp": MOCK_TIMESTAMP})
+        snapshot.add_event(
+            {**MOCK_RECORD, "group_name": "MOCK_OTHER", "state": Ec2State.RUNNING.value, "timestamp": 0}
+        )
+
+        snapshot.expire(cut_off_bucket=MOCK_TIMESTAMP)
+
+        self.assertEqual(
+            [(event.group_name, event.count, event.spread) for event in snapshot.get_flappy_events()],
+            [("MOCK_GROUP_NAME", 1, 1)],
+        )
+
+    def test_dumps_loads(self):
+        """Test a snapshot survives being encoded"""
+        snapshot = DetectionSnapshot(watermark=MOCK_TIMESTAMP)
+        snapshot.add_event(
+            {
+                **MOCK_RECORD,
+                "state": Ec2State.TERMINATED.value,
+                "team": MOCK_TEAM,
+                "timestamp": MOCK_TIMESTAMP,
+            }
+        )
+
+        self.assertEqual(DetectionSnapshot.loads(snapshot.dumps()), snapshot)
+
+
+class TestSnapshotStore(TestCase):
+    """Tests for the snapshot store"""
+
+    def setUp(self) -> None:
+        self.dynamodb_table = MagicMock()
+        self.dynamodb_table.put_item.return_value = {}
+        self.store = SnapshotStore(dynamodb_table=self.dynamodb_table)
+        self.snapshot = DetectionSnapshot(watermark=MOCK_TIMESTAMP)
+        self.snapshot.add_event({**MOCK_RECORD, "state": Ec2State.RUNNING.value, "timestamp": MOCK_TIMESTAMP})
+
+    def test_load(self):
+        """Test the stored snapshot is decoded"""
+        self.dynamodb_table.get_item.return_value = {
+            "Item": {
+                "snapshot_id": "detect",
+                "format_version": Decimal(SNAPSHOT_FORMAT_VERSION),
+                "data": MagicMock(value=self.snapshot.dumps()),
+            }
+        }
+
+        self.assertEqual(self.store.load(), self.snapshot)
+        self.dynamodb_table.get_item.assert_called_once_with(
+            Key={"snapshot_id": "detect"},
+            ConsistentRead=True,
+        )
+
+    def test_load_other_format(self):
+        """Test snapshots in another format are discarded"""
+        self.dynamodb_table.get_item.return_value = {
+            "Item": {
+                "snapshot_id": "detect",
+                "format_version": Decimal(SNAPSHOT_FORMAT_VERSION + 1),
+                "data": b"",
+            }
+        }
+
+        self.assertIsNone(self.store.load())
+
+    def test_load_missing(self):
+        """Test there is no snapshot before the first run"""
+        self.dynamodb_table.get_item.return_value = {}
+
+        self.assertIsNone(self.store.load())
+
+    def test_save(self):
+        """Test the snapshot is stored along with its format"""
+        self.assertTrue(self.store.save(snapshot=self.snapshot))
+
+        item = self.dynamodb_table.put_item.call_args[1]["Item"]
+        self.assertEqual(item["format_version"], SNAPSHOT_FORMAT_VERSION)
+        self.assertEqual(item["watermark"], MOCK_TIMESTAMP)
+        self.assertEqual(DetectionSnapshot.loads(item["data"]), self.snapshot)
+
+    def test_save_stale(self):
+        """Test a snapshot behind the stored one isn't stored"""
+        self.dynamodb_table.put_item.side_effect = ClientError(
+            {"Error": {"Code": "ConditionalCheckFailedException"}},
+            "PutItem",
+        )
+
+        self.assertFalse(self.store.save(snapshot=self.snapshot))
+
+    def test_save_sharded(self):
+        """Test a snapshot larger than a shard is split across items, deleting the replaced one's shards"""
+        items = {}
+
+        def put_item(Item, **_):  # pylint: disable=invalid-name
+            previous = items.get(Item["snapshot_id"])
+            items[Item["snapshot_id"]] = Item
+            return {"Attributes": previous} if previous else {}
+
+        self.dynamodb_table.put_item.side_effect = put_item
+        self.dynamodb_table.get_item.side_effect = lambda Key, **_: (
+            {"Item": items[Key["snapshot_id"]]} if Key["snapshot_id"] in items else {}
+        )
+        self.dynamodb_table.delete_item.side_effect = lambda Key, **_: items.pop(Key["snapshot_id"])
+        store = SnapshotStore(dynamodb_table=self.dynamodb_table, max_shard_size=16)
+        shards = -(-len(self.snapshot.dumps()) // 16)
+
+        self.assertTrue(store.save(snapshot=self.snapshot))
+
+        self.assertEqual(len(items), shards)
+        self.assertEqual(items["detect"]["shards"], shards)
+        self.assertEqual(store.load(), self.snapshot)
+
+        later_snapshot = DetectionSnapshot(watermark=MOCK_TIMESTAMP + 300)
+        self.assertTrue(store.save(snapshot=later_snapshot))
+
+        self.assertEqual(len(items), -(-len(later_snapshot.dumps()) // 16))
+        self.assertFalse(any(f"#{MOCK_TIMESTAMP}#" in snapshot_id for snapshot_id in items))
+        self.assertEqual(store.load(), later_snapshot)
+
+    def test_load_missing_shard(self):
+        """Test a snapshot whose shards were replaced while it was read is discarded"""
+        self.dynamodb_table.get_item.side_effect = [
+            {
+                "Item": {
+                    "snapshot_id": "detect",
+                    "format_version": Decimal(SNAPSHOT_FORMAT_VERSION),
+                    "watermark": Decimal(MOCK_TIMESTAMP),
+                    "shards": Decimal(2),
+                    "data": self.snapshot.dumps()[:8],
+                }
+            },
+            {},
+        ]
+
+        self.assertIsNone(self.store.load())
+        self.dynamodb_table.get_item.assert_called_with(
+            Key={"snapshot_id": f"detect#{MOCK_TIMESTAMP}#1"},
+            ConsistentRead=True,
+        )
@@ -0,0 +1,379 @@
+"""Tests for the Stream lambda"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import MagicMock, patch, ANY
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+
+from flappy_detector.handlers.detect import FlappyDetector
+from flappy_detector.handlers.stream import StreamDetector, handler
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils import columnar
+from flappy_detector.utils.enum import Ec2State
+
+MOCK_TEAM = "MOCK_TEAM"
+MOCK_GROUP_NAME = "MOCK_GROUP_NAME"
+MOCK_APPLICATION_FLAPPY = "MOCK_APPLICATION_FLAPPY"
+MOCK_ENVIRONMENT = "MOCK_ENVIRONMENT"
+MOCK_REGION = "MOCK_REGION"
+MOCK_ACCOUNT = "MOCK_ACCOUNT"
+MOCK_STATE_TABLE = "MOCK_FLAPPY_DETECTOR_STATE_TABLE"
+MOCK_MAX_EVENT_AGE_IN_MINS = 120
+MOCK_MIN_NUM_EVENTS = 4
+MOCK_MIN_SPREAD = 2
+ENVIRONMENT_VARIABLES = {
+    "FLAPPY_DETECTOR_STATE_TABLE": MOCK_STATE_TABLE,
+    "FLAPPY_DETECTOR_MAX_EVENT_AGE_IN_MINS": str(MOCK_MAX_EVENT_AGE_IN_MINS),
+    "FLAPPY_DETECTOR_MIN_NUM_EVENTS": str(MOCK_MIN_NUM_EVENTS),
+    "FLAPPY_DETECTOR_MIN_SPREAD": str(MOCK_MIN_SPREAD),
+}
+MOCK_TIME_NOW = datetime(2020, 1, 1)
+MOCK_TIMESTAMP = Decimal(MOCK_TIME_NOW.timestamp())
+MOCK_KEY = "_".join([MOCK_ACCOUNT, MOCK_REGION, MOCK_ENVIRONMENT, MOCK_APPLICATION_FLAPPY, MOCK_GROUP_NAME])
+MOCK_RECORD = {
+    "account": MOCK_ACCOUNT,
+    "region": MOCK_REGION,
+    "environment": MOCK_ENVIRONMENT,
+    "application": MOCK_APPLICATION_FLAPPY,
+    "group_name": MOCK_GROUP_NAME,
+    "timestamp": MOCK_TIMESTAMP,
+}
+
+
+def _flapping_records():
+    """Records of a group flapping, each with its event_id and sequence number"""
+    return [
+        {**MOCK_RECORD, "state": state.value, "event_id": str(index), "sequence_number": str(index)}
+        for index, state in enumerate([Ec2State.RUNNING, Ec2State.TERMINATED] * 2)
+    ]
+
+
+@patch.dict("os.environ", ENVIRONMENT_VARIABLES)
+@patch("flappy_detector.handlers.stream.datetime", MagicMock(now=lambda: MOCK_TIME_NOW))
+class TestHandlerStream(TestCase):
+    """Tests for the Stream lambda"""
+
+    def setUp(self) -> None:
+        self.datadog_client = MagicMock()
+        self.state_table = MagicMock()
+        self.state_table.name = MOCK_STATE_TABLE
+        self.state_table.get_item.return_value = {}
+        self.state_table.meta.client.batch_get_item.return_value = {"Responses": {}}
+        self.transact_write_items = self.state_table.meta.client.transact_write_items
+
+        self.handler = StreamDetector(
+            datadog_client=self.datadog_client,
+            state_table=self.state_table,
+            max_event_age=timedelta(minutes=MOCK_MAX_EVENT_AGE_IN_MINS),
+            min_number_of_events=MOCK_MIN_NUM_EVENTS,
+            min_spread=MOCK_MIN_SPREAD,
+        )
+
+    def _get_written(self):
+        """The state written by the last transaction, and the record ids it claimed"""
+        *markers, state = self.transact_write_items.call_args[1]["TransactItems"]
+        return state["Put"]["Item"], [marker["Put"]["Item"]["key"].split("#", 1)[1] for marker in markers]
+
+    @patch("flappy_detector.handlers.stream.initialize_datadog")
+    @patch("flappy_detector.handlers.stream.StreamDetector")
+    @patch("boto3.resource")
+    def test_handler(self, mock_boto3_resource, mock_stream_detector, mock_initialize_datadog):
+        """Tests the Stream lambda handler function"""
+        serializer = TypeSerializer()
+        mock_record = {**MOCK_RECORD, "state": Ec2State.RUNNING.value}
+        new_image = {name: serializer.serialize(value) for name, value in mock_record.items()}
+
+        mock_stream_detector.return_value.process_records.return_value = ["MOCK_SEQUENCE_NUMBER"]
+
+        actual = handler(
+            {
+                "Records": [
+                    {"eventName": "INSERT", "dynamodb": {"NewImage": new_image, "SequenceNumber": "1"}},
+                    {"eventName": "MODIFY", "dynamodb": {"NewImage": new_image, "SequenceNumber": "2"}},
+                ]
+            },
+            None,
+        )
+
+        self.assertEqual(actual, {"batchItemFailures": [{"itemIdentifier": "MOCK_SEQUENCE_NUMBER"}]})
+
+        mock_initialize_datadog.assert_called_once_with()
+        mock_boto3_resource.return_value.Table.assert_called_once_with(MOCK_STATE_TABLE)
+        mock_stream_detector.assert_called_once_with(
+            datadog_client=ANY,
+            state_table=mock_boto3_resource.return_value.Table.return_value,
+            max_event_age=timedelta(minutes=MOCK_MAX_EVENT_AGE_IN_MINS),
+            min_number_of_events=MOCK_MIN_NUM_EVENTS,
+            min_spread=MOCK_MIN_SPREAD,
+            alert_state_store=None,
+        )
+        mock_stream_detector.return_value.process_records.assert_called_once_with(
+            records=[{**mock_record, "sequence_number": "1"}],
+        )
+
+    def test_process_records(self):
+        """Test StreamDetector process_records alerts once a group starts flapping"""
+        records = [
+            {
+                **MOCK_RECORD,
+                "state": state.value,
+                "team": MOCK_TEAM if index == 1 else None,
+                "event_id": str(index),
+            }
+            for index, state in enumerate([Ec2State.RUNNING, Ec2State.TERMINATED] * 2)
+        ] + [
+            {**MOCK_RECORD, "state": "pending", "event_id": "4"},
+            {
+                **MOCK_RECORD,
+                "state": Ec2State.RUNNING.value,
+                "timestamp": MOCK_TIMESTAMP - 3 * 60 * 60,
+                "event_id": "5",
+            },
+        ]
+
+        self.assertEqual(self.handler.process_records(records=records), [])
+
+        time_bucket = str(int(MOCK_TIMESTAMP) // 60 * 60)
+        expires_at = int((MOCK_TIME_NOW + timedelta(minutes=MOCK_MAX_EVENT_AGE_IN_MINS)).timestamp())
+        self.transact_write_items.assert_called_once_with(
+            TransactItems=[
+                *[
+                    {
+                        "Put": {
+                            "TableName": MOCK_STATE_TABLE,
+                            "Item": {"key": f"{MOCK_KEY}#{index}", "expires_at": expires_at},
+                            "ConditionExpression": "attribute_not_exists(#key)",
+                            "ExpressionAttributeNames": {"#key": "key"},
+                        },
+                    }
+                    for index in range(5)
+                ],
+                {
+                    "Put": {
+                        "TableName": MOCK_STATE_TABLE,
+                        "Item": {
+                            "key": MOCK_KEY,
+                            "account": MOCK_ACCOUNT,
+                            "region": MOCK_REGION,
+                            "environment": MOCK_ENVIRONMENT,
+                            "application": MOCK_APPLICATION_FLAPPY,
+                            "group_name": MOCK_GROUP_NAME,
+                            "team": MOCK_TEAM,
+                            # The pending record is counted without changing the spread, as in the loop
+                            "buckets": {time_bucket: {"count": 5, "spread": 0, "known": 4}},
+                            "flapping": True,
+                            "version": 1,
+                            "expires_at": expires_at,
+                        },
+                        "ConditionExpression": "attribute_not_exists(#version) OR #version = :version",
+                        "ExpressionAttributeNames": {"#version": "version"},
+                        "ExpressionAttributeValues": {":version": 0},
+                    },
+                },
+            ],
+        )
+        self.datadog_client.Event.create.assert_called_once_with(
+            title=ANY,
+            text=ANY,
+            alert_type="warning",
+            aggregation_key=MOCK_KEY,
+            tags=FlappyEvent(
+                account=MOCK_ACCOUNT,
+                region=MOCK_REGION,
+                environment=MOCK_ENVIRONMENT,
+                application=MOCK_APPLICATION_FLAPPY,
+                group_name=MOCK_GROUP_NAME,
+                team=MOCK_TEAM,
+            ).tags,
+            attach_host_name=False,
+        )
+
+    def test_process_records_existing_state(self):
+        """Test StreamDetector process_records expires old buckets and doesn't alert again"""
+        recent_bucket = int(MOCK_TIMESTAMP) // 60 * 60 - 60
+        expired_bucket = int(MOCK_TIMESTAMP) // 60 * 60 - 3 * 60 * 60
+        self.state_table.get_item.return_value = {
+            "Item": {
+                "key": MOCK_KEY,
+                "team": MOCK_TEAM,
+                "buckets": {
+                    str(recent_bucket): {"count": Decimal(5), "spread": Decimal(0), "known": Decimal(4)},
+                    str(expired_bucket): {"count": Decimal(10), "spread": Decimal(10)},
+                },
+                "flapping": True,
+                "version": Decimal(3),
+            }
+        }
+
+        self.handler.process_records(
+            records=[{**MOCK_RECORD, "state": Ec2State.RUNNING.value, "event_id": "4"}],
+        )
+
+        item, record_ids = self._get_written()
+        self.assertEqual(
+            item["buckets"],
+            {
+                str(recent_bucket): {"count": 5, "spread": 0, "known": 4},
+                str(int(MOCK_TIMESTAMP) // 60 * 60): {"count": 1, "spread": 1, "known": 1},
+            },
+        )
+        self.assertEqual(record_ids, ["4"])
+        self.assertEqual(item["version"], 4)
+        self.assertTrue(item["flapping"])
+        self.datadog_client.Event.create.assert_not_called()
+
+    @patch("flappy_detector.handlers.stream.time.sleep")
+    def test_process_records_raced(self, mock_sleep):
+        """Test StreamDetector process_records retries, after a backoff, when another update races it"""
+        for reasons in [["None", "ConditionalCheckFailed"], ["TransactionConflict", "None"]]:
+            with self.subTest(reasons=reasons):
+                self.state_table.get_item.reset_mock()
+                self.transact_write_items.reset_mock()
+                mock_sleep.reset_mock()
+                self.transact_write_items.side_effect = [
+                    ClientError(
+                        {
+                            "Error": {"Code": "TransactionCanceledException"},
+                            "CancellationReasons": [{"Code": reason} for reason in reasons],
+                        },
+                        "TransactWriteItems",
+                    ),
+                    {},
+                ]
+
+                self.handler.process_records(
+                    records=[{**MOCK_RECORD, "state": Ec2State.RUNNING.value, "event_id": "0"}],
+                )
+
+                self.assertEqual(self.state_table.get_item.call_count, 2)
+                self.assertEqual(self.transact_write_items.call_count, 2)
+                mock_sleep.assert_called_once()
+
+    def test_process_records_redelivered(self):
+        """Test records already counted, by event_id or else sequence number, are skipped"""
+        time_bucket = int(MOCK_TIMESTAMP) // 60 * 60
+        self.state_table.get_item.return_value = {
+            "Item": {
+                "key": MOCK_KEY,
+                "buckets": {str(time_bucket): {"count": Decimal(2), "spread": Decimal(0)}},
+                "flapping": False,
+                "version": Decimal(1),
+            }
+        }
+        self.state_table.meta.client.batch_get_item.return_value = {
+            "Responses": {MOCK_STATE_TABLE: [{"key": f"{MOCK_KEY}#0"}, {"key": f"{MOCK_KEY}#MOCK_SEQ"}]},
+        }
+        records = [
+            {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "event_id": "0", "sequence_number": "1"},
+            {**MOCK_RECORD, "state": Ec2State.TERMINATED.value, "sequence_number": "MOCK_SEQ"},
+        ]
+
+        self.assertEqual(self.handler.process_records(records=records), [])
+
+        self.transact_write_items.assert_not_called()
+        self.state_table.meta.client.batch_get_item.assert_called_once_with(
+            RequestItems={
+                MOCK_STATE_TABLE: {
+                    "Keys": [{"key": f"{MOCK_KEY}#0"}, {"key": f"{MOCK_KEY}#MOCK_SEQ"}],
+                    "ConsistentRead": True,
+                    "ProjectionExpression": "#key",
+                    "ExpressionAttributeNames": {"#key": "key"},
+                },
+            },
+        )
+
+        records.append(
+            {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "event_id": "1", "sequence_number": "2"},
+        )
+        self.handler.process_records(records=records)
+
+        item, record_ids = self._get_written()
+        # Buckets stored before unknown states were counted hold only known ones
+        self.assertEqual(item["buckets"], {str(time_bucket): {"count": 3, "spread": 1, "known": 3}})
+        self.assertEqual(record_ids, ["1"])
+
+    def test_process_records_same_as_loop(self):
+        """Test the stream flags the same groups as the detector's loop and NumPy engine over mixed states"""
+        states = [Ec2State.RUNNING.value, "pending", Ec2State.TERMINATED.value, "shutting-down"] * 2
+        records = [
+            *[
+                {**MOCK_RECORD, "state": state, "event_id": str(index)}
+                for index, state in enumerate(states)
+            ],
+            {**MOCK_RECORD, "group_name": "MOCK_UNKNOWN", "state": "pending", "event_id": "MOCK_UNKNOWN"},
+        ]
+        self.handler.min_number_of_events = 5
+        self.handler.min_spread = 1
+        flappy_detector = FlappyDetector(
+            datadog_client=MagicMock(),
+            dynamodb_table=MagicMock(),
+            max_event_age=timedelta(minutes=MOCK_MAX_EVENT_AGE_IN_MINS),
+            min_number_of_events=5,
+            min_spread=1,
+        )
+        flappy_events = flappy_detector._group_events(events=records)
+        flapping_events = flappy_detector._find_flapping(flappy_events=flappy_events)
+
+        self.handler.process_records(records=records)
+
+        written = [
+            (
+                item["group_name"],
+                *[
+                    sum(counts[name] for counts in item["buckets"].values())
+                    for name in ("count", "spread", "known")
+                ],
+            )
+            for item in [
+                call_args[1]["TransactItems"][-1]["Put"]["Item"]
+                for call_args in self.transact_write_items.call_args_list
+            ]
+        ]
+        # As in the loop, a group with only unknown states is counted but never evaluated
+        self.assertEqual(
+            [(group_name, count, spread) for group_name, count, spread, known in written if known],
+            [(event.group_name, event.count, event.spread) for event in flappy_events],
+        )
+        self.assertEqual(self.datadog_client.Event.create.call_count, 1)
+        self.assertEqual([event.group_name for event in flapping_events], [MOCK_GROUP_NAME])
+        self.assertEqual(columnar.group_events(events=records), flappy_events)
+
+    def test_process_records_alert_failed(self):
+        """Test a group whose alert can't be sent isn't written, and its records are reported for a retry"""
+        records = _flapping_records()
+        self.datadog_client.Event.create.side_effect = [ValueError("MOCK_ERROR"), None]
+
+        self.assertEqual(self.handler.process_records(records=records), ["0", "1", "2", "3"])
+        self.transact_write_items.assert_not_called()
+
+        self.assertEqual(self.handler.process_records(records=records), [])
+        self.assertEqual(self.datadog_client.Event.create.call_count, 2)
+        self.transact_write_items.assert_called_once()
+
+    def test_process_records_alert_state_store(self):
+        """Test alerts are claimed from the alert state store, and released when they can't be sent"""
+        mock_alert_state_store = MagicMock()
+        self.handler.alert_state_store = mock_alert_state_store
+        records = _flapping_records()
+
+        for claimed, error, expected_failures in [
+                (False, None, []),
+                (True, None, []),
+                (True, ValueError("MOCK_ERROR"), ["0", "1", "2", "3"]),
+        ]:
+            with self.subTest(claimed=claimed, error=error):
+                mock_alert_state_store.reset_mock()
+                self.datadog_client.reset_mock()
+                mock_alert_state_store.claim_alert.return_value = claimed
+                self.datadog_client.Event.create.side_effect = error
+
+                self.assertEqual(self.handler.process_records(records=records), expected_failures)
+
+                mock_alert_state_store.claim_alert.assert_called_once()
+                self.assertEqual(self.datadog_client.Event.create.called, claimed)
+                if error:
+                    mock_alert_state_store.release.assert_called_once()
+                else:
+                    mock_alert_state_store.release.assert_not_called()
@@ -0,0 +1,26 @@
+"""Tests for the time bucket helpers"""
+from decimal import Decimal
+from unittest import TestCase
+
+from flappy_detector.utils.time_bucket import get_time_bucket, get_time_buckets
+
+
+class TestTimeBucket(TestCase):
+    """Tests for the time bucket helpers"""
+
+    def test_get_time_bucket(self):
+        """Test get_time_bucket rounds down to the start of the bucket"""
+        self.assertEqual(get_time_bucket(Decimal("7199.5")), 3600)
+        self.assertEqual(get_time_bucket(7200), 7200)
+        self.assertEqual(get_time_bucket(250, bucket_size=100), 200)
+
+    def test_get_time_buckets(self):
+        """Test get_time_buckets covers the whole range"""
+        self.assertEqual(
+            get_time_buckets(start=Decimal("3599.9"), end=Decimal(7200)),
+            [0, 3600, 7200],
+        )
+        self.assertEqual(
+            get_time_buckets(start=3600, end=3700),
+            [3600],
+        )
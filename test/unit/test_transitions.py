@@ -0,0 +1,78 @@
+"""Tests for the ordered analysis of each group's state changes"""
+from decimal import Decimal
+from unittest import TestCase
+
+from flappy_detector.models import FlappyEvent
+from flappy_detector.utils.enum import Ec2State
+from flappy_detector.utils.transitions import GroupTransitions, TransitionStats, group_transitions
+
+MOCK_TEAM = "MOCK_TEAM"
+MOCK_RECORD = {
+    "account": "MOCK_ACCOUNT",
+    "region": "MOCK_REGION",
+    "environment": "MOCK_ENVIRONMENT",
+    "application": "MOCK_APPLICATION",
+    "group_name": "MOCK_GROUP_NAME",
+}
+
+
+class TestTransitions(TestCase):
+    """Tests for the ordered analysis of each group's state changes"""
+
+    def test_get_stats(self):
+        """Test reversals, runs and intervals are found in timestamp order, whatever order they're added in"""
+        group = GroupTransitions(flappy_event=FlappyEvent(**MOCK_RECORD), max_events=100)
+        for sequence, (timestamp, change) in enumerate([(30, -1), (0, 1), (10, 1), (40, 1), (20, 1)]):
+            group.add(timestamp=Decimal(timestamp), sequence=sequence, change=change)
+
+        self.assertEqual(
+            group.get_stats(),
+            TransitionStats(reversals=2, longest_run=3, min_interval=10.0, median_interval=10.0),
+        )
+        self.assertEqual((group.flappy_event.count, group.flappy_event.spread), (5, 3))
+
+    def test_get_stats_same_timestamp(self):
+        """Test changes with the same timestamp are kept in the order they were read"""
+        group = GroupTransitions(flappy_event=FlappyEvent(**MOCK_RECORD), max_events=100)
+        for sequence, change in enumerate([1, 1, -1]):
+            group.add(timestamp=Decimal(0), sequence=sequence, change=change)
+
+        self.assertEqual(
+            group.get_stats(),
+            TransitionStats(reversals=1, longest_run=2, min_interval=0.0, median_interval=0.0),
+        )
+
+    def test_get_stats_bounded(self):
+        """Test only the newest changes are held, while the count and spread cover every one"""
+        group = GroupTransitions(flappy_event=FlappyEvent(**MOCK_RECORD), max_events=3)
+        for sequence, timestamp in enumerate([5, 0, 4, 1, 3, 2]):
+            group.add(timestamp=timestamp, sequence=sequence, change=1 if timestamp % 2 else -1)
+
+        self.assertEqual([change[0] for change in sorted(group.changes)], [3, 4, 5])
+        self.assertEqual(group.get_stats().reversals, 2)
+        self.assertEqual((group.flappy_event.count, group.flappy_event.spread), (6, 0))
+
+    def test_get_stats_empty(self):
+        """Test a group without any changes held"""
+        group = GroupTransitions(flappy_event=FlappyEvent(**MOCK_RECORD), max_events=100)
+
+        self.assertEqual(group.get_stats(), TransitionStats())
+
+    def test_group_transitions(self):
+        """Test records are folded by group, skipping unknown states and malformed records"""
+        groups = group_transitions(
+            events=[
+                {**MOCK_RECORD, "state": Ec2State.RUNNING.value, "timestamp": Decimal(0)},
+                {**MOCK_RECORD, "state": "pending", "timestamp": Decimal(1)},
+                {**MOCK_RECORD, "group_name": None, "state": Ec2State.RUNNING.value, "timestamp": Decimal(2)},
+                {**MOCK_RECORD, "state": Ec2State.RUNNING.value},
+                {**MOCK_RECORD, "team": MOCK_TEAM, "state": Ec2State.TERMINATED.value, "timestamp": 3},
+            ],
+            max_events=100,
+        )
+
+        self.assertEqual(
+            [group.flappy_event for group in groups],
+            [FlappyEvent(**MOCK_RECORD, team=MOCK_TEAM, count=2, spread=0)],
+        )
+        self.assertEqual(groups[0].get_stats().reversals, 1)